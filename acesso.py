@@ -0,0 +1,246 @@
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as TempoEsgotado
+from concurrent.futures.process import BrokenProcessPool
+
+import psycopg2.extras
+from werkzeug.security import check_password_hash
+
+import notificacoes
+from db import conectar
+
+# =========================
+# LOGIN
+# =========================
+# O hash da senha é caro de propósito, e na abertura da quermesse todos os
+# caixas entram no mesmo minuto. A conferência roda num pool de processos
+# pequeno e limitado (por worker), fora da CPU da requisição; quem passa do
+# limite da fila espera um pouco e, se não der, recebe "tente de novo".
+#
+# Tentativas erradas são contadas em memória, por usuário e por IP, numa
+# janela deslizante: passou do limite, o login é recusado antes de ir ao
+# banco ou calcular hash. As contagens e o cache são de cada worker.
+#
+# O cache de usuários vale só enquanto a geração de usuários do ouvinte de
+# avisos (notificacoes.py) for a mesma: qualquer alteração em "usuarios"
+# (senha, perfil, exclusão) dispara um NOTIFY no commit e descarta o cache
+# de todos os workers. Sem LISTEN, nada é guardado.
+
+# processos que conferem senhas, por worker
+PROCESSOS = int(os.getenv("LOGIN_PROCESSOS", "1"))
+
+# conferências rodando ou esperando, por worker
+FILA_MAXIMA = int(os.getenv("LOGIN_FILA_MAXIMA", "32"))
+
+# tempo máximo (s) esperando vaga na fila e, depois, o resultado
+ESPERA_MAXIMA = float(os.getenv("LOGIN_ESPERA_MAXIMA", "10"))
+
+# linha de "usuarios" guardada por até esse tempo (s) depois de lida
+CACHE_SEGUNDOS = float(os.getenv("LOGIN_CACHE_SEGUNDOS", "30"))
+
+# tentativas erradas permitidas dentro da janela (s); todos os tablets da
+# quermesse costumam sair pelo mesmo IP, por isso o limite por IP é maior
+JANELA = float(os.getenv("LOGIN_JANELA", "300"))
+FALHAS_POR_USUARIO = int(os.getenv("LOGIN_FALHAS_POR_USUARIO", "5"))
+FALHAS_POR_IP = int(os.getenv("LOGIN_FALHAS_POR_IP", "50"))
+
+# proxies na frente do app que acrescentam o IP em X-Forwarded-For; 0 usa o
+# endereço da própria conexão. No Heroku (DYNO definido) o padrão é 1, o
+# roteador: sem isso todos os clientes contariam como um IP só
+PROXIES = int(os.getenv("LOGIN_PROXIES", "1" if os.getenv("DYNO") else "0"))
+
+# contadores com mais chaves que isso são varridos
+CHAVES_MAXIMO = 10_000
+
+
+class LoginRecusado(Exception):
+    pass
+
+
+def ip_do_cliente(request):
+    if PROXIES > 0 and len(request.access_route) >= PROXIES:
+        return request.access_route[-PROXIES]
+    return request.remote_addr
+
+
+# =========================
+# TENTATIVAS ERRADAS
+# =========================
+class Tentativas:
+
+    def __init__(self, limite):
+        self.limite = limite
+        self._lock = threading.Lock()
+        self._falhas = {}   # chave -> deque de instantes
+
+    def _recentes(self, chave, agora):
+        falhas = self._falhas.get(chave)
+
+        while falhas and falhas[0] <= agora - JANELA:
+            falhas.popleft()
+
+        if falhas is not None and not falhas:
+            del self._falhas[chave]
+            return None
+
+        return falhas
+
+    def bloqueado(self, chave):
+        with self._lock:
+            falhas = self._recentes(chave, time.monotonic())
+            return falhas is not None and len(falhas) >= self.limite
+
+    def falhou(self, chave):
+        agora = time.monotonic()
+
+        with self._lock:
+            if len(self._falhas) >= CHAVES_MAXIMO:
+                for antiga in list(self._falhas):
+                    self._recentes(antiga, agora)
+
+            self._falhas.setdefault(chave, deque()).append(agora)
+
+    def limpar(self, chave):
+        with self._lock:
+            self._falhas.pop(chave, None)
+
+
+_por_usuario = Tentativas(FALHAS_POR_USUARIO)
+_por_ip = Tentativas(FALHAS_POR_IP)
+
+
+# =========================
+# CACHE DE USUÁRIOS
+# =========================
+_usuarios = {}   # usuario -> (linha, expira_em, geração dos usuários)
+_usuarios_lock = threading.Lock()
+
+
+def buscar_usuario(usuario):
+    agora = time.monotonic()
+
+    # geração lida antes da consulta: um aviso que chegue durante a leitura
+    # já invalida o que foi lido
+    geracao = notificacoes.obter_ouvinte().geracao_usuarios()
+
+    with _usuarios_lock:
+        linha, expira_em, geracao_linha = _usuarios.get(usuario, (None, 0, None))
+        if geracao is not None and geracao_linha == geracao and expira_em > agora:
+            return linha
+
+    with conectar() as conn:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        c.execute("""
+            SELECT id, nome_usuario, usuario, senha, perfil
+            FROM usuarios
+            WHERE usuario = %s
+        """, (usuario,))
+        linha = c.fetchone()
+
+    # só usuários que existem: nomes inventados não ocupam o cache
+    if linha is not None and geracao is not None:
+        with _usuarios_lock:
+            if len(_usuarios) >= CHAVES_MAXIMO:
+                _usuarios.clear()
+            _usuarios[usuario] = (linha, agora + CACHE_SEGUNDOS, geracao)
+
+    return linha
+
+
+def esquecer_usuario(*usuarios):
+
+    # chamar ao criar/editar/excluir usuário: vale já neste worker; os
+    # outros descartam o cache quando o aviso de usuários chegar
+    with _usuarios_lock:
+        for usuario in usuarios:
+            _usuarios.pop(usuario, None)
+
+
+# =========================
+# POOL DE CONFERÊNCIA
+# =========================
+class Conferencia:
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.vagas = threading.BoundedSemaphore(FILA_MAXIMA)
+
+        # spawn: o processo filho não herda threads nem conexões do worker
+        self.executor = ProcessPoolExecutor(
+            max_workers=PROCESSOS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def conferir(self, senha_hash, senha):
+        if not self.vagas.acquire(timeout=ESPERA_MAXIMA):
+            raise LoginRecusado("Muitos logins ao mesmo tempo. Tente de novo em instantes.")
+
+        try:
+            futuro = self.executor.submit(check_password_hash, senha_hash, senha)
+        except BaseException:
+            self.vagas.release()
+            raise
+
+        # a vaga só volta quando o processo termina, mesmo se desistirmos antes
+        futuro.add_done_callback(lambda _: self.vagas.release())
+
+        try:
+            return futuro.result(timeout=ESPERA_MAXIMA)
+        except TempoEsgotado:
+            raise LoginRecusado("Muitos logins ao mesmo tempo. Tente de novo em instantes.")
+
+
+_conferencia = None
+_conferencia_lock = threading.Lock()
+
+
+def obter_conferencia():
+    global _conferencia
+
+    # um pool por worker (fork), criado no primeiro login
+    if _conferencia is None or _conferencia.pid != os.getpid():
+        with _conferencia_lock:
+            if _conferencia is None or _conferencia.pid != os.getpid():
+                _conferencia = Conferencia()
+
+    return _conferencia
+
+
+def conferir_senha(senha_hash, senha):
+    global _conferencia
+
+    conferencia = obter_conferencia()
+
+    try:
+        return conferencia.conferir(senha_hash, senha)
+    except BrokenProcessPool:
+        # processo do pool morreu: o próximo login cria outro pool, e este
+        # confere aqui mesmo
+        with _conferencia_lock:
+            if _conferencia is conferencia:
+                _conferencia = None
+        return check_password_hash(senha_hash, senha)
+
+
+# =========================
+# AUTENTICAÇÃO
+# =========================
+def autenticar(usuario, senha, ip):
+
+    # devolve a linha do usuário, ou None se usuário/senha não conferem
+    if _por_usuario.bloqueado(usuario) or _por_ip.bloqueado(ip):
+        raise LoginRecusado("Muitas tentativas erradas. Aguarde alguns minutos.")
+
+    linha = buscar_usuario(usuario)
+
+    if linha is not None and conferir_senha(linha["senha"], senha):
+        _por_usuario.limpar(usuario)
+        return linha
+
+    _por_usuario.falhou(usuario)
+    _por_ip.falhou(ip)
+    return None
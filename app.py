@@ -1,45 +1,64 @@
 
-from flask import Flask, render_template, request, redirect, session, send_file, flash, jsonify
+from flask import Flask, render_template, request, redirect, session, send_file, flash, jsonify, Response
 import psycopg2
 import psycopg2.extras
 import os
 import base64
+import hashlib
+import hmac
+import tempfile
+import threading
 from pybrcode.pix import generate_simple_pix
-from datetime import datetime
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from functools import lru_cache
 from zoneinfo import ZoneInfo
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.lib import colors
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash
 from io import BytesIO
+from urllib.parse import urlencode
+from db import conectar, estatisticas_pool
+import resumos
+import exportacao
+import relatorios_pdf
+import tarefas
+import notificacoes
+import catalogo
+import movimentos
+import consultas
+import fechamentos
+import metricas
+import lentas
+import acesso
 
 app = Flask(__name__)
 app.secret_key = "quermesse_secret"
 
 # =========================
-# CONEXÃO POSTGRES
+# MÉTRICAS POR REQUISIÇÃO
 # =========================
-def conectar():
-    try:
-        conn = psycopg2.connect(
-            os.getenv("DATABASE_URL"),
-            sslmode="require"
-        )
-
-        cur = conn.cursor()
-        cur.execute("SET TIME ZONE 'America/Manaus';")
-        cur.close()
-        
-        return conn
-    except Exception as e:
-        print("ERRO GRAVE AO CONECTAR NO POSTGRES:", e)
-        return None
+# rota = regra do Flask ("/itens_venda/<int:numero_venda>"), nunca a URL
+# crua, para o número de séries não crescer com os parâmetros
+def rota_da_requisicao():
+    return request.url_rule.rule if request.url_rule else "sem_rota"
+
+@app.before_request
+def medir_inicio():
+    metricas.inicio_requisicao(rota_da_requisicao())
+
+@app.after_request
+def medir_fim(response):
+    metricas.fim_requisicao(rota_da_requisicao(), request.method, response.status_code)
+    return response
+
+@app.teardown_request
+def medir_erro(erro):
+    # exceção não tratada: after_request não roda
+    if erro is not None:
+        metricas.fim_requisicao(rota_da_requisicao(), request.method, 500)
 
 def agora_amazonas():
     return datetime.now(ZoneInfo("America/Manaus"))
+
     
 # =========================
 # LOGIN
@@ -58,16 +77,16 @@ def autenticar():
     usuario = request.form["usuario"]
     senha = request.form["senha"]
 
-    conn = conectar()
-    if not conn:
+    # senha conferida fora do worker, com limite de tentativas (acesso.py)
+    try:
+        user = acesso.autenticar(usuario, senha, acesso.ip_do_cliente(request))
+    except acesso.LoginRecusado as e:
+        flash(str(e), "warning")
+        return redirect("/")
+    except psycopg2.OperationalError:
         return "Erro ao conectar no banco", 500
 
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    c.execute("SELECT * FROM usuarios WHERE usuario=%s", (usuario,))
-    user = c.fetchone()
-    conn.close()
-
-    if user and check_password_hash(user["senha"], senha):
+    if user:
         session["usuario_id"] = user["id"]
         session["usuario"] = user["usuario"]  # pode manter se quiser
         session["perfil"] = user.get("perfil", "usuario")
@@ -89,35 +108,32 @@ def cadastro():
     if not session.get("usuario"):
         return redirect("/")
 
-    conn = conectar()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    with conectar() as conn:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-    if request.method == "POST":
-        nome_usuario = request.form["nome_usuario"]
-        usuario = request.form["usuario"]
-        senha = generate_password_hash(request.form["senha"])
-        perfil = request.form["perfil"]
+        if request.method == "POST":
+            nome_usuario = request.form["nome_usuario"]
+            usuario = request.form["usuario"]
+            senha = generate_password_hash(request.form["senha"])
+            perfil = request.form["perfil"]
 
-        # Verifica se já existe
-        c.execute("SELECT id FROM usuarios WHERE usuario = %s", (usuario,))
-        if c.fetchone():
-            conn.close()
-            flash("Usuário já cadastrado!", "danger")
-            return redirect("/cadastro")
+            # Verifica se já existe
+            c.execute("SELECT id FROM usuarios WHERE usuario = %s", (usuario,))
+            if c.fetchone():
+                flash("Usuário já cadastrado!", "danger")
+                return redirect("/cadastro")
 
-        c.execute(
-            "INSERT INTO usuarios (nome_usuario,usuario, senha, perfil) VALUES (%s, %s, %s, %s)",
-            (nome_usuario, usuario, senha, perfil)
-        )
-        conn.commit()
-        flash("Usuário cadastrado com sucesso!", "success")
-        conn.close()
-        return redirect("/cadastro")
+            c.execute(
+                "INSERT INTO usuarios (nome_usuario,usuario, senha, perfil) VALUES (%s, %s, %s, %s)",
+                (nome_usuario, usuario, senha, perfil)
+            )
+            conn.commit()
+            flash("Usuário cadastrado com sucesso!", "success")
+            return redirect("/cadastro")
 
-    # 🔹 IMPORTANTE: SEMPRE EXECUTA NO GET
-    c.execute("SELECT id,nome_usuario, usuario, perfil FROM usuarios ORDER BY usuario ASC")
-    usuarios = c.fetchall()
-    conn.close()
+        # 🔹 IMPORTANTE: SEMPRE EXECUTA NO GET
+        c.execute("SELECT id,nome_usuario, usuario, perfil FROM usuarios ORDER BY usuario ASC")
+        usuarios = c.fetchall()
 
     return render_template("cadastro.html", usuarios=usuarios)
 
@@ -130,43 +146,42 @@ def editar_usuario(id):
     if not session.get("usuario"):
         return redirect("/")
 
-    conn = conectar()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    with conectar() as conn:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-    # Busca usuário
-    c.execute("SELECT id, nome_usuario, usuario, perfil FROM usuarios WHERE id = %s", (id,))
-    usuario = c.fetchone()
+        # Busca usuário
+        c.execute("SELECT id, nome_usuario, usuario, perfil FROM usuarios WHERE id = %s", (id,))
+        usuario = c.fetchone()
 
-    if not usuario:
-        conn.close()
-        flash("Usuário não encontrado.", "danger")
-        return redirect("/cadastro")
+        if not usuario:
+            flash("Usuário não encontrado.", "danger")
+            return redirect("/cadastro")
 
-    if request.method == "POST":
-        novo_nome_usuario = request.form["nome_usuario"]
-        novo_usuario = request.form["usuario"]
-        novo_perfil = request.form["perfil"]
-        nova_senha = request.form["senha"]
-    
-        if nova_senha:
-            senha_hash = generate_password_hash(nova_senha)
-            c.execute(
-                "UPDATE usuarios SET nome_usuario = %s, usuario = %s, perfil = %s, senha = %s WHERE id = %s",
-                (novo_nome_usuario, novo_usuario, novo_perfil, senha_hash, id)
-            )
-        else:
-            c.execute(
-                "UPDATE usuarios SET nome_usuario = %s, usuario = %s, perfil = %s WHERE id = %s",
-                (novo_nome_usuario, novo_usuario, novo_perfil, id)
-            )
-    
-        conn.commit()
-        conn.close()
-    
-        flash("Usuário atualizado com sucesso!", "success")
-        return redirect("/cadastro")
+        if request.method == "POST":
+            novo_nome_usuario = request.form["nome_usuario"]
+            novo_usuario = request.form["usuario"]
+            novo_perfil = request.form["perfil"]
+            nova_senha = request.form["senha"]
+        
+            if nova_senha:
+                senha_hash = generate_password_hash(nova_senha)
+                c.execute(
+                    "UPDATE usuarios SET nome_usuario = %s, usuario = %s, perfil = %s, senha = %s WHERE id = %s",
+                    (novo_nome_usuario, novo_usuario, novo_perfil, senha_hash, id)
+                )
+            else:
+                c.execute(
+                    "UPDATE usuarios SET nome_usuario = %s, usuario = %s, perfil = %s WHERE id = %s",
+                    (novo_nome_usuario, novo_usuario, novo_perfil, id)
+                )
+        
+            conn.commit()
+            resumos.nova_versao(conn)
+            acesso.esquecer_usuario(usuario["usuario"], novo_usuario)
+        
+            flash("Usuário atualizado com sucesso!", "success")
+            return redirect("/cadastro")
 
-    conn.close()
     return render_template("editar_usuario.html", usuario=usuario)
 
 # =========================
@@ -177,28 +192,27 @@ def excluir_usuario(id):
     if not session.get("usuario"):
         return redirect("/")
 
-    conn = conectar()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    with conectar() as conn:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-    # Busca usuário a excluir
-    c.execute("SELECT usuario FROM usuarios WHERE id = %s", (id,))
-    usuario_excluir = c.fetchone()
+        # Busca usuário a excluir
+        c.execute("SELECT usuario FROM usuarios WHERE id = %s", (id,))
+        usuario_excluir = c.fetchone()
 
-    if not usuario_excluir:
-        conn.close()
-        flash("Usuário não encontrado.", "danger")
-        return redirect("/cadastro")
+        if not usuario_excluir:
+            flash("Usuário não encontrado.", "danger")
+            return redirect("/cadastro")
 
-    # 🔒 NÃO permite excluir o próprio usuário logado
-    if usuario_excluir["usuario"] == session["usuario"]:
-        conn.close()
-        flash("Você não pode excluir o próprio usuário!", "danger")
-        return redirect("/cadastro")
+        # 🔒 NÃO permite excluir o próprio usuário logado
+        if usuario_excluir["usuario"] == session["usuario"]:
+            flash("Você não pode excluir o próprio usuário!", "danger")
+            return redirect("/cadastro")
 
-    # Exclui
-    c.execute("DELETE FROM usuarios WHERE id = %s", (id,))
-    conn.commit()
-    conn.close()
+        # Exclui
+        c.execute("DELETE FROM usuarios WHERE id = %s", (id,))
+        conn.commit()
+        resumos.nova_versao(conn)
+        acesso.esquecer_usuario(usuario_excluir["usuario"])
 
     flash("Usuário excluído com sucesso!", "success")
     return redirect("/cadastro")
@@ -223,29 +237,33 @@ def produtos():
     if session.get("perfil") != "administrador":
         return redirect("/dashboard")
 
-    conn = conectar()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    with conectar() as conn:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-    if request.method == "POST":
-        descricao = request.form["descricao"]
-        valor = float(request.form["valor"].replace(",", "."))
-        estoque_inicial = int(request.form["estoque_inicial"])
-        imprimir_cupom = True if request.form.get("imprimir_cupom") else False
-        
-        # estoque atual começa igual ao inicial
-        estoque_atual = estoque_inicial
+        if request.method == "POST":
+            descricao = request.form["descricao"]
+            valor = float(request.form["valor"].replace(",", "."))
+            estoque_inicial = int(request.form["estoque_inicial"])
+            imprimir_cupom = True if request.form.get("imprimir_cupom") else False
+            
+            # estoque atual começa igual ao inicial
+            estoque_atual = estoque_inicial
 
-        c.execute("""
-            INSERT INTO produtos (descricao, valor, estoque_inicial, estoque_atual, imprimir_cupom)
-            VALUES (%s, %s, %s, %s, %s)
-            """, (descricao, valor, estoque_inicial, estoque_atual, imprimir_cupom))
+            c.execute("""
+                INSERT INTO produtos (descricao, valor, estoque_inicial, estoque_atual, imprimir_cupom)
+                VALUES (%s, %s, %s, %s, %s)
+                """, (descricao, valor, estoque_inicial, estoque_atual, imprimir_cupom))
 
-        conn.commit()
-        flash("Produto cadastrado com sucesso!", "success")
+            conn.commit()
+            flash("Produto cadastrado com sucesso!", "success")
 
-    c.execute("SELECT * FROM produtos ORDER BY descricao ASC")
-    lista = c.fetchall()
-    conn.close()
+        c.execute("SELECT * FROM produtos ORDER BY descricao ASC")
+        lista = c.fetchall()
+
+        # estoque_atual da tabela é o consolidado; o vendável vem das fatias
+        disponivel = movimentos.disponivel(conn.cursor())
+        for produto in lista:
+            produto["estoque_atual"] = disponivel.get(produto["id"], 0)
 
     return render_template("produtos.html", produtos=lista)
 
@@ -257,37 +275,36 @@ def editar_produto(id):
     if session.get("perfil") != "administrador":
         return redirect("/dashboard")
 
-    conn = conectar()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    if request.method == "POST":
-        descricao = request.form["descricao"]
-        valor = float(request.form["valor"].replace(",", "."))
-        estoque_inicial = int(request.form["estoque_inicial"])
-        imprimir_cupom = True if request.form.get("imprimir_cupom") else False
+    with conectar() as conn:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-        # 👇 AQUI ESTÁ O AJUSTE
-        estoque_atual = estoque_inicial
+        if request.method == "POST":
+            descricao = request.form["descricao"]
+            valor = float(request.form["valor"].replace(",", "."))
+            estoque_inicial = int(request.form["estoque_inicial"])
+            imprimir_cupom = True if request.form.get("imprimir_cupom") else False
 
-        c.execute("""
-        UPDATE produtos
-        SET descricao = %s,
-            valor = %s,
-            estoque_inicial = %s,
-            estoque_atual = %s,
-            imprimir_cupom = %s
-        WHERE id = %s
-        """, (descricao, valor, estoque_inicial, estoque_atual, imprimir_cupom, id))
-        
-        conn.commit()
-        conn.close()
-
-        flash("Produto atualizado com sucesso!", "success")
-        return redirect("/produtos")
+            c.execute("""
+            UPDATE produtos
+            SET descricao = %s,
+                valor = %s,
+                estoque_inicial = %s,
+                imprimir_cupom = %s
+            WHERE id = %s
+            """, (descricao, valor, estoque_inicial, imprimir_cupom, id))
+
+            # 👇 AQUI ESTÁ O AJUSTE: estoque volta ao inicial (livro de estoque)
+            movimentos.ajustar(c, {id: estoque_inicial}, "ajuste")
+            notificacoes.notificar_estoque(c, [id])
+            
+            conn.commit()
+            resumos.nova_versao(conn)
+
+            flash("Produto atualizado com sucesso!", "success")
+            return redirect("/produtos")
 
-    c.execute("SELECT * FROM produtos WHERE id=%s", (id,))
-    produto = c.fetchone()
-    conn.close()
+        c.execute("SELECT * FROM produtos WHERE id=%s", (id,))
+        produto = c.fetchone()
 
     return render_template("editar_produto.html", produto=produto)
 
@@ -299,18 +316,14 @@ def zerar_estoque(id):
     if session.get("perfil") != "administrador":
         return redirect("/dashboard")
 
-    conn = conectar()
-    c = conn.cursor()
+    with conectar() as conn:
+        c = conn.cursor()
 
-    # Zera apenas o estoque atual
-    c.execute("""
-        UPDATE produtos
-        SET estoque_atual = 0
-        WHERE id = %s
-    """, (id,))
+        # Zera apenas o estoque atual (livro de estoque)
+        movimentos.ajustar(c, {id: 0}, "ajuste")
+        notificacoes.notificar_estoque(c, [id])
 
-    conn.commit()
-    conn.close()
+        conn.commit()
 
     flash("Estoque zerado com sucesso!", "warning")
     return redirect("/produtos")
@@ -328,38 +341,33 @@ def excluir_produto(id):
         flash("Acesso restrito!", "danger")
         return redirect("/produtos")
 
-    conn = conectar()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    try:
-        # Verifica se o produto existe
-        c.execute("SELECT id FROM produtos WHERE id = %s", (id,))
-        produto = c.fetchone()
+    with conectar() as conn:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-        if not produto:
-            flash("Produto não encontrado.", "danger")
-            conn.close()
-            return redirect("/produtos")
+        try:
+            # Verifica se o produto existe
+            c.execute("SELECT id FROM produtos WHERE id = %s", (id,))
+            produto = c.fetchone()
 
-        # 🔥 Excluir produto
-        c.execute("SELECT 1 FROM vendas WHERE produto_id = %s LIMIT 1", (id,))
-        if c.fetchone():
-            flash("Não é possível excluir produto que já possui vendas!", "danger")
-            conn.close()
-            return redirect("/produtos")
+            if not produto:
+                flash("Produto não encontrado.", "danger")
+                return redirect("/produtos")
 
-        c.execute("DELETE FROM produtos WHERE id = %s", (id,))
-        conn.commit()
-        
-        flash("Produto excluído com sucesso!", "success")
+            # 🔥 Excluir produto
+            c.execute("SELECT 1 FROM itens_venda WHERE produto_id = %s LIMIT 1", (id,))
+            if c.fetchone():
+                flash("Não é possível excluir produto que já possui vendas!", "danger")
+                return redirect("/produtos")
 
-    except Exception as e:
-        conn.rollback()
-        print("Erro ao excluir produto:", e)
-        flash("Erro ao excluir produto.", "danger")
+            c.execute("DELETE FROM produtos WHERE id = %s", (id,))
+            conn.commit()
+            
+            flash("Produto excluído com sucesso!", "success")
 
-    finally:
-        conn.close()
+        except Exception:
+            conn.rollback()
+            app.logger.exception("Erro ao excluir produto %s", id)
+            flash("Erro ao excluir produto.", "danger")
 
     return redirect("/produtos")
 
@@ -372,134 +380,557 @@ def vendas():
     if "usuario" not in session:
         return redirect("/")
 
-    conn = conectar()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    c.execute("""
-        SELECT *
-        FROM produtos
-        WHERE estoque_atual > 0
-        ORDER BY descricao ASC
-    """)
-    produtos = c.fetchall()
-    conn.close()
+    # catálogo e estoque da memória (ver catalogo.py e notificacoes.py).
+    # A versão do catálogo vai para a página, que a usa em /catalogo?since=
+    # para se atualizar sozinha
+    cat = catalogo.obter()
+    estoque = catalogo.estoque()
+
+    produtos = [
+        {**p, "estoque_atual": estoque[p["id"]]}
+        for p in cat.produtos
+        if estoque.get(p["id"], 0) > 0
+    ]
+
+    aquecer_pix_em_segundo_plano()
 
-    return render_template("vendas.html", produtos=produtos)
+    return render_template("vendas.html", produtos=produtos, versao_catalogo=cat.versao)
 
 # =========================
 # SALVAR VENDA
 # =========================
-@app.route("/salvar_venda", methods=["POST"])
-def salvar_venda():
+# chave (1º inteiro) do pg_advisory_xact_lock por chave de idempotência
+LOCK_IDEMPOTENCIA = 7_300_002
+
+# alerta de estoque baixo para produtos sem estoque mínimo cadastrado
+ESTOQUE_MINIMO_PADRAO = 5
+
+# itens da venda e as saídas correspondentes no livro de estoque
+SQL_ITENS_VENDA = """
+    WITH itens AS (
+        INSERT INTO itens_venda
+        (numero_venda, produto_id, quantidade, valor_total)
+        VALUES %s
+        RETURNING numero_venda, produto_id, quantidade
+    )
+    INSERT INTO estoque_movimentos (produto_id, tipo, quantidade, numero_venda)
+    SELECT produto_id, 'venda', -quantidade, numero_venda
+    FROM itens
+"""
+
+def estoque_minimo(produto):
+    if produto["estoque_minimo"] is None:
+        return ESTOQUE_MINIMO_PADRAO
+    return produto["estoque_minimo"]
+
+def normalizar_itens(itens):
+
+    # formato atual: {"produto_id": 3, "quantidade": 2}
+    # formato antigo (uma entrada por unidade): {"id": 3, "valor": 5.0}
+    # o valor enviado pelo cliente é ignorado: o preço vem do banco
+    contagem = {}
+
+    for item in itens:
+        if "produto_id" in item:
+            produto_id = int(item["produto_id"])
+            quantidade = int(item.get("quantidade", 1))
+        else:
+            produto_id = int(item["id"])
+            quantidade = 1
 
-    usuario_id = session.get("usuario_id")
+        if quantidade < 1:
+            raise ValueError("quantidade inválida")
 
-    if not usuario_id:
-        return jsonify({"erro": "Sessão expirada"}), 403
+        contagem[produto_id] = contagem.get(produto_id, 0) + quantidade
 
-    dados = request.get_json()
+    return contagem
+
+def validar_venda(dados, chave=None):
+
+    # devolve (venda, None) ou (None, mensagem de erro)
+    if not isinstance(dados, dict):
+        return None, "Venda inválida"
 
     itens = dados.get("itens", [])
     forma_pagamento = dados.get("forma_pagamento")
     valor_recebido = dados.get("valor_recebido")
-    troco = dados.get("troco")
 
     if not itens:
-        return jsonify({"erro": "Nenhum item na venda"}), 400
+        return None, "Nenhum item na venda"
 
     if not forma_pagamento:
-        return jsonify({"erro": "Forma de pagamento obrigatória"}), 400
-
-    conn = conectar()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        return None, "Forma de pagamento obrigatória"
 
     try:
+        contagem = normalizar_itens(itens)
+    except (KeyError, TypeError, ValueError):
+        return None, "Item inválido na venda"
 
-        # GERA NUMERO DA VENDA (SEQUENCE = seguro para múltiplos caixas)
-        c.execute("SELECT nextval('seq_numero_venda') AS numero")
-        numero_venda = c.fetchone()["numero"]
+    if valor_recebido is not None:
+        try:
+            valor_recebido = Decimal(str(valor_recebido))
+        except InvalidOperation:
+            return None, "Valor recebido inválido"
 
-        contagem = {}
-        for item in itens:
-            contagem[item["id"]] = contagem.get(item["id"], 0) + 1
+    # chave gerada pelo tablet para cada venda: reenvios (toque duplo, fila
+    # offline do service worker) recebem a venda original em vez de outra
+    chave = chave or dados.get("chave_idempotencia")
 
-        alertas = []
-        venda_registro = []
+    if chave is not None:
+        chave = str(chave)
 
-        # CONTROLE DE ESTOQUE
-        for produto_id, quantidade in contagem.items():
+        if not (0 < len(chave) <= 100):
+            return None, "Chave de idempotência inválida"
 
-            c.execute("""
-                UPDATE produtos
-                SET estoque_atual = estoque_atual - %s
-                WHERE id = %s
-                AND estoque_atual >= %s
-            """, (quantidade, produto_id, quantidade))
+    return {
+        "contagem": contagem,
+        "forma_pagamento": forma_pagamento,
+        "valor_recebido": valor_recebido,
+        "troco": dados.get("troco"),
+        "chave": chave,
+        "criada_em": dados.get("criada_em")
+    }, None
+
+def resposta_venda(numero_venda, data_venda, forma_pagamento, valor_total,
+                   valor_recebido, troco, alertas, registro):
+    return {
+        "sucesso": True,
+        "numero_venda": numero_venda,
+        "data_venda": data_venda.strftime("%d/%m/%Y %H:%M:%S"),
+        "forma_pagamento": forma_pagamento,
+        "valor_total": float(valor_total),
+        "valor_recebido": None if valor_recebido is None else float(valor_recebido),
+        "troco": None if troco is None else float(troco),
+        "alertas": alertas,
+        "registro": registro
+    }
+
+@app.route("/salvar_venda", methods=["POST"])
+def salvar_venda():
+
+    usuario_id = session.get("usuario_id")
 
-            if c.rowcount == 0:
+    if not usuario_id:
+        return jsonify({"erro": "Sessão expirada"}), 403
+
+    venda, erro = validar_venda(request.get_json(), request.headers.get("Idempotency-Key"))
+
+    if erro:
+        return jsonify({"erro": erro}), 400
+
+    contagem = venda["contagem"]
+    forma_pagamento = venda["forma_pagamento"]
+    valor_recebido = venda["valor_recebido"]
+    troco = venda["troco"]
+    chave = venda["chave"]
+
+    # antes de pegar a conexão da venda: recarregar o catálogo usa outra
+    cat = catalogo.obter()
+    movimentos.iniciar()
+
+    with conectar() as conn:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+        try:
+
+            # IDEMPOTÊNCIA
+            # o lock faz o segundo envio da mesma chave esperar o primeiro terminar
+            if chave is not None:
+                c.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s))", (LOCK_IDEMPOTENCIA, chave))
+                c.execute("SELECT resposta FROM vendas_idempotencia WHERE chave = %s", (chave,))
+                anterior = c.fetchone()
+
+                if anterior:
+                    conn.rollback()
+                    return jsonify({**anterior["resposta"], "repetida": True})
+
+            # CONTROLE DE ESTOQUE
+            # baixa nas fatias do livro de estoque: caixas vendendo o mesmo
+            # produto não esperam um pelo outro (ver movimentos.py)
+            saldos = movimentos.movimentar(c, {id: -q for id, q in contagem.items()})
+
+            if saldos is None:
                 conn.rollback()
                 return jsonify({"erro": "Estoque insuficiente"}), 400
 
-            c.execute("""
-                SELECT descricao, estoque_atual,
-                       COALESCE(estoque_minimo,5) as estoque_minimo
-                FROM produtos
-                WHERE id = %s
-            """, (produto_id,))
+            # preço, descrição e estoque mínimo do catálogo em memória
+            produtos = catalogo.produtos_da_venda(c, cat, contagem)
 
-            produto = c.fetchone()
+            alertas = []
+            venda_registro = []
+            linhas = []
 
-            venda_registro.append({
-                "descricao": produto["descricao"],
-                "quantidade": quantidade
-            })
+            for produto_id, quantidade in contagem.items():
+                produto = produtos[produto_id]
 
-            if produto["estoque_atual"] <= produto["estoque_minimo"]:
-                alertas.append(
-                    f'{produto["descricao"]} com estoque baixo ({produto["estoque_atual"]})'
-                )
+                linhas.append((produto_id, quantidade, produto["valor"] * quantidade))
+
+                venda_registro.append({
+                    "descricao": produto["descricao"],
+                    "quantidade": quantidade
+                })
+
+                if saldos[produto_id] <= estoque_minimo(produto):
+                    alertas.append(
+                        f'{produto["descricao"]} com estoque baixo ({saldos[produto_id]})'
+                    )
 
-        # INSERIR ITENS DA VENDA
-        for i, item in enumerate(itens):
+            # CABEÇALHO DA VENDA
+            # (SEQUENCE = seguro para múltiplos caixas)
+            data_venda = agora_amazonas()
+            valor_total = sum(linha[2] for linha in linhas)
+
+            # troco recalculado com o preço do servidor
+            if valor_recebido is not None:
+                if valor_recebido < valor_total:
+                    conn.rollback()
+                    return jsonify({"erro": "Valor recebido menor que o total da venda"}), 400
+
+                troco = valor_recebido - valor_total
 
             c.execute("""
                 INSERT INTO vendas
-                (numero_venda, produto_id, quantidade, valor_total,
-                 data_venda, forma_pagamento, valor_recebido, troco, usuario_id)
-                VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)
+                (numero_venda, data_venda, forma_pagamento, valor_total,
+                 valor_recebido, troco, usuario_id)
+                VALUES (nextval('seq_numero_venda'), %s, %s, %s, %s, %s, %s)
+                RETURNING numero_venda
             """, (
-                numero_venda,
-                item["id"],
-                1,
-                item["valor"],
-                agora_amazonas(),
+                data_venda,
                 forma_pagamento,
-                valor_recebido if i == 0 else None,
-                troco if i == 0 else None,
+                valor_total,
+                valor_recebido,
+                troco,
                 usuario_id
             ))
+            numero_venda = c.fetchone()["numero_venda"]
 
-        conn.commit()
+            # INSERIR ITENS DA VENDA
+            # uma linha por produto com a quantidade real, num único INSERT
+            # (que também lança as saídas no livro de estoque)
+            psycopg2.extras.execute_values(c, SQL_ITENS_VENDA, [
+                (numero_venda, produto_id, quantidade, total_item)
+                for produto_id, quantidade, total_item in linhas
+            ], page_size=len(linhas))
+
+            resumos.aplicar_venda(c, forma_pagamento, usuario_id, valor_total, linhas)
+
+            notificacoes.notificar_estoque(c, saldos)
+
+            resposta = resposta_venda(
+                numero_venda, data_venda, forma_pagamento, valor_total,
+                valor_recebido, troco, alertas, venda_registro
+            )
+
+            if chave is not None:
+                c.execute("""
+                    INSERT INTO vendas_idempotencia (chave, numero_venda, resposta)
+                    VALUES (%s, %s, %s)
+                """, (chave, numero_venda, psycopg2.extras.Json(resposta)))
+
+            conn.commit()
+            resumos.nova_versao(conn)
 
-        return jsonify({
-            "sucesso": True,
-            "numero_venda": numero_venda,
-            "data_venda": agora_amazonas().strftime("%d/%m/%Y %H:%M:%S"),
-            "forma_pagamento": forma_pagamento,
-            "valor_recebido": valor_recebido,
-            "troco": troco,
-            "alertas": alertas,
-            "registro": venda_registro
-        })
-
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"erro": str(e)}), 500
-
-    finally:
-        conn.close()
+            return jsonify(resposta)
+
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"erro": str(e)}), 500
+
+# =========================
+# SALVAR VENDAS EM LOTE
+# =========================
+# Fila offline que volta de uma vez, vendas anotadas no papel durante uma
+# queda: uma requisição e uma transação para o lote inteiro. As fatias de
+# estoque dos produtos do lote são travadas (em ordem, ver movimentos.py), o
+# estoque é reservado venda a venda na ordem recebida e baixado de uma vez;
+# os números saem juntos de seq_numero_venda e cabeçalhos/itens vão em um
+# INSERT cada.
+#
+# modo "parcial" (padrão): vendas com erro ficam de fora, as outras são gravadas
+# modo "tudo_ou_nada": qualquer erro desfaz o lote inteiro
+LOTE_VENDAS_MAX = int(os.getenv("LOTE_VENDAS_MAX", "500"))
+MODOS_LOTE = ("parcial", "tudo_ou_nada")
+
+# venda da fila offline guarda a hora em que foi feita no tablet
+# ("criada_em", ms desde 1970); mais antiga que isso (s) ou no futuro
+# (relógio do tablet errado), vale a hora do servidor
+VENDA_ATRASO_MAXIMO = float(os.getenv("VENDA_ATRASO_MAXIMO", "172800"))
+
+def data_da_venda(criada_em, agora):
+    if isinstance(criada_em, bool) or not isinstance(criada_em, (int, float)):
+        return agora
+
+    try:
+        data = datetime.fromtimestamp(criada_em / 1000, agora.tzinfo)
+    except (OverflowError, OSError, ValueError):
+        return agora
+
+    if agora - timedelta(seconds=VENDA_ATRASO_MAXIMO) <= data <= agora:
+        return data
+
+    return agora
+
+def resposta_lote(modo, resultados, gravadas):
+    return jsonify({
+        "sucesso": all(r.get("sucesso") for r in resultados),
+        "modo": modo,
+        "gravadas": gravadas,
+        "resultados": resultados
+    })
+
+@app.route("/salvar_vendas_lote", methods=["POST"])
+def salvar_vendas_lote():
+
+    usuario_id = session.get("usuario_id")
+
+    if not usuario_id:
+        return jsonify({"erro": "Sessão expirada"}), 403
+
+    dados = request.get_json(silent=True) or {}
+    vendas = dados.get("vendas")
+    modo = dados.get("modo", "parcial")
+
+    if modo not in MODOS_LOTE:
+        return jsonify({"erro": "Modo inválido (use parcial ou tudo_ou_nada)"}), 400
+
+    if not isinstance(vendas, list) or not vendas:
+        return jsonify({"erro": "Nenhuma venda no lote"}), 400
+
+    if len(vendas) > LOTE_VENDAS_MAX:
+        return jsonify({"erro": f"Lote maior que {LOTE_VENDAS_MAX} vendas"}), 400
+
+    # um resultado por venda, na ordem recebida
+    resultados = [None] * len(vendas)
+    validas = []
+
+    for indice, dados_venda in enumerate(vendas):
+        venda, erro = validar_venda(dados_venda)
+
+        if erro:
+            resultados[indice] = {"sucesso": False, "erro": erro}
+        else:
+            validas.append((indice, venda))
+
+    if modo == "tudo_ou_nada" and len(validas) != len(vendas):
+        return resposta_lote(modo, [r or {"sucesso": False, "erro": "Lote desfeito"} for r in resultados], 0), 400
+
+    cat = catalogo.obter()
+    movimentos.iniciar()
+
+    with conectar() as conn:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+        try:
+
+            # IDEMPOTÊNCIA
+            # mesmos locks de salvar_venda, pegos em ordem fixa para dois
+            # lotes com chaves em comum não travarem um ao outro
+            chaves = sorted({v["chave"] for _, v in validas if v["chave"] is not None})
+
+            c.execute("""
+                SELECT pg_advisory_xact_lock(%s, h)
+                FROM (
+                    SELECT DISTINCT hashtext(chave) AS h
+                    FROM unnest(%s::text[]) AS chave
+                    ORDER BY 1
+                ) AS l
+            """, (LOCK_IDEMPOTENCIA, chaves))
+
+            c.execute("""
+                SELECT chave, resposta
+                FROM vendas_idempotencia
+                WHERE chave = ANY(%s)
+            """, (chaves,))
+            anteriores = {r["chave"]: r["resposta"] for r in c.fetchall()}
+
+            # chave repetida dentro do próprio lote: vale a primeira venda
+            primeira_da_chave = {}
+            repetidas = []
+            novas = []
+
+            for indice, venda in validas:
+                chave = venda["chave"]
+
+                if chave in anteriores:
+                    resultados[indice] = {**anteriores[chave], "repetida": True}
+                elif chave is not None and chave in primeira_da_chave:
+                    repetidas.append((indice, primeira_da_chave[chave]))
+                else:
+                    if chave is not None:
+                        primeira_da_chave[chave] = indice
+                    novas.append((indice, venda))
+
+            # CONTROLE DE ESTOQUE
+            # reserva em memória sobre as fatias travadas, na ordem das vendas
+            inicial = movimentos.travar(c, {p for _, v in novas for p in v["contagem"]})
+            saldo = dict(inicial)
+
+            # preço, descrição e estoque mínimo do catálogo em memória
+            produtos = catalogo.produtos_da_venda(c, cat, inicial)
+
+            agora = agora_amazonas()
+            aceitas = []
+
+            for indice, venda in novas:
+                contagem = venda["contagem"]
+
+                if any(saldo.get(id, 0) < quantidade for id, quantidade in contagem.items()):
+                    resultados[indice] = {"sucesso": False, "erro": "Estoque insuficiente"}
+                    continue
+
+                linhas = [
+                    (id, quantidade, produtos[id]["valor"] * quantidade)
+                    for id, quantidade in contagem.items()
+                ]
+                valor_total = sum(linha[2] for linha in linhas)
+
+                # troco recalculado com o preço do servidor
+                valor_recebido = venda["valor_recebido"]
+                troco = venda["troco"]
+
+                if valor_recebido is not None:
+                    if valor_recebido < valor_total:
+                        resultados[indice] = {
+                            "sucesso": False,
+                            "erro": "Valor recebido menor que o total da venda"
+                        }
+                        continue
+
+                    troco = valor_recebido - valor_total
+
+                alertas = []
+
+                for id, quantidade in contagem.items():
+                    saldo[id] -= quantidade
+
+                    if saldo[id] <= estoque_minimo(produtos[id]):
+                        alertas.append(f'{produtos[id]["descricao"]} com estoque baixo ({saldo[id]})')
+
+                aceitas.append({
+                    "indice": indice,
+                    "venda": venda,
+                    "data_venda": data_da_venda(venda["criada_em"], agora),
+                    "linhas": linhas,
+                    "valor_total": valor_total,
+                    "valor_recebido": valor_recebido,
+                    "troco": troco,
+                    "alertas": alertas
+                })
+
+            recusadas = len(novas) - len(aceitas)
+
+            if not aceitas or (modo == "tudo_ou_nada" and recusadas):
+                conn.rollback()
+
+                if modo == "tudo_ou_nada":
+                    resultados = [r or {"sucesso": False, "erro": "Lote desfeito"} for r in resultados]
+                    return resposta_lote(modo, resultados, 0), 400
+
+                for indice, original in repetidas:
+                    resultados[indice] = {**resultados[original], "repetida": True}
+
+                return resposta_lote(modo, [r or {"sucesso": False} for r in resultados], 0)
+
+            # baixa do lote inteiro nas fatias (já travadas)
+            baixas = {id: saldo[id] - inicial[id] for id in saldo if saldo[id] != inicial[id]}
+            movimentos.movimentar(c, baixas)
+
+            # NÚMEROS DAS VENDAS
+            # todos de uma vez, em ordem crescente na ordem do lote
+            c.execute("""
+                SELECT nextval('seq_numero_venda') AS numero_venda
+                FROM generate_series(1, %s)
+            """, (len(aceitas),))
+            numeros = sorted(r["numero_venda"] for r in c.fetchall())
+
+            for aceita, numero_venda in zip(aceitas, numeros):
+                aceita["numero_venda"] = numero_venda
+
+            psycopg2.extras.execute_values(c, """
+                INSERT INTO vendas
+                (numero_venda, data_venda, forma_pagamento, valor_total,
+                 valor_recebido, troco, usuario_id)
+                VALUES %s
+            """, [
+                (a["numero_venda"], a["data_venda"], a["venda"]["forma_pagamento"],
+                 a["valor_total"], a["valor_recebido"], a["troco"], usuario_id)
+                for a in aceitas
+            ], page_size=len(aceitas))
+
+            itens = [
+                (a["numero_venda"], id, quantidade, total_item)
+                for a in aceitas
+                for id, quantidade, total_item in a["linhas"]
+            ]
+
+            psycopg2.extras.execute_values(c, SQL_ITENS_VENDA, itens, page_size=len(itens))
+
+            resumos.aplicar_vendas(c, [
+                (a["venda"]["forma_pagamento"], usuario_id, a["valor_total"], a["linhas"])
+                for a in aceitas
+            ])
+
+            notificacoes.notificar_estoque(c, baixas)
+
+            # venda atrasada que caiu num dia já fechado
+            fechamentos.vendas_alteradas(c, [a["data_venda"] for a in aceitas])
+
+            idempotencia = []
+
+            for a in aceitas:
+                resposta = resposta_venda(
+                    a["numero_venda"], a["data_venda"], a["venda"]["forma_pagamento"],
+                    a["valor_total"], a["valor_recebido"], a["troco"], a["alertas"],
+                    [
+                        {"descricao": produtos[id]["descricao"], "quantidade": quantidade}
+                        for id, quantidade, _ in a["linhas"]
+                    ]
+                )
+                resultados[a["indice"]] = resposta
+
+                if a["venda"]["chave"] is not None:
+                    idempotencia.append(
+                        (a["venda"]["chave"], a["numero_venda"], psycopg2.extras.Json(resposta))
+                    )
+
+            if idempotencia:
+                psycopg2.extras.execute_values(c, """
+                    INSERT INTO vendas_idempotencia (chave, numero_venda, resposta)
+                    VALUES %s
+                """, idempotencia, page_size=len(idempotencia))
+
+            conn.commit()
+            resumos.nova_versao(conn)
+
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"erro": str(e)}), 500
+
+    for indice, original in repetidas:
+        resultados[indice] = {**resultados[original], "repetida": True}
+
+    return resposta_lote(modo, resultados, len(aceitas))
 # =========================
 # CANCELAR VENDA
 # =========================
+def devolver_estoque(c, numero_venda, itens):
+
+    # itens voltam às fatias e entram no livro como cancelamento;
+    # devolve os ids para o aviso de estoque
+    quantidades = {}
+    for item in itens:
+        if item["produto_id"] is not None:
+            quantidades[item["produto_id"]] = quantidades.get(item["produto_id"], 0) + item["quantidade"]
+
+    saldos = movimentos.movimentar(c, quantidades)
+
+    movimentos.registrar(c, "cancelamento", [
+        (produto_id, quantidade, numero_venda)
+        for produto_id, quantidade in quantidades.items()
+    ])
+
+    return list(saldos)
+
 @app.route("/cancelar_venda", methods=["POST"])
 def cancelar_venda():
 
@@ -512,48 +943,53 @@ def cancelar_venda():
     if not numero_venda:
         return jsonify({"erro": "Número da venda não informado"}), 400
 
-    conn = conectar()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    with conectar() as conn:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-    try:
+        try:
         
-        # 🔎 Buscar itens da venda
-        c.execute("""
-            SELECT produto_id, quantidade
-            FROM vendas
-            WHERE numero_venda = %s
-        """, (numero_venda,))
+            # 🔎 Buscar itens da venda
+            c.execute("""
+                SELECT produto_id, quantidade, valor_total
+                FROM itens_venda
+                WHERE numero_venda = %s
+            """, (numero_venda,))
 
-        itens = c.fetchall()
+            itens = c.fetchall()
 
-        if not itens:
-            conn.rollback()
-            return jsonify({"erro": "Venda não encontrada"}), 404
+            if not itens:
+                conn.rollback()
+                return jsonify({"erro": "Venda não encontrada"}), 404
 
-        # 🔥 Restaurar estoque
-        for item in itens:
-            c.execute("""
-                UPDATE produtos
-                SET estoque_atual = estoque_atual + %s
-                WHERE id = %s
-            """, (item["quantidade"], item["produto_id"]))
+            # 🔥 Restaurar estoque (livro de estoque)
+            estoque = devolver_estoque(c, numero_venda, itens)
 
-        # ❌ Excluir venda
-        c.execute("""
-            DELETE FROM vendas
-            WHERE numero_venda = %s
-        """, (numero_venda,))
+            # ❌ Excluir venda (itens saem junto, ON DELETE CASCADE)
+            c.execute("""
+                DELETE FROM vendas
+                WHERE numero_venda = %s
+                RETURNING forma_pagamento, usuario_id, valor_total, data_venda
+            """, (numero_venda,))
+            venda = c.fetchone()
+
+            fechamentos.vendas_alteradas(c, [venda["data_venda"]])
+
+            resumos.aplicar_venda(
+                c, venda["forma_pagamento"], venda["usuario_id"], venda["valor_total"],
+                [(i["produto_id"], i["quantidade"], i["valor_total"]) for i in itens],
+                sinal=-1
+            )
 
-        conn.commit()
+            notificacoes.notificar_estoque(c, estoque)
 
-        return jsonify({"sucesso": True})
+            conn.commit()
+            resumos.nova_versao(conn)
 
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"erro": str(e)}), 500
+            return jsonify({"sucesso": True})
 
-    finally:
-        conn.close()
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"erro": str(e)}), 500
 
 # =========================
 # EXCLUIR VENDA (RELATÓRIO)
@@ -568,99 +1004,247 @@ def excluir_venda(numero_venda):
         flash("Acesso restrito!", "danger")
         return redirect("/relatorios")
 
-    conn = conectar()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    with conectar() as conn:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-    try:
+        try:
 
-        # Buscar itens da venda
-        c.execute("""
-            SELECT produto_id, quantidade
-            FROM vendas
-            WHERE numero_venda = %s
-        """, (numero_venda,))
-        itens = c.fetchall()
+            # Buscar itens da venda
+            c.execute("""
+                SELECT produto_id, quantidade, valor_total
+                FROM itens_venda
+                WHERE numero_venda = %s
+            """, (numero_venda,))
+            itens = c.fetchall()
 
-        if not itens:
-            flash("Venda não encontrada.", "danger")
-            conn.close()
-            return redirect("/relatorios")
+            if not itens:
+                flash("Venda não encontrada.", "danger")
+                return redirect("/relatorios")
 
-        # Restaurar estoque
-        for item in itens:
-            c.execute("""
-                UPDATE produtos
-                SET estoque_atual = estoque_atual + %s
-                WHERE id = %s
-            """, (item["quantidade"], item["produto_id"]))
+            # Restaurar estoque (livro de estoque)
+            estoque = devolver_estoque(c, numero_venda, itens)
 
-        # Excluir venda
-        c.execute("""
-            DELETE FROM vendas
-            WHERE numero_venda = %s
-        """, (numero_venda,))
+            # Excluir venda (itens saem junto, ON DELETE CASCADE)
+            c.execute("""
+                DELETE FROM vendas
+                WHERE numero_venda = %s
+                RETURNING forma_pagamento, usuario_id, valor_total, data_venda
+            """, (numero_venda,))
+            venda = c.fetchone()
+
+            fechamentos.vendas_alteradas(c, [venda["data_venda"]])
+
+            resumos.aplicar_venda(
+                c, venda["forma_pagamento"], venda["usuario_id"], venda["valor_total"],
+                [(i["produto_id"], i["quantidade"], i["valor_total"]) for i in itens],
+                sinal=-1
+            )
 
-        conn.commit()
+            notificacoes.notificar_estoque(c, estoque)
 
-        flash(f"Venda {numero_venda} excluída com sucesso!", "success")
+            conn.commit()
+            resumos.nova_versao(conn)
 
-    except Exception as e:
-        conn.rollback()
-        flash("Erro ao excluir venda.", "danger")
-        print(e)
+            flash(f"Venda {numero_venda} excluída com sucesso!", "success")
 
-    finally:
-        conn.close()
+        except Exception:
+            conn.rollback()
+            app.logger.exception("Erro ao excluir venda %s", numero_venda)
+            flash("Erro ao excluir venda.", "danger")
 
     return redirect("/relatorios")
 
 # =========================
 # FUNÇÃO GERA PIX
 # =========================
-def gerar_pix(valor):
+PIX_CACHE_MAX = int(os.getenv("PIX_CACHE_MAX", "512"))
+
+# múltiplos de cada preço pré-calculados no aquecimento (1x, 2x, ... Nx)
+PIX_AQUECER_MULTIPLOS = int(os.getenv("PIX_AQUECER_MULTIPLOS", "10"))
+
+# maior cobrança por PIX (centavos); acima disso o pedido é recusado
+PIX_VALOR_MAXIMO = int(os.getenv("PIX_VALOR_MAXIMO", "1000000"))
+
+def centavos(valor):
+    return int((Decimal(str(valor)) * 100).to_integral_value(ROUND_HALF_UP))
+
+def centavos_pix(valor):
+
+    # None se o valor não é número ou está fora de (0, PIX_VALOR_MAXIMO]
+    if isinstance(valor, bool):
+        return None
+
+    try:
+        valor_centavos = centavos(valor)
+    except (ArithmeticError, TypeError, ValueError):
+        return None
+
+    if not 0 < valor_centavos <= PIX_VALOR_MAXIMO:
+        return None
+
+    return valor_centavos
 
+@lru_cache(maxsize=PIX_CACHE_MAX)
+def pix_em_centavos(valor_centavos):
+
+    # O identificador (txid) sai do próprio valor: o mesmo valor gera sempre o
+    # mesmo código, em qualquer worker, e QR/copia-e-cola podem ficar em cache
     pix = generate_simple_pix(
         fullname="PAROQUIA SAO JOAO BATISTA",
         key="comsaofrancisco@paroquiasjb.org.br",
         city="PRES. MEDICI",
-        value=float(valor),
+        value=valor_centavos / 100,
+        pix_id=f"QUERMESSE{valor_centavos}",
         mult_transaction=False
     )
 
     qrcode_base64 = pix.toBase64()
+    png = base64.b64decode(qrcode_base64.split(",", 1)[1])
+
+    return qrcode_base64, str(pix), png
 
-    payload = str(pix)
+def gerar_pix(valor_centavos):
+
+    qrcode_base64, payload, _ = pix_em_centavos(valor_centavos)
 
     return {
         "qrcode": qrcode_base64,
+        "qrcode_url": f"/pix/{valor_centavos}.png",
         "copia_cola": payload
     }
-# =========================
-# ROTA GERA PIX
-# =========================
+
+def aquecer_pix():
+
+    # QR dos preços atuais e dos seus múltiplos, sem passar do tamanho do cache
+    precos = sorted({centavos(p["valor"]) for p in catalogo.obter().produtos})
+
+    valores = sorted({
+        preco * multiplo
+        for preco in precos
+        for multiplo in range(1, PIX_AQUECER_MULTIPLOS + 1)
+        if 0 < preco * multiplo <= PIX_VALOR_MAXIMO
+    })
+
+    for valor_centavos in valores[:PIX_CACHE_MAX // 2]:
+        pix_em_centavos(valor_centavos)
+
+_pix_aquecido_pid = None
+
+def aquecer_pix_em_segundo_plano():
+    global _pix_aquecido_pid
+
+    # uma vez por worker
+    if _pix_aquecido_pid == os.getpid():
+        return
+    _pix_aquecido_pid = os.getpid()
+
+    def rodar():
+        try:
+            aquecer_pix()
+        except Exception:
+            app.logger.exception("ERRO AO AQUECER PIX")
+
+    threading.Thread(target=rodar, name="aquecer-pix", daemon=True).start()
+
 @app.route("/gerar_pix", methods=["POST"])
 def rota_gerar_pix():
 
-    data = request.get_json()
-    valor = data.get("valor")
+    if "usuario" not in session:
+        return jsonify({"erro": "Não autorizado"}), 403
+
+    data = request.get_json(silent=True)
+    valor_centavos = centavos_pix(data.get("valor")) if isinstance(data, dict) else None
 
-    pix = gerar_pix(valor)
+    if valor_centavos is None:
+        return jsonify({"erro": "Valor inválido"}), 400
+
+    pix = gerar_pix(valor_centavos)
 
     return jsonify(pix)
 
+@app.route("/pix/<int:valor_centavos>.png")
+def pix_png(valor_centavos):
+
+    if "usuario" not in session:
+        return jsonify({"erro": "Não autorizado"}), 403
+
+    if not 0 < valor_centavos <= PIX_VALOR_MAXIMO:
+        return jsonify({"erro": "Valor inválido"}), 400
+
+    _, _, png = pix_em_centavos(valor_centavos)
+
+    # o QR de um valor nunca muda (txid fixo por valor)
+    resposta = send_file(BytesIO(png), mimetype="image/png")
+    resposta.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resposta
+
 # =========================
 # ESTOQUE ATUAL
 # =========================
+def resposta_versionada(etag, montar):
+
+    # 304 sem montar o corpo quando o cliente já tem essa versão
+    if request.if_none_match.contains(etag):
+        resposta = Response(status=304)
+    else:
+        resposta = jsonify(montar())
+
+    resposta.set_etag(etag)
+    resposta.headers["Cache-Control"] = "private, no-cache"
+    return resposta
+
+def etag_estoque(estoque):
+    return hashlib.sha1(repr(sorted(estoque.items())).encode()).hexdigest()
+
 @app.route('/estoque_atual')
 def estoque_atual():
-    conn = conectar()
-    cur = conn.cursor()
-    cur.execute("SELECT id, estoque_atual FROM produtos")
-    dados = cur.fetchall()
-    cur.close()
-    conn.close()
+    cat = catalogo.obter()
+    estoque = catalogo.estoque()
+
+    return resposta_versionada(
+        etag_estoque(estoque),
+        lambda: [(p["id"], estoque.get(p["id"], 0)) for p in cat.produtos]
+    )
+
+@app.route("/catalogo")
+def rota_catalogo():
+
+    if "usuario" not in session:
+        return jsonify({"erro": "Não autorizado"}), 403
+
+    cat = catalogo.obter()
+    estoque = catalogo.estoque()
+    since = request.args.get("since", type=int)
+
+    # o estoque entra na etag: muda a cada venda, o catálogo não
+    if since is None:
+        produtos, removidos = cat.produtos, []
+        etag = f"{cat.etag}-{etag_estoque(estoque)}"
+    else:
+        produtos, removidos = cat.desde(since)
+        etag = f"{cat.etag}-{since}-{etag_estoque({p['id']: estoque.get(p['id'], 0) for p in produtos})}"
 
-    return jsonify(dados)
+    return resposta_versionada(etag, lambda: {
+        "versao": cat.versao,
+        "completo": since is None,
+        "produtos": [catalogo.como_json(p, estoque.get(p["id"], 0)) for p in produtos],
+        "removidos": removidos
+    })
+
+@app.route("/estoque/stream")
+def estoque_stream():
+
+    if "usuario" not in session:
+        return jsonify({"erro": "Não autorizado"}), 403
+
+    return Response(
+        notificacoes.fluxo_estoque(),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
 
 # =========================
 # DASHBOARD AVANÇADO
@@ -670,47 +1254,11 @@ def dashboard_avancado():
     if "usuario" not in session:
         return redirect("/")
 
-    conn = conectar()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    # Total geral
-    c.execute("SELECT COALESCE(SUM(valor_total),0) as total FROM vendas")
-    total_geral = c.fetchone()["total"]
-
-    # Total por forma
-    c.execute("""
-        SELECT forma_pagamento,
-               SUM(valor_total) as total
-        FROM vendas
-        GROUP BY forma_pagamento
-    """)
-    por_forma = c.fetchall()
-
-    # Produtos mais vendidos
-    c.execute("""
-        SELECT p.descricao,
-               SUM(v.quantidade) as quantidade,
-               SUM(v.valor_total) as total
-        FROM vendas v
-        JOIN produtos p ON v.produto_id = p.id
-        GROUP BY p.descricao
-        ORDER BY quantidade DESC
-    """)
-    mais_vendidos = c.fetchall()
-
-    # Vendas por operador
-    c.execute("""
-        SELECT u.nome_usuario,
-               COUNT(DISTINCT v.numero_venda) AS vendas,
-               SUM(v.valor_total) AS total
-        FROM vendas v
-        JOIN usuarios u ON u.id = v.usuario_id
-        GROUP BY u.nome_usuario
-        ORDER BY total DESC
-    """)
-    por_operador = c.fetchall()
-
-    conn.close()
+    with conectar() as conn:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+        # totais mantidos pelas próprias vendas (ver resumos.py)
+        total_geral, por_forma, mais_vendidos, por_operador = resumos.ler(c)
 
     return render_template(
         "dashboard_avancado.html",
@@ -720,329 +1268,176 @@ def dashboard_avancado():
         por_operador=por_operador
     )
 
+def enviar_pdf(pdf, nome):
+    return send_file(
+        BytesIO(pdf),
+        as_attachment=True,
+        download_name=nome,
+        mimetype="application/pdf"
+    )
+
 # =========================
 # RELATÓRIO RESUMO GERAL
 # =========================
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-from reportlab.lib import colors
-from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.units import inch
-
 @app.route("/dashboard_avancado_pdf")
 def dashboard_avancado_pdf():
 
     if session.get("perfil") != "administrador":
         return redirect("/dashboard")
 
-    conn = conectar()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    # 🔎 CONSULTAS
-    c.execute("SELECT COALESCE(SUM(valor_total),0) as total FROM vendas")
-    total_geral = c.fetchone()["total"]
-
-    c.execute("""
-        SELECT forma_pagamento,
-               SUM(valor_total) as total
-        FROM vendas
-        GROUP BY forma_pagamento
-    """)
-    por_forma = c.fetchall()
-
-    c.execute("""
-        SELECT p.descricao,
-               SUM(v.quantidade) as quantidade,
-               SUM(v.valor_total) as total
-        FROM vendas v
-        JOIN produtos p ON v.produto_id = p.id
-        GROUP BY p.descricao
-        ORDER BY quantidade DESC
-    """)
-    mais_vendidos = c.fetchall()
-
-    c.execute("""
-        SELECT u.nome_usuario,
-               COUNT(DISTINCT v.numero_venda) AS vendas,
-               SUM(v.valor_total) AS total
-        FROM vendas v
-        JOIN usuarios u ON u.id = v.usuario_id
-        GROUP BY u.nome_usuario
-        ORDER BY total DESC
-    """)
-    por_operador = c.fetchall()
-
-    conn.close()
-
-    # 📄 CRIAÇÃO DO PDF
-    file_path = "Resumo_Quermesse.pdf"
-    doc = SimpleDocTemplate(file_path, pagesize=A4)
-    elements = []
-
-    styles = getSampleStyleSheet()
-
-    # 🎨 Estilos personalizados
-    titulo_style = ParagraphStyle(
-        'TituloCentralizado',
-        parent=styles['Title'],
-        alignment=1  # centralizado
-    )
+    # versão lida antes dos dados (ver resumos.versao); o PDF é montado
+    # depois de devolver a conexão ao pool
+    with conectar() as conn:
+        versao = resumos.versao(conn)
 
-    destaque_style = ParagraphStyle(
-        'Destaque',
-        parent=styles['Heading2'],
-        textColor=colors.HexColor("#0d6efd")
-    )
-    
-    # 🏷️ Título
-    elements.append(Paragraph("QUERMESSE ONLINE", titulo_style))
-    elements.append(Spacer(1, 10))
-    elements.append(Paragraph("Resumo Geral de Vendas", styles["Heading2"]))
-    elements.append(Spacer(1, 10))
-
-    # 📅 Data
-    data_atual = agora_amazonas().strftime("%d/%m/%Y %H:%M:%S")
-    elements.append(Paragraph(f"Gerado em: {data_atual}", styles["Normal"]))
-    elements.append(Spacer(1, 20))
-
-    # 💰 Total Geral
-    elements.append(Paragraph(
-        f"Total Geral Arrecadado: R$ {round(total_geral,2)}",
-        destaque_style
-    ))
-    elements.append(Spacer(1, 25))
-
-    # =========================
-    # 🟦 FUNÇÃO PARA TABELA BONITA
-    # =========================
-    def tabela_estilizada(dados):
-        tabela = Table(dados, hAlign="LEFT")
-
-        tabela.setStyle(TableStyle([
-            ('BACKGROUND', (0,0), (-1,0), colors.HexColor("#a9abaa")),
-            ('TEXTCOLOR',(0,0),(-1,0),colors.white),
-            ('ALIGN',(1,1),(-1,-1),'CENTER'),
-            ('GRID', (0,0), (-1,-1), 0.5, colors.grey),
-            ('FONTNAME', (0,0), (-1,-1), 'Helvetica'),
-            ('BOTTOMPADDING', (0,0), (-1,0), 8),
-        ]))
-
-        return tabela
-
-    # 🟩 Forma de pagamento
-    elements.append(Paragraph("Vendas por Forma de Pagamento", styles["Heading3"]))
-    elements.append(Spacer(1,10))
-
-    data_forma = [["Forma de Pagamento", "Total (R$)"]]
-    for item in por_forma:
-        data_forma.append([
-            item["forma_pagamento"],
-            round(item["total"],2)
-        ])
-
-    elements.append(tabela_estilizada(data_forma))
-    elements.append(Spacer(1,25))
-
-    # 🟩 Produtos
-    elements.append(Paragraph("Vendas por Produtos", styles["Heading3"]))
-    elements.append(Spacer(1,10))
-
-    data_prod = [["Produto", "Quantidade", "Total (R$)"]]
-    for p in mais_vendidos:
-        data_prod.append([
-            p["descricao"],
-            p["quantidade"],
-            round(p["total"],2)
-        ])
-
-    elements.append(tabela_estilizada(data_prod))
-    elements.append(Spacer(1,25))
-
-    # 🟩 Operadores
-    elements.append(Paragraph("Vendas por Operador de Caixa", styles["Heading3"]))
-    elements.append(Spacer(1,10))
-
-    data_op = [["Operador", "Nº Vendas", "Total (R$)"]]
-    for o in por_operador:
-        data_op.append([
-            o["nome_usuario"],
-            o["vendas"],
-            round(o["total"],2)
-        ])
-
-    elements.append(tabela_estilizada(data_op))
-    elements.append(Spacer(1,30))
-
-    # 📝 Rodapé
-    elements.append(Paragraph(
-        "Relatório gerado automaticamente pelo Sistema Quermesse Online.",
-        styles["Italic"]
-    ))
-
-    doc.build(elements)
-
-    return send_file(file_path, as_attachment=True)
+    def gerar():
+        with conectar() as conn:
+            c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+            # 🔎 CONSULTAS
+            total_geral, por_forma, mais_vendidos, por_operador = resumos.ler(c)
+
+        # 📄 CRIAÇÃO DO PDF
+        return relatorios_pdf.resumo_geral(
+            total_geral, por_forma, mais_vendidos, por_operador,
+            agora_amazonas().strftime("%d/%m/%Y %H:%M:%S")
+        )
+
+    pdf = relatorios_pdf.em_cache(("resumo", versao), gerar)
+
+    return enviar_pdf(pdf, "Resumo_Quermesse.pdf")
 
 # =========================
 # FECHAMENTO
 # =========================
+# um dia (?data=) ou um período (?data_inicio=&data_fim=); dias fechados
+# (fechamentos.py) vêm da fotografia, os abertos das vendas
+def periodo_da_requisicao():
+    hoje = agora_amazonas().strftime("%Y-%m-%d")
+    data = request.args.get("data")
+
+    de = request.args.get("data_inicio") or data or hoje
+    ate = request.args.get("data_fim") or data or de
+
+    de, ate = fechamentos.como_data(de), fechamentos.como_data(ate)
+
+    if ate < de:
+        de, ate = ate, de
+
+    return de, ate
+
+def fechamento_como_json(f):
+    return {
+        "data_inicio": f["de"].isoformat(),
+        "data_fim": f["ate"].isoformat(),
+        "dias": [{**d, "data": d["data"].isoformat()} for d in f["dias"]],
+        "formas": f["formas"],
+        "operadores": f["operadores"],
+        "total": f["total"]
+    }
+
 @app.route("/fechamento")
 def fechamento():
 
     if "usuario" not in session:
         return redirect("/")
 
-    data = request.args.get("data")
+    de, ate = periodo_da_requisicao()
+
+    with conectar() as conn:
+        fechados = fechamentos.fechados(conn, de, ate)
+        resultado = fechamentos.periodo(conn, de, ate)
+
+    # fechar o dia só aparece para um dia único, já terminado e ainda aberto
+    um_dia = de == ate
 
-    if not data:
-        data = agora_amazonas().strftime("%Y-%m-%d")
-
-    conn = conectar()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    c.execute("""
-        SELECT forma_pagamento,
-               SUM(valor_total) AS total,
-               SUM(COALESCE(troco_unico,0)) AS total_troco
-        FROM (
-            SELECT numero_venda,
-                   forma_pagamento,
-                   SUM(valor_total) AS valor_total,
-                   MAX(COALESCE(troco,0)) AS troco_unico
-            FROM vendas
-            WHERE DATE(data_venda) = %s
-            GROUP BY numero_venda, forma_pagamento
-        ) sub
-        GROUP BY forma_pagamento
-        ORDER BY forma_pagamento
-    """, (data,))
-
-    resultado = c.fetchall()
-
-    conn.close()
-
-    # CALCULAR TOTAIS
-    total_geral = sum(float(r["total"] or 0) for r in resultado)
-    total_troco = sum(float(r["total_troco"] or 0) for r in resultado)
-
-    data_formatada = datetime.strptime(data, "%Y-%m-%d").strftime("%d/%m/%Y")
-    
     return render_template(
         "fechamento.html",
-        resultado=resultado,
-        data=data_formatada,
-        total_geral=total_geral,
-        total_troco=total_troco
+        fechamento=resultado,
+        um_dia=um_dia,
+        dia=fechados.get(de) if um_dia else None,
+        pode_fechar=um_dia and de not in fechados and fechamentos.pode_fechar(de)
     )
-    
-# =========================
-# FECHAMENTO PDF
-# =========================
-@app.route("/fechamento_pdf")
-def fechamento_pdf():
+
+@app.route("/fechamento_json")
+def fechamento_json():
 
     if "usuario" not in session:
-        return redirect("/")
+        return jsonify({"erro": "Não autorizado"}), 403
 
-    data = request.args.get("data")
+    de, ate = periodo_da_requisicao()
 
-    if not data:
-        data = agora_amazonas().strftime("%Y-%m-%d")
-
-    conn = conectar()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    c.execute("""
-    SELECT forma_pagamento,
-           SUM(valor_total) AS total,
-           SUM(COALESCE(troco_unico,0)) AS total_troco
-    FROM (
-        SELECT numero_venda,
-               forma_pagamento,
-               SUM(valor_total) AS valor_total,
-               MAX(COALESCE(troco,0)) AS troco_unico
-        FROM vendas
-        WHERE DATE(data_venda) = %s
-        GROUP BY numero_venda, forma_pagamento
-    ) sub
-    GROUP BY forma_pagamento
-    """, (data,))
-
-    resultado = c.fetchall()
-    conn.close()
-
-    # ======================
-    # CRIAÇÃO DO PDF
-    # ======================
-
-    file_path = "Fechamento_Caixa.pdf"
-    doc = SimpleDocTemplate(file_path, pagesize=A4)
-
-    elements = []
-    styles = getSampleStyleSheet()
-
-    titulo_style = ParagraphStyle(
-        'TituloCentralizado',
-        parent=styles['Title'],
-        alignment=1
-    )
+    with conectar() as conn:
+        resultado = fechamentos.periodo(conn, de, ate)
 
-    elements.append(Paragraph("QUERMESSE ONLINE", titulo_style))
-    elements.append(Spacer(1, 10))
-    elements.append(Paragraph("Fechamento de Caixa", styles["Heading2"]))
-    elements.append(Spacer(1, 10))
-    elements.append(Paragraph(f"Data: {data}", styles["Normal"]))
-    elements.append(Spacer(1, 20))
+    return jsonify(fechamento_como_json(resultado))
 
-    tabela = [["Forma Pagamento", "Total Vendido", "Total Troco"]]
+@app.route("/fechar_dia", methods=["POST"])
+def fechar_dia():
 
-    total_vendido = 0
-    total_troco = 0
+    if "usuario" not in session:
+        return redirect("/")
 
-    for r in resultado:
-        total = float(r["total"] or 0)
-        troco = float(r["total_troco"] or 0)
-    
-        total_vendido += total
-        total_troco += troco
+    if session.get("perfil") != "administrador":
+        flash("Acesso restrito!", "danger")
+        return redirect("/fechamento")
+
+    try:
+        data = fechamentos.como_data(request.form.get("data") or "")
+    except ValueError:
+        flash("Data inválida (use AAAA-MM-DD).", "danger")
+        return redirect("/fechamento")
+
+    # hoje e dias futuros ainda recebem vendas
+    if not fechamentos.pode_fechar(data):
+        flash("Só é possível fechar dias que já terminaram.", "danger")
+        return redirect("/fechamento")
+
+    with conectar() as conn:
+        if fechamentos.fechar(conn, data, session.get("usuario_id")):
+            flash("Dia fechado com sucesso!", "success")
+        else:
+            flash("Este dia já estava fechado.", "info")
+
+    return redirect(f"/fechamento?data={data}")
     
-        tabela.append([
-            r["forma_pagamento"],
-            f"R$ {round(total,2)}",
-            f"R$ {round(troco,2)}"
-        ])
-        
-    tabela.append([
-        "TOTAL GERAL",
-        f"R$ {round(total_vendido,2)}",
-        f"R$ {round(total_troco,2)}"
-    ])
+# =========================
+# FECHAMENTO PDF
+# =========================
+@app.route("/fechamento_pdf")
+def fechamento_pdf():
 
-    table = Table(tabela)
+    if "usuario" not in session:
+        return redirect("/")
 
-    table.setStyle(TableStyle([
-        ('BACKGROUND',(0,0),(-1,0),'#a9abaa'),
-        ('TEXTCOLOR',(0,0),(-1,0),'white'),
-        ('GRID',(0,0),(-1,-1),0.5,'grey'),
-        ('FONTNAME',(0,0),(-1,-1),'Helvetica'),
-        ('BACKGROUND', (0,-1), (-1,-1), '#d9edf7')
-    ]))
+    de, ate = periodo_da_requisicao()
 
-    elements.append(table)
+    with conectar() as conn:
+        versao = fechamentos.versao(conn, de, ate)
 
-    elements.append(Spacer(1,20))
-    elements.append(Paragraph(
-        "Relatório gerado automaticamente pelo Sistema Quermesse Online.",
-        styles["Italic"]
-    ))
+    def gerar():
+        with conectar() as conn:
+            resultado = fechamentos.periodo(conn, de, ate)
 
-    doc.build(elements)
+        return relatorios_pdf.fechamento_caixa(resultado)
 
-    return send_file(file_path, as_attachment=True)
+    pdf = relatorios_pdf.em_cache(("fechamento", de, ate, versao), gerar)
+
+    return enviar_pdf(pdf, "Fechamento_Caixa.pdf")
 
 # =========================
 # RELATÓRIOS
 # =========================
+# uma página da lista; o total geral e a contagem vêm do banco
+RELATORIO_POR_PAGINA = int(os.getenv("RELATORIO_POR_PAGINA", "50"))
+RELATORIO_POR_PAGINA_MAX = 500
+
+def inteiro_ou_none(valor):
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        return None
+
 @app.route("/relatorios")
 def relatorios():
 
@@ -1052,99 +1447,58 @@ def relatorios():
     if session.get("perfil") != "administrador":
         return redirect("/dashboard")
 
-    data_inicio = request.args.get("data_inicio")
-    data_fim = request.args.get("data_fim")
-    forma_pagamento = request.args.get("forma_pagamento")
-    usuario_id = request.args.get("usuario_id")
-    numero_venda = request.args.get("numero_venda")
-    
-    # corrigir parâmetros vindos como "None"
-    if data_inicio == "None":
-        data_inicio = None
-    
-    if data_fim == "None":
-        data_fim = None
-    
-    if forma_pagamento == "None":
-        forma_pagamento = None
-    
-    if usuario_id == "None":
-        usuario_id = None
+    filtros = consultas.Filtros.de(request.args)
 
-    if numero_venda == "None":
-        numero_venda = None
-    
-    conn = conectar()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    query = """
-        SELECT 
-            v.numero_venda,
-            MIN(v.data_venda AT TIME ZONE 'America/Manaus') AS data_venda,
-            v.forma_pagamento,
-            u.nome_usuario,
-            SUM(v.valor_total) AS total
-        FROM vendas v
-        JOIN usuarios u ON u.id = v.usuario_id
-        WHERE 1=1
-    """
-
-    params = []
-
-    if data_inicio and data_inicio != "None":
-        query += " AND DATE(v.data_venda) >= %s"
-        params.append(data_inicio)
-
-    if data_fim and data_fim != "None":
-        query += " AND DATE(v.data_venda) <= %s"
-        params.append(data_fim)
-
-    if forma_pagamento:
-        query += " AND v.forma_pagamento = %s"
-        params.append(forma_pagamento)
-
-    if usuario_id:
-        query += " AND u.id = %s"
-        params.append(usuario_id)
-
-    if numero_venda and numero_venda != "None":
-        query += " AND v.numero_venda = %s"
-        params.append(numero_venda)
-
-    query += """
-        GROUP BY 
-            v.numero_venda,
-            v.forma_pagamento,
-            u.nome_usuario
-        ORDER BY v.numero_venda DESC
-    """
-
-    c.execute(query, params)
-    vendas = c.fetchall()
-
-    # usuários para filtro
-    c.execute("SELECT id, nome_usuario FROM usuarios ORDER BY nome_usuario")
-    usuarios = c.fetchall()
-
-    # formas de pagamento
-    c.execute("SELECT DISTINCT forma_pagamento FROM vendas ORDER BY forma_pagamento")
-    formas = c.fetchall()
-
-    conn.close()
-
-    total_geral = sum(float(v["total"] or 0) for v in vendas)
+    por_pagina = inteiro_ou_none(request.args.get("por_pagina")) or RELATORIO_POR_PAGINA
+    por_pagina = min(max(por_pagina, 1), RELATORIO_POR_PAGINA_MAX)
+
+    antes = inteiro_ou_none(request.args.get("antes"))
+    depois = inteiro_ou_none(request.args.get("depois")) if antes is None else None
+
+    # contagem/total vêm do cache de consultas quando a mesma busca já foi
+    # feita (inclusive por uma exportação) sobre os mesmos dados
+    pagina = consultas.pagina(filtros, por_pagina, antes, depois)
+
+    with conectar() as conn:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+        # usuários para filtro
+        c.execute("SELECT id, nome_usuario FROM usuarios ORDER BY nome_usuario")
+        usuarios = c.fetchall()
+
+        # formas de pagamento (lidas do resumo, sem varrer vendas)
+        c.execute("""
+            SELECT forma_pagamento
+            FROM resumo_forma_pagamento
+            GROUP BY forma_pagamento
+            HAVING SUM(vendas) > 0
+            ORDER BY forma_pagamento
+        """)
+        formas = c.fetchall()
+
+    texto_filtros = filtros.como_dict()
+
+    def url_pagina(**cursor_pagina):
+        argumentos = {k: v for k, v in texto_filtros.items() if v is not None}
+        argumentos["por_pagina"] = por_pagina
+        argumentos.update(cursor_pagina)
+        return "/relatorios?" + urlencode(argumentos)
 
     return render_template(
         "relatorios.html",
-        vendas=vendas,
-        total_geral=total_geral,
+        vendas=pagina.vendas,
+        total_geral=float(pagina.totais.total_geral),
+        quantidade=pagina.totais.quantidade,
+        por_pagina=por_pagina,
+        url_anterior=None if pagina.anterior is None else url_pagina(depois=pagina.anterior),
+        url_proxima=None if pagina.proxima is None else url_pagina(antes=pagina.proxima),
         usuarios=usuarios,
         formas=formas,
-        filtro_data_inicio=data_inicio,
-        filtro_data_fim=data_fim,
-        filtro_forma_pagamento=forma_pagamento,
-        filtro_usuario_id=usuario_id,
-        filtro_numero_venda=numero_venda
+        filtro_data_inicio=texto_filtros["data_inicio"],
+        filtro_data_fim=texto_filtros["data_fim"],
+        filtro_forma_pagamento=texto_filtros["forma_pagamento"],
+        filtro_usuario_id=texto_filtros["usuario_id"],
+        filtro_numero_venda=texto_filtros["numero_venda"]
     )
 
 # =========================
@@ -1156,28 +1510,51 @@ def itens_venda(numero_venda):
     if "usuario" not in session:
         return jsonify({"erro": "Não autorizado"}), 403
 
-    conn = conectar()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    c.execute("""
-        SELECT 
-            p.descricao,
-            v.quantidade,
-            v.valor_total,
-            TO_CHAR(v.data_venda, 'DD/MM/YYYY HH24:MI:SS') AS data_venda
-        FROM vendas v
-        JOIN produtos p ON p.id = v.produto_id
-        WHERE v.numero_venda = %s
-    """, (numero_venda,))
+    with conectar() as conn:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-    itens = c.fetchall()
+        c.execute("""
+            SELECT 
+                p.descricao,
+                i.quantidade,
+                i.valor_total,
+                TO_CHAR(v.data_venda, 'DD/MM/YYYY HH24:MI:SS') AS data_venda
+            FROM itens_venda i
+            JOIN vendas v ON v.numero_venda = i.numero_venda
+            JOIN produtos p ON p.id = i.produto_id
+            WHERE i.numero_venda = %s
+        """, (numero_venda,))
 
-    conn.close()
+        itens = c.fetchall()
 
     return jsonify(itens)
 
 # =========================
-# PDF
+# RELATÓRIO DE VENDAS (PDF / EXCEL)
+# =========================
+# filtros: consultas.Filtros
+def pdf_vendas(filtros, progresso=None):
+
+    with conectar() as conn:
+        versao = resumos.versao(conn)
+
+    def gerar():
+        vendas = consultas.vendas(filtros)
+
+        if progresso:
+            progresso(0.5)
+
+        # ===== GERAR PDF =====
+        return relatorios_pdf.relatorio_vendas(vendas)
+
+    return relatorios_pdf.em_cache(("vendas", filtros, versao), gerar)
+
+def excel_vendas(filtros, arquivo, progresso=None):
+    with conectar() as conn:
+        exportacao.excel_vendas(conn, filtros, arquivo, progresso)
+
+# =========================
+# RELATÓRIO DE VENDAS (PDF)
 # =========================
 @app.route("/relatorio_vendas_pdf")
 def relatorio_vendas_pdf():
@@ -1185,116 +1562,10 @@ def relatorio_vendas_pdf():
     if "usuario" not in session:
         return redirect("/")
 
-    data_inicio = request.args.get("data_inicio")
-    data_fim = request.args.get("data_fim")
-    forma_pagamento = request.args.get("forma_pagamento")
-    usuario_id = request.args.get("usuario_id")
-    numero_venda = request.args.get("numero_venda")
-
-    conn = conectar()
-    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-
-    query = """
-        SELECT 
-            v.numero_venda,
-            MIN(v.data_venda AT TIME ZONE 'America/Manaus') as data_venda,
-            SUM(v.valor_total) as valor_total,
-            v.forma_pagamento,
-            u.nome_usuario
-        FROM vendas v
-        JOIN usuarios u ON u.id = v.usuario_id
-        WHERE 1=1
-    """
-
-    params = []
-
-    if data_inicio:
-        query += " AND DATE(v.data_venda) >= %s"
-        params.append(data_inicio)
-
-    if data_fim:
-        query += " AND DATE(v.data_venda) <= %s"
-        params.append(data_fim)
-
-    if forma_pagamento:
-        query += " AND v.forma_pagamento = %s"
-        params.append(forma_pagamento)
-
-    if usuario_id:
-        query += " AND v.usuario_id = %s"
-        params.append(usuario_id)
-
-    if numero_venda:
-        query += " AND v.numero_venda = %s"
-        params.append(numero_venda) 
-
-    query += """
-        GROUP BY v.numero_venda, v.forma_pagamento, u.nome_usuario
-        ORDER BY v.numero_venda DESC
-    """
-
-    c.execute(query, params)
-    vendas = c.fetchall()
-
-    # ===== GERAR PDF =====
-    caminho = "relatorio_vendas.pdf"
-    
-    elementos = []
-    
-    styles = getSampleStyleSheet()
-    
-    # Título
-    titulo = Paragraph("Relatório de Vendas", styles["Title"])
-    elementos.append(titulo)
-    elementos.append(Spacer(1,20))
-    
-    dados = [["Venda", "Data", "Pagamento", "Usuário", "Valor"]]
-    
-    total = 0
-    
-    for v in vendas:
-        dados.append([
-            v["numero_venda"],
-            v["data_venda"].strftime("%d/%m/%Y %H:%M"),
-            v["forma_pagamento"],
-            v["nome_usuario"],
-            f"R$ {v['valor_total']:.2f}"
-        ])
-        total += v["valor_total"]
-    
-    dados.append(["", "", "", "TOTAL", f"R$ {total:.2f}"])
-    
-    tabela = Table(dados, colWidths=[60,120,110,120,80])
-    
-    tabela.setStyle(TableStyle([
-    
-        # Cabeçalho
-        ('BACKGROUND',(0,0),(-1,0),colors.lightgrey),
-        ('FONTNAME',(0,0),(-1,0),'Helvetica-Bold'),
-        ('ALIGN',(0,0),(-1,0),'CENTER'),
-    
-        # Alinhamento das colunas
-        ('ALIGN',(0,1),(0,-1),'CENTER'),
-        ('ALIGN',(1,1),(3,-1),'CENTER'),
-        ('ALIGN',(4,1),(4,-1),'RIGHT'),
-    
-        # Grade
-        ('GRID',(0,0),(-1,-1),1,colors.black),
-    
-        # Linha total
-        ('FONTNAME',(3,-1),(4,-1),'Helvetica-Bold'),
-        ('BACKGROUND',(3,-1),(4,-1),colors.lightgrey)
-    
-    ]))
-    
-    elementos.append(tabela)
-    
-    doc = SimpleDocTemplate(caminho, pagesize=A4)
-    doc.build(elementos)
+    pdf = pdf_vendas(consultas.Filtros.de(request.args))
 
-    conn.close()
+    return enviar_pdf(pdf, "relatorio_vendas.pdf")
 
-    return send_file(caminho, as_attachment=True)
 # =========================
 # EXCEL
 # =========================
@@ -1304,153 +1575,124 @@ def relatorio_vendas_excel():
     if session.get("perfil") != "administrador":
         return redirect("/dashboard")
 
-    # filtros vindos da URL
-    data_inicio = request.args.get("data_inicio")
-    data_fim = request.args.get("data_fim")
-    forma_pagamento = request.args.get("forma_pagamento")
-    usuario_id = request.args.get("usuario_id")
-    numero_venda = request.args.get("numero_venda")
-    
-    # Corrigir valores inválidos vindos da URL
-    if data_inicio in ("", "None"):
-        data_inicio = None
-    
-    if data_fim in ("", "None"):
-        data_fim = None
-    
-    if forma_pagamento in ("", "None"):
-        forma_pagamento = None
-    
-    if usuario_id in ("", "None"):
-        usuario_id = None
-
-    if numero_venda in ("", "None"):
-        numero_venda = None
-
-    conn = conectar()
-    c = conn.cursor()
-
-    sql = """
-        SELECT 
-            v.numero_venda,
-            MIN(v.data_venda AT TIME ZONE 'America/Manaus') AS data_venda,
-            v.forma_pagamento,
-            u.nome_usuario,
-            SUM(v.valor_total) AS total
-        FROM vendas v
-        JOIN usuarios u ON u.id = v.usuario_id
-        WHERE 1=1
-    """
-
-    params = []
-
-    if data_inicio:
-        sql += " AND DATE(v.data_venda) >= %s"
-        params.append(data_inicio)
-
-    if data_fim:
-        sql += " AND DATE(v.data_venda) <= %s"
-        params.append(data_fim)
-
-    if forma_pagamento:
-        sql += " AND v.forma_pagamento = %s"
-        params.append(forma_pagamento)
-
-    if usuario_id:
-        sql += " AND v.usuario_id = %s"
-        params.append(usuario_id)
-
-    if numero_venda:
-        sql += " AND v.numero_venda = %s"
-        params.append(numero_venda)
-
-    sql += """
-        GROUP BY 
-            v.numero_venda, 
-            v.forma_pagamento, 
-            u.nome_usuario
-        ORDER BY v.numero_venda DESC
-    """
-
-    c.execute(sql, params)
-
-    vendas = c.fetchall()
-    conn.close()
-
-    wb = Workbook()
-    ws = wb.active
-
-    # Cabeçalho
-    headers = ["ID Venda", "Data", "Forma Pagamento", "Valor Total", "Usuário"]
-    ws.append(headers)
-
-    # ===== ESTILO DO CABEÇALHO =====
-    bold_font = Font(bold=True)
-    fill_gray = PatternFill(start_color="DDDDDD",
-                            end_color="DDDDDD",
-                            fill_type="solid")
-
-    for col in range(1, len(headers) + 1):
-        cell = ws.cell(row=1, column=col)
-        cell.font = bold_font
-        cell.fill = fill_gray
-
-    # Inserindo dados
-    total_geral = 0
-    
-    for v in vendas:
-        valor = float(v[4])
-        total_geral += valor
-
-        ws.append([
-            v[0],
-            v[1].strftime("%d/%m/%Y %H:%M:%S"),
-            v[2],
-            valor,
-            v[3]
-        ])
-
-    # ===== LINHA DO TOTAL =====
-    linha_total = ws.max_row + 1
-    
-    # Texto
-    ws.cell(row=linha_total, column=1).value = "Total das vendas"
-    
-    # Valor
-    ws.cell(row=linha_total, column=4).value = total_geral
-    
-    # Mesclar A+B+C
-    ws.merge_cells(start_row=linha_total, start_column=1, end_row=linha_total, end_column=3)
-    
-    # Mesclar D+E
-    ws.merge_cells(start_row=linha_total, start_column=4, end_row=linha_total, end_column=5)
-    
-    # Negrito
-    ws.cell(row=linha_total, column=1).font = Font(bold=True)
-    ws.cell(row=linha_total, column=4).font = Font(bold=True)
+    # arquivo temporário por requisição (apagado ao fechar): duas exportações
+    # simultâneas não se sobrescrevem e a planilha não fica inteira na memória
+    arquivo = tempfile.TemporaryFile()
 
-    ws.cell(row=linha_total, column=1).alignment = Alignment(horizontal="right")
-    ws.cell(row=linha_total, column=4).alignment = Alignment(horizontal="center")
+    try:
+        excel_vendas(consultas.Filtros.de(request.args), arquivo)
+    except Exception:
+        arquivo.close()
+        raise
+
+    arquivo.seek(0)
+
+    return send_file(
+        arquivo,
+        as_attachment=True,
+        download_name="Relatorio_Vendas.xlsx",
+        mimetype=exportacao.MIME_XLSX
+    )
 
-    # ===== AJUSTE AUTOMÁTICO DE LARGURA =====
-    for column_cells in ws.columns:
-        max_length = 0
-        column_letter = column_cells[0].column_letter
+# =========================
+# RELATÓRIOS EM SEGUNDO PLANO
+# =========================
+@tarefas.tarefa("relatorio_vendas_pdf")
+def tarefa_relatorio_vendas_pdf(parametros, progresso):
+    pdf = pdf_vendas(consultas.Filtros.de(parametros), progresso)
+    return pdf, "relatorio_vendas.pdf", "application/pdf"
+
+@tarefas.tarefa("relatorio_vendas_excel", somente_admin=True)
+def tarefa_relatorio_vendas_excel(parametros, progresso):
+    with tempfile.TemporaryFile() as arquivo:
+        excel_vendas(consultas.Filtros.de(parametros), arquivo, progresso)
+        arquivo.seek(0)
+        return arquivo.read(), "Relatorio_Vendas.xlsx", exportacao.MIME_XLSX
+
+def pode_acessar_tarefa(tarefa):
+    # mesma regra do compartilhamento em tarefas.enviar
+    return (
+        session.get("perfil") == "administrador"
+        or tarefa["usuario_id"] == session.get("usuario_id")
+    )
 
-        for cell in column_cells:
-            try:
-                if cell.value:
-                    max_length = max(max_length, len(str(cell.value)))
-            except:
-                pass
+@app.route("/tarefas/<tipo>", methods=["POST"])
+def enviar_tarefa(tipo):
+
+    if "usuario" not in session:
+        return jsonify({"erro": "Não autorizado"}), 403
+
+    if tipo not in tarefas.TIPOS:
+        return jsonify({"erro": "Tipo de tarefa desconhecido"}), 404
+
+    _, somente_admin = tarefas.TIPOS[tipo]
+
+    if somente_admin and session.get("perfil") != "administrador":
+        return jsonify({"erro": "Acesso restrito"}), 403
+
+    parametros = consultas.Filtros.de(request.get_json(silent=True) or request.form).como_dict()
 
-        adjusted_width = max_length + 2
-        ws.column_dimensions[column_letter].width = adjusted_width
+    with conectar() as conn:
+        versao = resumos.versao(conn)
 
-    file_path = "Relatorio_Vendas.xlsx"
-    wb.save(file_path)
+    if tarefas.NO_WEB:
+        tarefas.iniciar()
+
+    # admins podem abrir as tarefas de todos, então dividem o mesmo pedido;
+    # os demais usuários ficam cada um com a sua
+    tarefa = tarefas.enviar(
+        tipo, parametros, session.get("usuario_id"), versao,
+        compartilhar=session.get("perfil") == "administrador"
+    )
+
+    return jsonify({
+        "id": tarefa["id"],
+        "status": tarefa["status"],
+        "url_status": f"/tarefas/{tarefa['id']}",
+        "url_arquivo": f"/tarefas/{tarefa['id']}/arquivo"
+    }), 202
+
+@app.route("/tarefas/<id_tarefa>")
+def status_tarefa(id_tarefa):
+
+    if "usuario" not in session:
+        return jsonify({"erro": "Não autorizado"}), 403
+
+    tarefa = tarefas.consultar(id_tarefa)
+
+    if not tarefa or not pode_acessar_tarefa(tarefa):
+        return jsonify({"erro": "Tarefa não encontrada"}), 404
+
+    if tarefas.NO_WEB:
+        tarefas.iniciar()
+
+    return jsonify({
+        "id": tarefa["id"],
+        "tipo": tarefa["tipo"],
+        "status": tarefa["status"],
+        "progresso": round(tarefa["progresso"], 2),
+        "erro": tarefa["erro"],
+        "url_arquivo": f"/tarefas/{tarefa['id']}/arquivo" if tarefa["status"] == "concluida" else None
+    })
+
+@app.route("/tarefas/<id_tarefa>/arquivo")
+def arquivo_tarefa(id_tarefa):
+
+    if "usuario" not in session:
+        return redirect("/")
+
+    tarefa = tarefas.arquivo(id_tarefa)
+
+    if not tarefa or not pode_acessar_tarefa(tarefa):
+        return jsonify({"erro": "Arquivo não disponível"}), 404
+
+    return send_file(
+        BytesIO(tarefa["conteudo"]),
+        as_attachment=True,
+        download_name=tarefa["nome_arquivo"],
+        mimetype=tarefa["mimetype"]
+    )
 
-    return send_file(file_path, as_attachment=True)
 # =========================
 # RESETAR QUERMESSE
 # =========================
@@ -1465,36 +1707,94 @@ def resetar_quermesse():
         flash("Acesso restrito!", "danger")
         return redirect("/dashboard")
 
-    conn = conectar()
-    if not conn:
-        flash("Erro ao conectar no banco!", "danger")
-        return redirect("/dashboard")
-
-    cur = conn.cursor()
-
     try:
-        # 🔥 Apaga TODAS as vendas
-        cur.execute("TRUNCATE TABLE vendas RESTART IDENTITY CASCADE;")
-
-        # 🔄 Opcional: restaurar estoque para inicial
-        cur.execute("""
-            UPDATE produtos
-            SET estoque_atual = estoque_inicial
-        """)
+        with conectar() as conn:
+            cur = conn.cursor()
 
-        conn.commit()
-        flash("Sistema resetado para nova quermesse com sucesso!", "success")
-
-    except Exception as e:
-        conn.rollback()
-        print("ERRO RESET:", e)
-        flash("Erro ao resetar sistema!", "danger")
+            try:
+                # 🔥 Apaga TODAS as vendas
+                cur.execute("TRUNCATE TABLE vendas RESTART IDENTITY CASCADE;")
+                cur.execute("TRUNCATE TABLE vendas_idempotencia;")
+                resumos.zerar(cur)
+                fechamentos.zerar(cur)
+
+                # 🔄 Opcional: restaurar estoque para inicial (livro de estoque)
+                cur.execute("SELECT id, estoque_inicial FROM produtos")
+                ajustados = movimentos.ajustar(cur, dict(cur.fetchall()), "reset")
+                notificacoes.notificar_estoque(cur, [id for id, _ in ajustados])
+
+                conn.commit()
+                resumos.nova_versao(conn)
+                flash("Sistema resetado para nova quermesse com sucesso!", "success")
+
+            except Exception:
+                conn.rollback()
+                app.logger.exception("ERRO RESET")
+                flash("Erro ao resetar sistema!", "danger")
 
-    finally:
-        conn.close()
+    except psycopg2.OperationalError:
+        flash("Erro ao conectar no banco!", "danger")
 
     return redirect("/dashboard")
 
 @app.route("/health")
 def health():
     return "OK", 200
+
+# /metrics e /health/*: sessão de administrador, ou o coletor (Prometheus)
+# com "Authorization: Bearer <METRICAS_TOKEN>"; sem o token, só a sessão
+METRICAS_TOKEN = os.getenv("METRICAS_TOKEN", "")
+
+def pode_ver_metricas():
+    if session.get("perfil") == "administrador":
+        return True
+
+    if not METRICAS_TOKEN:
+        return False
+
+    tipo, _, token = request.headers.get("Authorization", "").partition(" ")
+    return tipo.lower() == "bearer" and hmac.compare_digest(token.encode(), METRICAS_TOKEN.encode())
+
+@app.route("/metrics")
+def metrics():
+    if not pode_ver_metricas():
+        return jsonify({"erro": "Não autorizado"}), 403
+
+    return Response(metricas.exportar(), mimetype="text/plain; version=0.0.4")
+
+# =========================
+# CONSULTAS LENTAS
+# =========================
+# grupos do log de lentas.py (CONSULTAS_LENTAS_MS), pelo tempo total gasto
+@app.route("/consultas_lentas")
+def consultas_lentas():
+    if session.get("perfil") != "administrador":
+        return redirect("/dashboard")
+
+    return render_template(
+        "consultas_lentas.html",
+        grupos=lentas.piores(),
+        limite_ms=lentas.LIMITE_MS,
+        arquivo=lentas.ARQUIVO
+    )
+
+@app.route("/health/pool")
+def health_pool():
+    if not pode_ver_metricas():
+        return jsonify({"erro": "Não autorizado"}), 403
+
+    return jsonify(estatisticas_pool())
+
+@app.route("/health/pix")
+def health_pix():
+    if not pode_ver_metricas():
+        return jsonify({"erro": "Não autorizado"}), 403
+
+    info = pix_em_centavos.cache_info()
+    return jsonify({
+        "acertos": info.hits,
+        "faltas": info.misses,
+        "tamanho": info.currsize,
+        "maximo": info.maxsize
+    })
+
@@ -0,0 +1,639 @@
+import argparse
+import http.cookiejar
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from datetime import datetime
+
+from werkzeug.security import generate_password_hash
+
+import movimentos
+from db import conectar
+
+# =========================
+# BENCHMARK DE CAIXAS SIMULTÂNEOS
+# =========================
+# Simula N caixas vendendo ao mesmo tempo contra o app rodando (gunicorn ou
+# flask) e um PostgreSQL local:
+#
+#   DATABASE_URL=postgresql://localhost/quermesse DATABASE_SSLMODE=disable \
+#       python benchmark.py --caixas 16 --taxa 40
+#
+# O padrão de --url é o gunicorn local (http://localhost:8000, PORT do
+# gunicorn.conf.py). DATABASE_SSLMODE=disable vale para o benchmark e para o
+# servidor: o db.py exige SSL por padrão (Heroku), e um PostgreSQL local
+# normalmente não tem.
+#
+# Cria (ou reaproveita) usuários e produtos "BENCH", faz login de cada caixa
+# e repete carrinhos realistas em /salvar_venda, com /gerar_pix, consultas a
+# /estoque_atual e alguns cancelamentos, no ritmo pedido. O resultado
+# (vazão, p50/p95/p99 por rota, erros, conflitos de estoque, idas ao banco
+# por venda no máximo) é gravado em JSON; --comparar mostra a diferença
+# para um resultado anterior.
+#
+# Com --tablets N, N tablets ficam conectados em /estoque/stream durante
+# todo o teste, como as telas de venda abertas. Rodar o mesmo teste com o
+# servidor em WEB_MODO=threads e WEB_MODO=gevent (gunicorn.conf.py) mostra
+# quantos tablets cada modo aguenta sem atrasar as vendas:
+#
+#   python benchmark.py --caixas 4 --taxa 20 --tablets 300
+#
+# Com --logins N, N caixas a mais fazem login nos primeiros --janela-logins
+# segundos (a abertura da quermesse), enquanto os outros já vendem.
+#
+# Com --produto-quente, depois da rodada normal vem outra igual em que todo
+# carrinho leva só o mesmo produto (todas as vendas disputam o mesmo
+# estoque); as vendas/s das duas saem lado a lado.
+
+PREFIXO = "BENCH"
+SENHA = "bench"
+
+# formas de pagamento da tela de vendas, com o peso de cada uma
+FORMAS = [("Pix", 40), ("Dinheiro", 35), ("Débito", 15), ("Crédito", 10)]
+
+# a cada venda: chance de consultar o estoque e de cancelar a venda
+CHANCE_ESTOQUE = 0.2
+CHANCE_CANCELAR = 0.03
+
+PERCENTIS = (50, 95, 99)
+
+
+# =========================
+# PREPARAÇÃO DO BANCO
+# =========================
+def preparar(caixas, produtos, estoque):
+
+    with conectar() as conn:
+        c = conn.cursor()
+
+        senha = generate_password_hash(SENHA)
+
+        for numero in range(1, caixas + 1):
+            c.execute("""
+                INSERT INTO usuarios (nome_usuario, usuario, senha, perfil)
+                VALUES (%s, %s, %s, 'usuario')
+                ON CONFLICT (usuario) DO UPDATE SET senha = EXCLUDED.senha
+            """, (f"{PREFIXO} Caixa {numero}", f"{PREFIXO.lower()}{numero}", senha))
+
+        c.execute("SELECT COUNT(*) FROM produtos WHERE descricao LIKE %s", (PREFIXO + " %",))
+        existentes = c.fetchone()[0]
+
+        for numero in range(existentes + 1, produtos + 1):
+            c.execute("""
+                INSERT INTO produtos
+                (descricao, valor, estoque_inicial, estoque_atual, estoque_minimo, imprimir_cupom)
+                VALUES (%s, %s, %s, %s, 0, FALSE)
+            """, (f"{PREFIXO} Produto {numero:03d}", 2 + numero % 9, estoque, estoque))
+
+        # estoque cheio a cada rodada, para as rodadas serem comparáveis
+        c.execute("""
+            UPDATE produtos
+            SET estoque_inicial = %s
+            WHERE descricao LIKE %s
+            RETURNING id
+        """, (estoque, PREFIXO + " %"))
+        movimentos.ajustar(c, {id: estoque for id, in c.fetchall()}, "ajuste")
+
+        c.execute("""
+            SELECT id, valor
+            FROM produtos
+            WHERE descricao LIKE %s
+            ORDER BY descricao
+            LIMIT %s
+        """, (PREFIXO + " %", produtos))
+        catalogo = [(id, float(valor)) for id, valor in c.fetchall()]
+
+        conn.commit()
+
+    return catalogo
+
+
+def estatisticas_banco():
+
+    # idas ao banco: pg_stat_statements, se estiver instalado no banco;
+    # sem ele, só o número de transações (pg_stat_database). As duas contam
+    # o banco inteiro (ouvinte, tarefas, outros clientes), não só as vendas:
+    # por venda, são um limite superior
+    with conectar() as conn:
+        c = conn.cursor()
+
+        c.execute("""
+            SELECT xact_commit + xact_rollback
+            FROM pg_stat_database
+            WHERE datname = current_database()
+        """)
+        transacoes = c.fetchone()[0]
+
+        c.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements'")
+        consultas = None
+
+        if c.fetchone():
+            c.execute("""
+                SELECT COALESCE(SUM(calls), 0)
+                FROM pg_stat_statements
+                WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+            """)
+            consultas = int(c.fetchone()[0])
+
+        conn.rollback()
+
+    return {"transacoes": transacoes, "consultas": consultas}
+
+
+# =========================
+# CAIXA SIMULADO
+# =========================
+class Caixa:
+
+    def __init__(self, url, numero, catalogo, medicoes, sorteio):
+        self.url = url.rstrip("/")
+        self.usuario = f"{PREFIXO.lower()}{numero}"
+        self.catalogo = catalogo
+        self.medicoes = medicoes
+        self.sorteio = sorteio
+
+        jarra = http.cookiejar.CookieJar()
+        self.abridor = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jarra))
+        self.url_final = None
+
+    def chamar(self, rota, corpo=None, formulario=None, cabecalhos=None):
+
+        cabecalhos = dict(cabecalhos or {})
+        dados = None
+
+        if corpo is not None:
+            dados = json.dumps(corpo).encode()
+            cabecalhos["Content-Type"] = "application/json"
+        elif formulario is not None:
+            dados = urllib.parse.urlencode(formulario).encode()
+
+        pedido = urllib.request.Request(self.url + rota, data=dados, headers=cabecalhos)
+
+        inicio = time.perf_counter()
+        try:
+            with self.abridor.open(pedido, timeout=30) as resposta:
+                status = resposta.status
+                conteudo = resposta.read()
+                self.url_final = resposta.url
+        except urllib.error.HTTPError as e:
+            status = e.code
+            conteudo = e.read()
+        except (urllib.error.URLError, OSError):
+            status = 0
+            conteudo = b""
+
+        self.medicoes.registrar(rota, time.perf_counter() - inicio, status)
+
+        try:
+            return status, json.loads(conteudo)
+        except ValueError:
+            return status, None
+
+    def entrar(self):
+
+        # login certo termina no /dashboard; recusado volta para a tela de login
+        self.url_final = None
+        self.chamar("/autenticar", formulario={"usuario": self.usuario, "senha": SENHA})
+        return bool(self.url_final and self.url_final.endswith("/dashboard"))
+
+    def entrar_as(self, quando):
+
+        # caixa que só faz login (abertura da quermesse), no horário marcado
+        time.sleep(max(quando - time.monotonic(), 0))
+        self.medicoes.login(self.entrar())
+
+    def carrinho(self):
+
+        # poucos produtos por venda, os primeiros do catálogo vendem mais
+        pesos = [1 / (posicao + 1) for posicao in range(len(self.catalogo))]
+        tamanho = self.sorteio.choice([1, 1, 2, 2, 2, 3, 4])
+
+        escolhidos = {}
+        for id, valor in self.sorteio.choices(self.catalogo, weights=pesos, k=tamanho):
+            escolhidos[id] = (escolhidos.get(id, (0, valor))[0] + self.sorteio.choice([1, 1, 1, 2, 3]), valor)
+
+        return escolhidos
+
+    def vender(self):
+
+        escolhidos = self.carrinho()
+        total = sum(quantidade * valor for quantidade, valor in escolhidos.values())
+
+        forma = self.sorteio.choices([f for f, _ in FORMAS], weights=[p for _, p in FORMAS])[0]
+
+        if forma == "Pix":
+            self.chamar("/gerar_pix", corpo={"valor": total})
+
+        valor_recebido = None
+        if forma == "Dinheiro":
+            valor_recebido = math.ceil(total / 10) * 10
+
+        status, resposta = self.chamar("/salvar_venda", corpo={
+            "itens": [
+                {"produto_id": id, "quantidade": quantidade}
+                for id, (quantidade, _) in escolhidos.items()
+            ],
+            "forma_pagamento": forma,
+            "valor_recebido": valor_recebido
+        }, cabecalhos={"Idempotency-Key": uuid.uuid4().hex})
+
+        if status == 400 and resposta and resposta.get("erro") == "Estoque insuficiente":
+            self.medicoes.conflito_estoque()
+            return
+
+        if status != 200 or not resposta:
+            return
+
+        self.medicoes.venda()
+
+        if self.sorteio.random() < CHANCE_ESTOQUE:
+            self.chamar("/estoque_atual")
+
+        if self.sorteio.random() < CHANCE_CANCELAR:
+            self.chamar("/cancelar_venda", corpo={"numero_venda": resposta["numero_venda"]})
+
+    def rodar(self, intervalo, fim):
+
+        self.entrar()
+
+        # ritmo fixo (circuito aberto): a próxima venda sai no horário marcado,
+        # mesmo que a anterior tenha demorado; atrasos não são descontados
+        proxima = time.monotonic() + self.sorteio.random() * intervalo
+
+        while True:
+            agora = time.monotonic()
+
+            if agora >= fim:
+                return
+
+            if proxima > agora:
+                time.sleep(min(proxima - agora, fim - agora))
+                continue
+
+            self.vender()
+            proxima += intervalo
+
+
+# =========================
+# TABLET CONECTADO
+# =========================
+class Tablet:
+
+    # tela de vendas aberta: fica em /estoque/stream até o fim do teste e
+    # reconecta se o stream cair; o tempo até o primeiro evento (estoque
+    # completo) é medido como a rota /estoque/stream
+    def __init__(self, url, abridor, medicoes):
+        self.url = url.rstrip("/")
+        self.abridor = abridor
+        self.medicoes = medicoes
+
+    def conectar(self, fim):
+        inicio = time.perf_counter()
+        conectado = False
+
+        try:
+            with self.abridor.open(self.url + "/estoque/stream", timeout=max(fim - time.monotonic(), 1)) as resposta:
+                for linha in resposta:
+                    if time.monotonic() >= fim:
+                        break
+
+                    if not linha.startswith(b"data:"):
+                        continue
+
+                    if not conectado:
+                        conectado = True
+                        self.medicoes.registrar("/estoque/stream", time.perf_counter() - inicio, resposta.status)
+                        self.medicoes.tablet(+1)
+                    else:
+                        self.medicoes.aviso()
+
+        except urllib.error.HTTPError as e:
+            self.medicoes.registrar("/estoque/stream", time.perf_counter() - inicio, e.code)
+        except (urllib.error.URLError, OSError):
+            # sem nenhum evento até o fim do teste também cai aqui (timeout)
+            if not conectado:
+                self.medicoes.registrar("/estoque/stream", time.perf_counter() - inicio, 0)
+
+        if conectado:
+            self.medicoes.tablet(-1)
+
+        return conectado
+
+    def rodar(self, fim):
+        while time.monotonic() < fim:
+            if not self.conectar(fim):
+                time.sleep(1)
+
+
+class Medicoes:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.rotas = {}
+        self.vendas = 0
+        self.conflitos_estoque = 0
+        self.tablets_conectados = 0
+        self.tablets_maximo = 0
+        self.avisos = 0
+        self.logins = {True: 0, False: 0}
+
+    def registrar(self, rota, segundos, status):
+        with self._lock:
+            rota_medida = self.rotas.setdefault(rota, {"tempos": [], "status": {}})
+            rota_medida["tempos"].append(segundos)
+            rota_medida["status"][status] = rota_medida["status"].get(status, 0) + 1
+
+    def venda(self):
+        with self._lock:
+            self.vendas += 1
+
+    def conflito_estoque(self):
+        with self._lock:
+            self.conflitos_estoque += 1
+
+    def tablet(self, variacao):
+        with self._lock:
+            self.tablets_conectados += variacao
+            self.tablets_maximo = max(self.tablets_maximo, self.tablets_conectados)
+
+    def aviso(self):
+        with self._lock:
+            self.avisos += 1
+
+    def login(self, aceito):
+        with self._lock:
+            self.logins[aceito] += 1
+
+
+def percentil(ordenados, p):
+    if not ordenados:
+        return None
+    posicao = max(0, math.ceil(p / 100 * len(ordenados)) - 1)
+    return ordenados[posicao]
+
+
+def resumir(medicoes, duracao):
+
+    rotas = {}
+
+    for rota, medida in sorted(medicoes.rotas.items()):
+        tempos = sorted(medida["tempos"])
+        erros = sum(n for status, n in medida["status"].items() if status == 0 or status >= 400)
+
+        rotas[rota] = {
+            "requisicoes": len(tempos),
+            "por_segundo": round(len(tempos) / duracao, 2),
+            "erros": erros,
+            "taxa_erros": round(erros / len(tempos), 4),
+            "status": {str(status): n for status, n in sorted(medida["status"].items())},
+            "media_ms": round(1000 * sum(tempos) / len(tempos), 2),
+            "max_ms": round(1000 * tempos[-1], 2),
+            **{f"p{p}_ms": round(1000 * percentil(tempos, p), 2) for p in PERCENTIS}
+        }
+
+    return rotas
+
+
+def rodada_produto_quente(args, produto):
+
+    # mesmos caixas e ritmo da rodada normal, catálogo de um produto só
+    medicoes = Medicoes()
+    fim = time.monotonic() + args.duracao
+
+    threads = [
+        threading.Thread(
+            target=Caixa(args.url, numero, [produto], medicoes, random.Random(args.semente * 1000 + numero)).rodar,
+            args=(args.caixas / args.taxa, fim),
+            daemon=True
+        )
+        for numero in range(1, args.caixas + 1)
+    ]
+
+    comeco = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duracao = time.monotonic() - comeco
+
+    tentativas = medicoes.vendas + medicoes.conflitos_estoque
+
+    return {
+        "produto_id": produto[0],
+        "vendas": medicoes.vendas,
+        "vendas_por_segundo": round(medicoes.vendas / duracao, 2),
+        "conflitos_estoque": medicoes.conflitos_estoque,
+        "taxa_conflitos_estoque": round(medicoes.conflitos_estoque / max(tentativas, 1), 4),
+        "rotas": resumir(medicoes, duracao)
+    }
+
+
+def commit_atual():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def comparar(atual, anterior):
+
+    print(f"\nComparação com {anterior.get('commit')} ({anterior.get('inicio')}):")
+
+    for rota, medida in atual["rotas"].items():
+        antes = anterior.get("rotas", {}).get(rota)
+        if not antes:
+            continue
+
+        partes = []
+        for campo in ("p50_ms", "p95_ms", "p99_ms"):
+            if antes.get(campo):
+                variacao = 100 * (medida[campo] - antes[campo]) / antes[campo]
+                partes.append(f"{campo} {antes[campo]} → {medida[campo]} ({variacao:+.0f}%)")
+
+        print(f"  {rota}: " + ", ".join(partes))
+
+    print(f"  vendas/s: {anterior.get('vendas_por_segundo')} → {atual['vendas_por_segundo']}")
+
+    if anterior.get("produto_quente") and atual["produto_quente"]:
+        print(f"  vendas/s (produto quente): {anterior['produto_quente']['vendas_por_segundo']} → "
+              f"{atual['produto_quente']['vendas_por_segundo']}")
+
+    if anterior.get("tablets") and atual["tablets"]["pedidos"]:
+        print(f"  tablets conectados: {anterior['tablets']['conectados_ao_mesmo_tempo']} → "
+              f"{atual['tablets']['conectados_ao_mesmo_tempo']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de caixas simultâneos da quermesse")
+    parser.add_argument("--url", default=os.getenv("BENCH_URL", "http://localhost:8000"))
+    parser.add_argument("--caixas", type=int, default=8, help="caixas simultâneos")
+    parser.add_argument("--taxa", type=float, default=20, help="vendas por segundo (somando todos os caixas)")
+    parser.add_argument("--duracao", type=float, default=60, help="segundos de medição")
+    parser.add_argument("--produtos", type=int, default=40)
+    parser.add_argument("--estoque", type=int, default=1_000_000, help="estoque de cada produto BENCH")
+    parser.add_argument("--tablets", type=int, default=0, help="tablets conectados em /estoque/stream")
+    parser.add_argument("--logins", type=int, default=0, help="caixas que fazem login durante o teste")
+    parser.add_argument("--janela-logins", type=float, default=5, help="segundos em que os --logins acontecem")
+    parser.add_argument("--produto-quente", action="store_true",
+                        help="rodada extra com todas as vendas no mesmo produto")
+    parser.add_argument("--semente", type=int, default=42)
+    parser.add_argument("--saida", help="arquivo JSON do resultado")
+    parser.add_argument("--comparar", help="resultado anterior (JSON) para comparação")
+    args = parser.parse_args()
+
+    catalogo = preparar(args.caixas + args.logins, args.produtos, args.estoque)
+    medicoes = Medicoes()
+
+    intervalo = args.caixas / args.taxa
+    banco_antes = estatisticas_banco()
+    inicio = datetime.now()
+    fim = time.monotonic() + args.duracao
+
+    caixas = [
+        Caixa(args.url, numero, catalogo, medicoes, random.Random(args.semente * 1000 + numero))
+        for numero in range(1, args.caixas + 1)
+    ]
+    threads = [
+        threading.Thread(target=caixa.rodar, args=(intervalo, fim), daemon=True)
+        for caixa in caixas
+    ]
+
+    # os tablets usam a sessão do primeiro caixa; ninguém espera por eles no
+    # fim (um stream parado só percebe o fim no próximo evento)
+    tablets = []
+
+    if args.tablets:
+        tela = Caixa(args.url, 1, catalogo, medicoes, random.Random(args.semente))
+        tela.entrar()
+
+        tablets = [
+            threading.Thread(target=Tablet(args.url, tela.abridor, medicoes).rodar, args=(fim,), daemon=True)
+            for _ in range(args.tablets)
+        ]
+
+    # os logins da abertura usam os usuários depois dos caixas que vendem
+    sorteio = random.Random(args.semente)
+    threads += [
+        threading.Thread(
+            target=Caixa(args.url, numero, catalogo, medicoes, sorteio).entrar_as,
+            args=(time.monotonic() + sorteio.random() * args.janela_logins,),
+            daemon=True
+        )
+        for numero in range(args.caixas + 1, args.caixas + args.logins + 1)
+    ]
+
+    print(f"{args.caixas} caixas, {args.taxa} vendas/s, {args.tablets} tablets, "
+          f"{args.logins} logins, {args.duracao:.0f}s contra {args.url}")
+
+    comeco = time.monotonic()
+    for thread in tablets + threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duracao = time.monotonic() - comeco
+
+    # as estatísticas do PostgreSQL são publicadas com um pequeno atraso
+    time.sleep(1.5)
+    banco_depois = estatisticas_banco()
+
+    # depois da leitura do banco: as contas por venda são da rodada normal
+    quente = None
+    if args.produto_quente:
+        print(f"Rodada com um produto só ({args.duracao:.0f}s)")
+        quente = rodada_produto_quente(args, catalogo[0])
+
+    vendas = max(medicoes.vendas, 1)
+    tentativas = medicoes.vendas + medicoes.conflitos_estoque
+
+    resultado = {
+        "commit": commit_atual(),
+        "inicio": inicio.isoformat(timespec="seconds"),
+        "parametros": {
+            "url": args.url,
+            "caixas": args.caixas,
+            "taxa": args.taxa,
+            "duracao": args.duracao,
+            "produtos": args.produtos,
+            "tablets": args.tablets,
+            "logins": args.logins,
+            "janela_logins": args.janela_logins,
+            "produto_quente": args.produto_quente,
+            "semente": args.semente
+        },
+        "vendas": medicoes.vendas,
+        "vendas_por_segundo": round(medicoes.vendas / duracao, 2),
+        "conflitos_estoque": medicoes.conflitos_estoque,
+        "taxa_conflitos_estoque": round(medicoes.conflitos_estoque / max(tentativas, 1), 4),
+        "transacoes_por_venda_maximo": round(
+            (banco_depois["transacoes"] - banco_antes["transacoes"]) / vendas, 2
+        ),
+        "consultas_por_venda_maximo": None if banco_antes["consultas"] is None else round(
+            (banco_depois["consultas"] - banco_antes["consultas"]) / vendas, 2
+        ),
+        "tablets": {
+            "pedidos": args.tablets,
+            "conectados_ao_mesmo_tempo": medicoes.tablets_maximo,
+            "avisos_recebidos": medicoes.avisos
+        },
+        "logins": {
+            "pedidos": args.logins,
+            "aceitos": medicoes.logins[True],
+            "recusados": medicoes.logins[False]
+        },
+        "produto_quente": quente,
+        "rotas": resumir(medicoes, duracao)
+    }
+
+    print(f"\nVendas: {resultado['vendas']} ({resultado['vendas_por_segundo']}/s), "
+          f"conflitos de estoque: {resultado['conflitos_estoque']}")
+    consultas = resultado["consultas_por_venda_maximo"]
+    print(f"Por venda, no máximo (conta todo o banco): "
+          f"{resultado['transacoes_por_venda_maximo']} transações, "
+          + (f"{consultas} consultas" if consultas is not None else "consultas sem pg_stat_statements"))
+
+    if args.tablets:
+        print(f"Tablets conectados ao mesmo tempo: {medicoes.tablets_maximo} de {args.tablets}, "
+              f"avisos de estoque recebidos: {medicoes.avisos}")
+
+    if args.logins:
+        print(f"Logins da abertura: {medicoes.logins[True]} aceitos, {medicoes.logins[False]} recusados")
+
+    if quente:
+        print(f"Vendas/s: {resultado['vendas_por_segundo']} com {len(catalogo)} produtos, "
+              f"{quente['vendas_por_segundo']} com um produto só "
+              f"(conflitos de estoque: {quente['conflitos_estoque']}, /salvar_venda p95 "
+              f"{resultado['rotas'].get('/salvar_venda', {}).get('p95_ms')} → "
+              f"{quente['rotas'].get('/salvar_venda', {}).get('p95_ms')} ms)")
+
+    for rota, medida in resultado["rotas"].items():
+        print(f"  {rota:20} {medida['requisicoes']:6} req  "
+              f"p50 {medida['p50_ms']:7.1f} ms  p95 {medida['p95_ms']:7.1f} ms  "
+              f"p99 {medida['p99_ms']:7.1f} ms  erros {medida['taxa_erros']:.2%}")
+
+    saida = args.saida or f"benchmark-{inicio:%Y%m%d-%H%M%S}.json"
+    with open(saida, "w") as arquivo:
+        json.dump(resultado, arquivo, indent=2, ensure_ascii=False)
+    print(f"\nResultado gravado em {saida}")
+
+    if args.comparar:
+        with open(args.comparar) as arquivo:
+            comparar(resultado, json.load(arquivo))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
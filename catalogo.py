@@ -0,0 +1,132 @@
+import hashlib
+import threading
+
+import psycopg2.extras
+
+import movimentos
+import notificacoes
+from db import conectar
+
+# =========================
+# CATÁLOGO VERSIONADO
+# =========================
+# Cada linha de produtos guarda em "versao" o id da transação que mudou o
+# catálogo dela (descrição, preço, estoque mínimo, cupom; triggers das
+# migrações 7 e 9); produtos apagados ficam em produtos_removidos. Baixa de
+# estoque não conta: o estoque nunca fica no catálogo; vem do estoque que o
+# ouvinte de avisos mantém em dia (estoque(), ver notificacoes.py).
+#
+# A versão entregue ao cliente é o xmin do snapshot da leitura: toda
+# transação abaixo dele já terminou, então "?since=<versao>" devolve tudo
+# que pode ter mudado depois, sem perder commits que chegaram fora de ordem
+# (no máximo repete algum produto, o que é inofensivo).
+#
+# A leitura fica em memória por worker e só é refeita quando o ouvinte de
+# LISTEN/NOTIFY avisa que o catálogo mudou (um admin gravou produtos); sem
+# mudança, nem o banco é consultado. /vendas e os preços das vendas saem
+# daqui.
+
+
+class Catalogo:
+
+    def __init__(self, versao, produtos, removidos):
+        self.versao = versao
+        self.produtos = produtos      # [dict] em ordem de descrição
+        self.removidos = removidos    # {id: versao}
+        self.por_id = {p["id"]: p for p in produtos}
+
+        conteudo = repr((
+            [(p["id"], p["versao"]) for p in produtos],
+            sorted(removidos.items())
+        ))
+        self.etag = hashlib.sha1(conteudo.encode()).hexdigest()
+
+    def desde(self, versao):
+        return (
+            [p for p in self.produtos if p["versao"] >= versao],
+            [i for i, v in self.removidos.items() if v >= versao]
+        )
+
+
+def carregar():
+    with conectar() as conn:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+        # marca d'água lida ANTES dos dados
+        c.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint AS versao")
+        versao = c.fetchone()["versao"]
+
+        c.execute("""
+            SELECT id, descricao, valor, estoque_minimo, imprimir_cupom, versao
+            FROM produtos
+            ORDER BY descricao ASC
+        """)
+        produtos = c.fetchall()
+
+        c.execute("SELECT id, versao FROM produtos_removidos")
+        removidos = {r["id"]: r["versao"] for r in c.fetchall()}
+
+    return Catalogo(versao, produtos, removidos)
+
+
+_cache = None               # (geração do ouvinte, Catalogo)
+_cache_lock = threading.Lock()
+
+
+def obter():
+    global _cache
+
+    geracao = notificacoes.obter_ouvinte().geracao_catalogo()
+
+    with _cache_lock:
+        cache = _cache
+
+    if geracao is not None and cache is not None and cache[0] == geracao:
+        return cache[1]
+
+    # geração lida antes da consulta: um aviso que chegue durante a leitura
+    # já invalida o que foi lido
+    catalogo = carregar()
+
+    if geracao is not None:
+        with _cache_lock:
+            _cache = (geracao, catalogo)
+
+    return catalogo
+
+
+def estoque():
+    # {id: saldo vendável} do ouvinte (atualizado pelos avisos de estoque);
+    # sem LISTEN, das fatias. Não alterar o dict devolvido.
+    estoque = notificacoes.obter_ouvinte().estoque()
+    return movimentos.disponivel() if estoque is None else estoque
+
+
+def produtos_da_venda(c, cat, ids):
+
+    # Descrição, preço e estoque mínimo dos produtos de uma venda, do
+    # catálogo em memória. Produto que o cache ainda não conhece (cadastrado
+    # agora, aviso a caminho) é lido na própria transação.
+    produtos = {id: cat.por_id[id] for id in ids if id in cat.por_id}
+    faltando = sorted(set(ids) - set(produtos))
+
+    if faltando:
+        c.execute("""
+            SELECT id, descricao, valor, estoque_minimo, imprimir_cupom, versao
+            FROM produtos
+            WHERE id = ANY(%s)
+        """, (faltando,))
+        produtos.update((p["id"], p) for p in c.fetchall())
+
+    return produtos
+
+
+def como_json(produto, estoque_atual):
+    return {
+        "id": produto["id"],
+        "descricao": produto["descricao"],
+        "valor": float(produto["valor"]),
+        "estoque_atual": estoque_atual,
+        "estoque_minimo": produto["estoque_minimo"],
+        "imprimir_cupom": produto["imprimir_cupom"]
+    }
@@ -0,0 +1,322 @@
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, fields
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from zoneinfo import ZoneInfo
+
+import resumos
+from db import conectar
+
+# =========================
+# CONSULTAS DO RELATÓRIO DE VENDAS
+# =========================
+# Tela (/relatorios), PDF e Excel usam os mesmos filtros e o mesmo SQL, todos
+# montados aqui. Os filtros viram um Filtros imutável (normalizado), que
+# também é a chave do cache: contagem/total e a lista completa ficam em
+# memória por (filtros, versão das vendas). Qualquer venda gravada ou apagada
+# muda a versão (resumos.nova_versao), então ver o relatório e depois
+# exportar não repete a agregação, e nada desatualizado é reaproveitado.
+
+FUSO = ZoneInfo("America/Manaus")
+
+# resultados guardados por processo
+CACHE_MAX = int(os.getenv("CONSULTAS_CACHE_MAX", "16"))
+
+
+def inicio_do_dia(data, dias=0):
+    # "AAAA-MM-DD" (ou date) -> meia-noite em Manaus (dias=1 dá o início do
+    # dia seguinte). Os filtros usam intervalos semiabertos [início, fim)
+    # direto em data_venda, o que deixa o índice da coluna ser usado
+    # (DATE(data_venda) não deixa).
+    if isinstance(data, str):
+        data = datetime.strptime(data, "%Y-%m-%d").date()
+
+    dia = data + timedelta(days=dias)
+    return datetime(dia.year, dia.month, dia.day, tzinfo=FUSO)
+
+
+# =========================
+# FILTROS
+# =========================
+@dataclass(frozen=True)
+class Filtros:
+    data_inicio: date = None
+    data_fim: date = None
+    forma_pagamento: str = None
+    usuario_id: int = None
+    numero_venda: int = None
+
+    @classmethod
+    def de(cls, origem):
+
+        # origem: request.args, formulário/JSON ou os parâmetros de uma tarefa.
+        # Vazio, "None" (links antigos do relatório) e valores inválidos
+        # valem como "sem filtro".
+        def texto(campo):
+            valor = origem.get(campo)
+            if valor is None:
+                return None
+            valor = str(valor).strip()
+            return None if valor in ("", "None") else valor
+
+        def dia(campo):
+            try:
+                return datetime.strptime(texto(campo), "%Y-%m-%d").date()
+            except (TypeError, ValueError):
+                return None
+
+        def inteiro(campo):
+            try:
+                return int(texto(campo))
+            except (TypeError, ValueError):
+                return None
+
+        return cls(
+            data_inicio=dia("data_inicio"),
+            data_fim=dia("data_fim"),
+            forma_pagamento=texto("forma_pagamento"),
+            usuario_id=inteiro("usuario_id"),
+            numero_venda=inteiro("numero_venda")
+        )
+
+    def como_dict(self):
+        # tudo texto (ou None): serve para JSON de tarefa, template e URL
+        return {
+            campo.name: None if getattr(self, campo.name) is None else str(getattr(self, campo.name))
+            for campo in fields(self)
+        }
+
+    def where(self):
+
+        # trecho "AND ..." sobre vendas v / usuarios u
+        where = ""
+        params = []
+
+        if self.data_inicio:
+            where += " AND v.data_venda >= %s"
+            params.append(inicio_do_dia(self.data_inicio))
+
+        if self.data_fim:
+            where += " AND v.data_venda < %s"
+            params.append(inicio_do_dia(self.data_fim, 1))
+
+        if self.forma_pagamento:
+            where += " AND v.forma_pagamento = %s"
+            params.append(self.forma_pagamento)
+
+        if self.usuario_id is not None:
+            where += " AND v.usuario_id = %s"
+            params.append(self.usuario_id)
+
+        if self.numero_venda is not None:
+            where += " AND v.numero_venda = %s"
+            params.append(self.numero_venda)
+
+        return where, params
+
+
+# =========================
+# RESULTADOS
+# =========================
+@dataclass(frozen=True)
+class Venda:
+    numero_venda: int
+    data_venda: datetime        # horário de Manaus, sem fuso
+    forma_pagamento: str
+    nome_usuario: str
+    valor_total: Decimal
+
+
+@dataclass(frozen=True)
+class Totais:
+    quantidade: int
+    total_geral: Decimal
+
+    # maior texto de cada coluna (larguras da planilha)
+    maior_numero: int
+    maior_forma: int
+    maior_valor: int
+    maior_usuario: int
+
+
+@dataclass(frozen=True)
+class Pagina:
+    totais: Totais
+    vendas: list
+    anterior: int = None        # cursor "depois" da página anterior
+    proxima: int = None         # cursor "antes" da próxima página
+
+
+# mesma ordem dos campos de Venda
+COLUNAS_VENDA = """
+    v.numero_venda,
+    v.data_venda AT TIME ZONE 'America/Manaus' AS data_venda,
+    v.forma_pagamento,
+    u.nome_usuario,
+    v.valor_total
+"""
+
+COLUNAS_TOTAIS = """
+    COUNT(*),
+    COALESCE(SUM(v.valor_total), 0),
+    COALESCE(MAX(length(v.numero_venda::text)), 0),
+    COALESCE(MAX(length(v.forma_pagamento)), 0),
+    COALESCE(MAX(length(v.valor_total::text)), 0),
+    COALESCE(MAX(length(u.nome_usuario)), 0)
+"""
+
+
+def sql_vendas(filtros, cursor="", ordem="DESC"):
+    where, params = filtros.where()
+    return f"""
+        SELECT {COLUNAS_VENDA}
+        FROM vendas v
+        JOIN usuarios u ON u.id = v.usuario_id
+        WHERE 1=1 {where} {cursor}
+        ORDER BY v.numero_venda {ordem}
+    """, params
+
+
+def sql_totais(filtros):
+    where, params = filtros.where()
+    return f"""
+        SELECT {COLUNAS_TOTAIS}
+        FROM vendas v
+        JOIN usuarios u ON u.id = v.usuario_id
+        WHERE 1=1 {where}
+    """, params
+
+
+# =========================
+# CACHE
+# =========================
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _ler(chave):
+    with _cache_lock:
+        valor = _cache.get(chave)
+        if valor is not None:
+            _cache.move_to_end(chave)
+        return valor
+
+
+def _guardar(chave, valor):
+    with _cache_lock:
+        _cache[chave] = valor
+        _cache.move_to_end(chave)
+        while len(_cache) > CACHE_MAX:
+            _cache.popitem(last=False)
+
+
+# =========================
+# CONSULTAS
+# =========================
+def totais(filtros, conn=None):
+
+    # conn: para rodar dentro da transação de quem chamou (ex.: exportação)
+    if conn is None:
+        with conectar() as conn:
+            return totais(filtros, conn)
+
+    # versão lida ANTES dos dados
+    chave = ("totais", filtros, resumos.versao(conn))
+
+    resultado = _ler(chave)
+
+    if resultado is None:
+        c = conn.cursor()
+        c.execute(*sql_totais(filtros))
+        resultado = Totais(*c.fetchone())
+        _guardar(chave, resultado)
+
+    return resultado
+
+
+def vendas(filtros):
+
+    # lista completa, da venda mais nova para a mais antiga (tupla: é compartilhada pelo cache)
+    with conectar() as conn:
+        chave = ("vendas", filtros, resumos.versao(conn))
+
+        resultado = _ler(chave)
+
+        if resultado is None:
+            c = conn.cursor()
+            c.execute(*sql_vendas(filtros))
+            resultado = tuple(Venda(*linha) for linha in c.fetchall())
+            _guardar(chave, resultado)
+
+    return resultado
+
+
+def pagina(filtros, por_pagina, antes=None, depois=None):
+
+    # paginação por chave (keyset) em numero_venda DESC:
+    # antes=N  → vendas mais antigas que N (próxima página)
+    # depois=N → vendas mais novas que N (página anterior)
+    # o índice da chave primária leva direto à página, sem OFFSET
+    cursor = ""
+    params_cursor = []
+    ordem = "DESC"
+
+    if antes is not None:
+        cursor = " AND v.numero_venda < %s"
+        params_cursor.append(antes)
+    elif depois is not None:
+        cursor = " AND v.numero_venda > %s"
+        params_cursor.append(depois)
+        ordem = "ASC"
+
+    sql_pagina, params = sql_vendas(filtros, cursor, ordem)
+    sql_pagina += " LIMIT %s"
+    params = params + params_cursor + [por_pagina + 1]
+
+    with conectar() as conn:
+        chave = ("totais", filtros, resumos.versao(conn))
+        resultado_totais = _ler(chave)
+
+        c = conn.cursor()
+
+        if resultado_totais is not None:
+            c.execute(sql_pagina, params)
+            linhas = c.fetchall()
+        else:
+            # sem cache: contagem/total e a página na mesma ida ao banco
+            # (uma linha com página vazia se não houver vendas)
+            sql_agregado, params_agregado = sql_totais(filtros)
+            c.execute(f"""
+                SELECT t.*, p.*
+                FROM ({sql_agregado}) t
+                LEFT JOIN LATERAL ({sql_pagina}) p ON true
+                ORDER BY p.numero_venda {ordem}
+            """, params_agregado + params)
+            linhas = c.fetchall()
+
+            resultado_totais = Totais(*linhas[0][:6])
+            _guardar(chave, resultado_totais)
+
+            linhas = [linha[6:] for linha in linhas if linha[6] is not None]
+
+    lista = [Venda(*linha) for linha in linhas]
+    tem_mais = len(lista) > por_pagina
+    lista = lista[:por_pagina]
+
+    if ordem == "ASC":
+        lista.reverse()
+
+    # cursores: só existem se houver vendas daquele lado da página
+    anterior = None
+    proxima = None
+
+    if lista:
+        if (ordem == "ASC" and tem_mais) or antes is not None:
+            anterior = lista[0].numero_venda
+
+        if (ordem == "DESC" and tem_mais) or depois is not None:
+            proxima = lista[-1].numero_venda
+
+    return Pagina(resultado_totais, lista, anterior, proxima)
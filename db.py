@@ -0,0 +1,351 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+import lentas
+import metricas
+
+log = logging.getLogger(__name__)
+
+# =========================
+# CONFIGURAÇÃO DO POOL
+# =========================
+POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+POOL_MAX = int(os.getenv("DB_POOL_MAX", "8"))
+
+# tempo máximo (s) que uma requisição espera por uma conexão livre
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+
+# conexão parada há mais tempo que isso faz um SELECT 1 antes de ser entregue
+POOL_VERIFICAR_APOS = float(os.getenv("DB_POOL_VERIFICAR_APOS", "30"))
+
+# conexões mais velhas que isso são recicladas (evita conexões "eternas")
+POOL_VIDA_MAXIMA = float(os.getenv("DB_POOL_VIDA_MAXIMA", "1800"))
+
+SSLMODE = os.getenv("DATABASE_SSLMODE", "require")
+FUSO_HORARIO = "America/Manaus"
+
+
+class PoolEsgotado(psycopg2.OperationalError):
+    pass
+
+
+# =========================
+# MODO COOPERATIVO (GEVENT)
+# =========================
+# Com WEB_MODO=gevent (gunicorn.conf.py) o worker corrige socket, select,
+# time e threading antes de importar o app: threads viram greenlets e os
+# locks/condições do pool passam a ceder a vez em vez de travar o worker.
+# O psycopg2 conversa com o banco em C, fora do socket do Python; sem o
+# callback de espera do psycogreen, cada consulta pararia todos os
+# greenlets do processo.
+def _ativar_modo_cooperativo():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+
+    if not monkey.is_module_patched("socket"):
+        return False
+
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+    return True
+
+
+COOPERATIVO = _ativar_modo_cooperativo()
+
+
+def abrir_conexao(dsn=None, connection_factory=None):
+    try:
+        return psycopg2.connect(
+            dsn or os.getenv("DATABASE_URL"),
+            sslmode=SSLMODE,
+            # fuso definido no handshake: dispensa o SET TIME ZONE a cada uso
+            options=f"-c timezone={FUSO_HORARIO}",
+            connect_timeout=10,
+            connection_factory=connection_factory
+        )
+    except Exception:
+        log.exception("ERRO GRAVE AO CONECTAR NO POSTGRES")
+        raise
+
+
+# =========================
+# CURSORES MEDIDOS
+# =========================
+# As conexões do pool entregam cursores que contam e cronometram cada
+# comando (metricas.registrar_consulta), seja qual for a classe de cursor
+# pedida (padrão, RealDictCursor, cursor nomeado...). Com CONSULTAS_LENTAS_MS
+# ligado, os comandos lentos também vão para o log de lentas.py.
+class CursorMedido:
+
+    def execute(self, query, vars=None):
+        inicio = time.perf_counter()
+        try:
+            resultado = super().execute(query, vars)
+        finally:
+            duracao = time.perf_counter() - inicio
+            metricas.registrar_consulta(duracao)
+
+        if lentas.ativo(duracao):
+            lentas.registrar(self.connection, query, vars, duracao)
+
+        return resultado
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+
+        inicio = time.perf_counter()
+        try:
+            resultado = super().executemany(query, vars_list)
+        finally:
+            duracao = time.perf_counter() - inicio
+            metricas.registrar_consulta(duracao)
+
+        # o lote inteiro conta como um comando; o log guarda (e explica)
+        # os parâmetros da primeira linha
+        if lentas.ativo(duracao) and vars_list:
+            lentas.registrar(self.connection, query, vars_list[0], duracao)
+
+        return resultado
+
+
+_cursores_medidos = {}
+
+
+def _cursor_medido(classe):
+    medido = _cursores_medidos.get(classe)
+    if medido is None:
+        medido = _cursores_medidos[classe] = type(classe.__name__ + "Medido", (CursorMedido, classe), {})
+    return medido
+
+
+class ConexaoMedida(psycopg2.extensions.connection):
+
+    def cursor(self, *args, **kwargs):
+        classe = kwargs.get("cursor_factory") or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs["cursor_factory"] = _cursor_medido(classe)
+        return super().cursor(*args, **kwargs)
+
+
+# =========================
+# POOL DE CONEXÕES
+# =========================
+class PoolConexoes:
+
+    def __init__(self, dsn, minimo=POOL_MIN, maximo=POOL_MAX, timeout=POOL_TIMEOUT):
+        self.dsn = dsn
+        self.minimo = max(0, minimo)
+        self.maximo = max(1, maximo, self.minimo)
+        self.timeout = timeout
+        self.pid = os.getpid()
+
+        self._cond = threading.Condition()
+        self._livres = []          # [(conn, devolvida_em)]
+        self._nascimento = {}      # conn -> criada_em
+        self._em_uso = 0
+        self._aguardando = 0
+        self._criadas = 0
+        self._recicladas = 0
+
+    # ---------- abertura / descarte ----------
+    def _abrir(self):
+        conn = abrir_conexao(self.dsn, ConexaoMedida)
+
+        with self._cond:
+            self._criadas += 1
+            self._nascimento[conn] = time.monotonic()
+
+        return conn
+
+    def _fechar(self, conn):
+        with self._cond:
+            self._nascimento.pop(conn, None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _saudavel(self, conn, devolvida_em):
+        if conn.closed:
+            return False
+
+        agora = time.monotonic()
+
+        if agora - self._nascimento.get(conn, agora) > POOL_VIDA_MAXIMA:
+            return False
+
+        if agora - devolvida_em > POOL_VERIFICAR_APOS:
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT 1")
+                cur.close()
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+
+        return True
+
+    def aquecer(self):
+        # abre o mínimo configurado logo no primeiro uso do processo
+        while True:
+            with self._cond:
+                if len(self._livres) + self._em_uso >= self.minimo:
+                    return
+                self._em_uso += 1
+            try:
+                conn = self._abrir()
+            except Exception:
+                with self._cond:
+                    self._em_uso -= 1
+                return
+            self.devolver(conn)
+
+    # ---------- empréstimo ----------
+    def obter(self):
+        prazo = time.monotonic() + self.timeout
+        conn = None
+        devolvida_em = None
+
+        with self._cond:
+            while True:
+                if self._livres:
+                    conn, devolvida_em = self._livres.pop()
+                    self._em_uso += 1
+                    break
+
+                if self._em_uso + len(self._livres) < self.maximo:
+                    # reserva a vaga; a conexão é aberta fora do lock
+                    self._em_uso += 1
+                    break
+
+                restante = prazo - time.monotonic()
+                if restante <= 0:
+                    raise PoolEsgotado(
+                        f"Nenhuma conexão livre em {self.timeout}s "
+                        f"(máximo {self.maximo})"
+                    )
+
+                self._aguardando += 1
+                try:
+                    self._cond.wait(restante)
+                finally:
+                    self._aguardando -= 1
+
+        try:
+            if conn is not None and not self._saudavel(conn, devolvida_em):
+                self._fechar(conn)
+                with self._cond:
+                    self._recicladas += 1
+                conn = None
+
+            if conn is None:
+                conn = self._abrir()
+
+        except Exception:
+            with self._cond:
+                self._em_uso -= 1
+                self._cond.notify()
+            raise
+
+        return conn
+
+    def devolver(self, conn):
+        descartar = bool(conn.closed)
+
+        if not descartar:
+            try:
+                # nunca devolve ao pool uma transação aberta ou abortada
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                descartar = True
+
+        if descartar:
+            self._fechar(conn)
+
+        with self._cond:
+            self._em_uso -= 1
+            if not descartar:
+                self._livres.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def fechar_todas(self):
+        with self._cond:
+            livres = [conn for conn, _ in self._livres]
+            self._livres = []
+        for conn in livres:
+            self._fechar(conn)
+
+    def estatisticas(self):
+        with self._cond:
+            return {
+                "modo": "gevent" if COOPERATIVO else "threads",
+                "minimo": self.minimo,
+                "maximo": self.maximo,
+                "em_uso": self._em_uso,
+                "livres": len(self._livres),
+                "aguardando": self._aguardando,
+                "criadas": self._criadas,
+                "recicladas": self._recicladas
+            }
+
+
+# =========================
+# POOL DO PROCESSO
+# =========================
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def obter_pool():
+    global _pool
+
+    # cada worker do gunicorn (fork) precisa do seu próprio pool
+    if _pool is None or _pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = PoolConexoes(os.getenv("DATABASE_URL"))
+                _pool.aquecer()
+
+    return _pool
+
+
+@contextmanager
+def conectar():
+    pool = obter_pool()
+
+    inicio = time.perf_counter()
+    conn = pool.obter()
+    metricas.registrar_espera_conexao(time.perf_counter() - inicio)
+
+    try:
+        yield conn
+    finally:
+        pool.devolver(conn)
+
+
+def estatisticas_pool():
+    return obter_pool().estatisticas()
+
+
+def _medidores_pool():
+    # só o pool deste processo; nada a informar antes do primeiro uso
+    if _pool is None or _pool.pid != os.getpid():
+        return {}
+
+    estatisticas = _pool.estatisticas()
+    return {
+        "quermesse_db_pool_em_uso": estatisticas["em_uso"],
+        "quermesse_db_pool_livres": estatisticas["livres"],
+        "quermesse_db_pool_aguardando": estatisticas["aguardando"]
+    }
+
+
+metricas.registrar_medidores(_medidores_pool)
@@ -0,0 +1,121 @@
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill, Alignment
+from openpyxl.utils import get_column_letter
+
+import consultas
+
+# =========================
+# EXPORTAÇÃO EXCEL (STREAMING)
+# =========================
+# Workbook em modo write-only + cursor nomeado (lado do servidor): as vendas
+# vêm do banco em lotes e vão direto para o arquivo, sem montar a planilha
+# inteira em memória.
+
+LOTE_CURSOR = 2000
+
+MIME_XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+CABECALHO = ["ID Venda", "Data", "Forma Pagamento", "Valor Total", "Usuário"]
+
+# "dd/mm/aaaa hh:mm:ss"
+LARGURA_DATA = 19
+
+
+def _larguras(totais):
+
+    # No modo write-only as larguras vão no início da planilha, antes das
+    # linhas; por isso o maior texto de cada coluna vem da agregação do
+    # relatório (consultas.totais), feita antes de abrir o cursor.
+    dados = [
+        totais.maior_numero,
+        LARGURA_DATA,
+        totais.maior_forma,
+        max(totais.maior_valor, len(str(totais.total_geral))),
+        totais.maior_usuario
+    ]
+
+    return [max(len(titulo), tamanho) + 2 for titulo, tamanho in zip(CABECALHO, dados)]
+
+
+def excel_vendas(conn, filtros, destino, progresso=None):
+
+    # filtros: consultas.Filtros
+    # destino: caminho ou arquivo binário aberto
+    # progresso: função opcional chamada com a fração já escrita (0 a 1)
+    c = conn.cursor()
+
+    # mesma foto do banco para as larguras e para as linhas (a agregação
+    # pode vir do cache, se a mesma busca já foi feita nessa versão das vendas)
+    c.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+
+    totais = consultas.totais(filtros, conn)
+    quantidade = max(totais.quantidade, 1)
+    larguras = _larguras(totais)
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+
+    for coluna, largura in enumerate(larguras, start=1):
+        ws.column_dimensions[get_column_letter(coluna)].width = largura
+
+    # ===== ESTILO DO CABEÇALHO =====
+    bold_font = Font(bold=True)
+    fill_gray = PatternFill(start_color="DDDDDD",
+                            end_color="DDDDDD",
+                            fill_type="solid")
+
+    linha = []
+    for titulo in CABECALHO:
+        cell = WriteOnlyCell(ws, value=titulo)
+        cell.font = bold_font
+        cell.fill = fill_gray
+        linha.append(cell)
+    ws.append(linha)
+
+    # ===== DADOS =====
+    cursor_vendas = conn.cursor(name="exportacao_excel_vendas")
+    cursor_vendas.itersize = LOTE_CURSOR
+
+    cursor_vendas.execute(*consultas.sql_vendas(filtros))
+
+    total_geral = 0
+    linhas = 1
+
+    for v in cursor_vendas:
+        valor = float(v[4])
+        total_geral += valor
+        linhas += 1
+
+        if progresso and linhas % LOTE_CURSOR == 0:
+            progresso((linhas - 1) / quantidade)
+
+        ws.append([
+            v[0],
+            v[1].strftime("%d/%m/%Y %H:%M:%S"),
+            v[2],
+            valor,
+            v[3]
+        ])
+
+    cursor_vendas.close()
+    conn.rollback()
+
+    # ===== LINHA DO TOTAL =====
+    linha_total = linhas + 1
+
+    rotulo = WriteOnlyCell(ws, value="Total das vendas")
+    rotulo.font = Font(bold=True)
+    rotulo.alignment = Alignment(horizontal="right")
+
+    valor_total = WriteOnlyCell(ws, value=total_geral)
+    valor_total.font = Font(bold=True)
+    valor_total.alignment = Alignment(horizontal="center")
+
+    ws.append([rotulo, None, None, valor_total, None])
+
+    # Mesclar A+B+C e D+E
+    ws.merged_cells.add(f"A{linha_total}:C{linha_total}")
+    ws.merged_cells.add(f"D{linha_total}:E{linha_total}")
+
+    wb.save(destino)
@@ -0,0 +1,293 @@
+import sys
+from datetime import datetime, timedelta
+
+import psycopg2.extras
+
+import resumos
+from consultas import FUSO, inicio_do_dia
+from db import conectar
+
+# =========================
+# FECHAMENTO DE DIAS ENCERRADOS
+# =========================
+# Um dia que já terminou só muda se alguma venda dele for apagada. "Fechar o
+# dia" grava uma fotografia por (forma de pagamento, operador) em
+# "fechamentos", e o fechamento desse dia passa a ler só essas linhas (índice
+# por data) em vez de agregar as vendas de novo.
+#
+# O fechamento de um período (um dia ou vários) é uma consulta só, que junta
+# as fotografias dos dias fechados com as vendas dos dias abertos.
+#
+# Apagar uma venda de um dia fechado (ou gravar nele uma venda atrasada da
+# fila offline) refaz a fotografia do dia na mesma transação: o commit
+# grava as duas coisas juntas, e ninguém lê uma fotografia velha.
+
+# agregação das vendas de um período, no mesmo formato das linhas de
+# "fechamentos" (dia no fuso da quermesse)
+SQL_VENDAS = """
+    SELECT (v.data_venda AT TIME ZONE %(fuso)s)::date AS data,
+           v.forma_pagamento,
+           v.usuario_id,
+           u.nome_usuario,
+           COUNT(*) AS vendas,
+           SUM(v.valor_total) AS total,
+           SUM(COALESCE(v.troco, 0)) AS total_troco
+    FROM vendas v
+    LEFT JOIN usuarios u ON u.id = v.usuario_id
+    WHERE v.data_venda >= %(inicio)s AND v.data_venda < %(fim)s
+    GROUP BY 1, v.forma_pagamento, v.usuario_id, u.nome_usuario
+"""
+
+# fechamento de um período numa consulta só: dias fechados vêm da
+# fotografia, os demais das vendas. Só os dias abertos vão a "vendas", cada
+# um pelo seu intervalo [início, fim) no índice de data_venda; período todo
+# fechado não lê venda nenhuma. Os GROUPING SETS devolvem, juntos, os
+# subtotais por dia e forma, por dia, por forma, por operador e o total
+# geral; "nivel" (GROUPING) diz qual é qual.
+SQL_PERIODO = """
+    WITH fechados AS MATERIALIZED (
+        SELECT data
+        FROM dias_fechados
+        WHERE data >= %(de)s AND data <= %(ate)s
+    ), abertos AS MATERIALIZED (
+        SELECT dia::date AS data,
+               dia::timestamp AT TIME ZONE %(fuso)s AS inicio,
+               (dia + interval '1 day')::timestamp AT TIME ZONE %(fuso)s AS fim
+        FROM generate_series(%(de)s::date, %(ate)s::date, interval '1 day') dia
+        WHERE dia::date NOT IN (SELECT data FROM fechados)
+    ), linhas AS (
+        SELECT f.data, f.forma_pagamento, f.usuario_id, f.nome_usuario,
+               f.vendas, f.total, f.total_troco, TRUE AS fechado
+        FROM fechamentos f
+        JOIN fechados USING (data)
+
+        UNION ALL
+
+        SELECT a.data, v.forma_pagamento, v.usuario_id, u.nome_usuario,
+               COUNT(*), SUM(v.valor_total), SUM(COALESCE(v.troco, 0)), FALSE
+        FROM abertos a
+        JOIN vendas v ON v.data_venda >= a.inicio AND v.data_venda < a.fim
+        LEFT JOIN usuarios u ON u.id = v.usuario_id
+        GROUP BY a.data, v.forma_pagamento, v.usuario_id, u.nome_usuario
+    )
+    SELECT GROUPING(data, forma_pagamento, usuario_id) AS nivel,
+           data,
+           forma_pagamento,
+           usuario_id,
+           MAX(nome_usuario) AS nome_usuario,
+           COALESCE(SUM(vendas), 0)::int AS vendas,
+           COALESCE(SUM(total), 0)::numeric(12,2) AS total,
+           COALESCE(SUM(total_troco), 0)::numeric(12,2) AS total_troco,
+           bool_and(fechado) AS fechado
+    FROM linhas
+    GROUP BY GROUPING SETS (
+        (data, forma_pagamento),
+        (data),
+        (forma_pagamento),
+        (usuario_id),
+        ()
+    )
+    ORDER BY nivel, data, forma_pagamento, total DESC
+"""
+
+# GROUPING(data, forma_pagamento, usuario_id): bit ligado = coluna agregada
+NIVEL_DIA_FORMA = 0b001
+NIVEL_DIA = 0b011
+NIVEL_FORMA = 0b101
+NIVEL_OPERADOR = 0b110
+NIVEL_TOTAL = 0b111
+
+# colunas que valem em cada nível (as demais vêm nulas ou sem sentido)
+COLUNAS = {
+    NIVEL_DIA_FORMA: ("forma_pagamento",),
+    NIVEL_DIA: ("data", "fechado"),
+    NIVEL_FORMA: ("forma_pagamento",),
+    NIVEL_OPERADOR: ("usuario_id", "nome_usuario"),
+    NIVEL_TOTAL: (),
+}
+
+SOMAS = ("vendas", "total", "total_troco")
+
+# chave do pg_advisory_xact_lock por dia (com o dia como segunda chave):
+# quem altera vendas de um dia pega a trava compartilhada, quem fecha o dia
+# pega a exclusiva, então o fechamento não fotografa no meio de uma exclusão
+LOCK_DIA = 7_300_004
+
+
+def hoje():
+    return datetime.now(FUSO).date()
+
+
+def como_data(data):
+    if isinstance(data, str):
+        return datetime.strptime(data, "%Y-%m-%d").date()
+    return data
+
+
+def pode_fechar(data):
+    # só dias que já terminaram: vendas novas sempre entram no dia de hoje
+    return como_data(data) < hoje()
+
+
+def parametros(de, ate=None):
+    de = como_data(de)
+    ate = como_data(ate) if ate is not None else de
+    return {
+        "de": de,
+        "ate": ate,
+        "inicio": inicio_do_dia(de),
+        "fim": inicio_do_dia(ate, 1),
+        "fuso": FUSO.key
+    }
+
+
+def fotografar(c, data):
+    c.execute("DELETE FROM fechamentos WHERE data = %(de)s", parametros(data))
+    c.execute(f"""
+        INSERT INTO fechamentos
+            (data, forma_pagamento, usuario_id, nome_usuario, vendas, total, total_troco)
+        SELECT d.*
+        FROM ({SQL_VENDAS}) d
+    """, parametros(data))
+
+
+def fechar(conn, data, usuario_id=None):
+
+    # devolve False se o dia ainda não terminou ou já estava fechado
+    if not pode_fechar(data):
+        return False
+
+    c = conn.cursor()
+    c.execute(
+        "SELECT pg_advisory_xact_lock(%s, %s::date - DATE '2000-01-01')",
+        (LOCK_DIA, como_data(data))
+    )
+    c.execute("""
+        INSERT INTO dias_fechados (data, fechado_por)
+        VALUES (%s, %s)
+        ON CONFLICT (data) DO NOTHING
+        RETURNING data
+    """, (como_data(data), usuario_id))
+
+    if c.fetchone() is None:
+        conn.rollback()
+        return False
+
+    fotografar(c, data)
+    conn.commit()
+    return True
+
+
+def vendas_alteradas(c, datas_venda):
+
+    # chamar na transação que grava ou apaga vendas dessas datas, depois da
+    # mudança; refaz ali mesmo a fotografia dos dias que estavam fechados.
+    # As linhas de dias_fechados são travadas primeiro (em ordem de data),
+    # então duas alterações no mesmo dia fotografam uma depois da outra.
+    datas = sorted({d.astimezone(FUSO).date() for d in datas_venda})
+
+    cur = c.connection.cursor()
+    cur.execute("""
+        SELECT pg_advisory_xact_lock_shared(%s, d - DATE '2000-01-01')
+        FROM unnest(%s::date[]) AS d
+        ORDER BY d
+    """, (LOCK_DIA, datas))
+    cur.execute("""
+        UPDATE dias_fechados
+        SET gerado_em = clock_timestamp()
+        WHERE data IN (
+            SELECT data
+            FROM dias_fechados
+            WHERE data = ANY(%s)
+            ORDER BY data
+            FOR UPDATE
+        )
+        RETURNING data
+    """, (datas,))
+    dias = sorted(linha[0] for linha in cur.fetchall())
+
+    for data in dias:
+        fotografar(cur, data)
+
+    return dias
+
+
+def fechados(conn, de, ate):
+
+    # {data: linha de dias_fechados} dos dias fechados do período
+    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    c.execute("""
+        SELECT data, fechado_em, gerado_em
+        FROM dias_fechados
+        WHERE data >= %(de)s AND data <= %(ate)s
+        ORDER BY data
+    """, parametros(de, ate))
+    return {d["data"]: d for d in c.fetchall()}
+
+
+def versao(conn, de, ate):
+
+    # período todo fechado só muda quando alguma fotografia é refeita;
+    # senão vale a versão das vendas
+    dias = fechados(conn, de, ate)
+
+    if len(dias) == (como_data(ate) - como_data(de)).days + 1:
+        return ("fechado", max(d["gerado_em"] for d in dias.values()))
+
+    return resumos.versao(conn)
+
+
+def periodo(conn, de, ate):
+
+    # subtotais já somados pelo banco; aqui só se separa cada nível
+    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    c.execute(SQL_PERIODO, parametros(de, ate))
+
+    dias = {}
+    formas = []
+    operadores = []
+    total = None
+
+    for linha in c.fetchall():
+        nivel = linha["nivel"]
+        r = {k: linha[k] for k in COLUNAS[nivel] + SOMAS}
+
+        if nivel == NIVEL_DIA_FORMA:
+            dias.setdefault(linha["data"], {"formas": []})["formas"].append(r)
+        elif nivel == NIVEL_DIA:
+            dias.setdefault(linha["data"], {"formas": []}).update(r)
+        elif nivel == NIVEL_FORMA:
+            formas.append(r)
+        elif nivel == NIVEL_OPERADOR:
+            operadores.append(r)
+        elif nivel == NIVEL_TOTAL:
+            total = r
+
+    return {
+        "de": como_data(de),
+        "ate": como_data(ate),
+        "dias": [dias[d] for d in sorted(dias)],
+        "formas": formas,
+        "operadores": operadores,
+        "total": total
+    }
+
+
+def zerar(c):
+    c.execute("TRUNCATE TABLE fechamentos, dias_fechados")
+
+
+if __name__ == "__main__":
+    # python fechamentos.py             -> fecha o dia de ontem
+    # python fechamentos.py AAAA-MM-DD  -> fecha o dia informado
+    argumentos = sys.argv[1:]
+    data = como_data(argumentos[0]) if argumentos else hoje() - timedelta(days=1)
+
+    with conectar() as conn:
+        if fechar(conn, data):
+            print(f"Dia {data:%d/%m/%Y} fechado.")
+        elif not pode_fechar(data):
+            print(f"Dia {data:%d/%m/%Y} ainda não terminou.")
+            sys.exit(1)
+        else:
+            print(f"Dia {data:%d/%m/%Y} já estava fechado.")
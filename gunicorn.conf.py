@@ -0,0 +1,52 @@
+import os
+
+# =========================
+# CONFIGURAÇÃO DO GUNICORN
+# =========================
+# WEB_MODO=threads (padrão): workers gthread com WEB_THREADS threads. Cada
+#   requisição em andamento ocupa uma thread, inclusive cada tablet parado
+#   em /estoque/stream; com todas ocupadas, as vendas esperam na fila.
+#
+# WEB_MODO=gevent: workers cooperativos (greenlets), até WEB_CONEXOES
+#   conexões por worker. Um stream parado custa alguns KB, não uma thread.
+#   O banco continua limitado pelo pool (DB_POOL_MAX, db.py), e o psycopg2
+#   cede a vez enquanto espera o PostgreSQL. A senha do login é conferida
+#   em outro processo (acesso.py), mas gerar PDF ainda segura o worker
+#   enquanto roda: por isso os relatórios saem do processo "worker" do
+#   Procfile (python tarefas.py), e não dos workers web.
+#
+# Comparação dos dois modos: python benchmark.py --tablets N (ver o arquivo)
+
+MODO = os.getenv("WEB_MODO", "threads")
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+# cada worker importa o app depois de se preparar (no gevent, depois de
+# corrigir os módulos); com preload o app seria importado antes
+preload_app = False
+
+if MODO == "gevent":
+    worker_class = "gevent"
+    worker_connections = int(os.getenv("WEB_CONEXOES", "1000"))
+elif MODO == "threads":
+    worker_class = "gthread"
+    threads = int(os.getenv("WEB_THREADS", "32"))
+else:
+    raise ValueError(f"WEB_MODO inválido: {MODO!r} (use threads ou gevent)")
+
+
+# retrato de métricas (metricas.py) do worker que saiu vai para o total dos
+# aposentados; o diretório do master some junto com ele
+def child_exit(server, worker):
+    import metricas
+    metricas.aposentar(worker.pid, metricas.diretorio(server.pid))
+
+
+def on_exit(server):
+    import shutil
+    import metricas
+
+    # um METRICAS_DIR fixo é do operador: fica
+    if not os.getenv("METRICAS_DIR"):
+        shutil.rmtree(metricas.diretorio(server.pid), ignore_errors=True)
@@ -0,0 +1,234 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+from datetime import datetime
+
+import psycopg2
+import psycopg2.extensions
+
+import metricas
+
+log = logging.getLogger(__name__)
+
+# =========================
+# LOG DE CONSULTAS LENTAS
+# =========================
+# Opcional: com CONSULTAS_LENTAS_MS definido, todo comando dos cursores do
+# pool (db.CursorMedido) que passar desse tempo vira uma linha JSON em
+# CONSULTAS_LENTAS_ARQUIVO, com rota, parâmetros e duração.
+#
+# Comandos iguais a menos dos valores (mesma "impressão") formam um grupo.
+# Na primeira vez que um grupo aparece em cada processo, o plano é capturado
+# na mesma conexão e transação, dentro de um SAVEPOINT desfeito em seguida:
+# SELECTs sem efeito colateral com EXPLAIN (ANALYZE, BUFFERS); o resto só
+# com EXPLAIN, sem executar de novo.
+#
+# /consultas_lentas (administrador) mostra os grupos que mais custaram.
+
+LIMITE_MS = float(os.getenv("CONSULTAS_LENTAS_MS", "0"))
+
+ARQUIVO = os.getenv("CONSULTAS_LENTAS_ARQUIVO") or os.path.join(
+    tempfile.gettempdir(), "quermesse-consultas-lentas.jsonl"
+)
+
+# quanto do fim do arquivo a página lê (bytes)
+LER_MAXIMO = int(os.getenv("CONSULTAS_LENTAS_LER_MAX", str(5 * 1024 * 1024)))
+
+# o EXPLAIN ANALYZE roda a consulta de novo: limite de tempo para ele
+TEMPO_MAXIMO_EXPLAIN_MS = 30000
+
+# chamadas que não podem ser repetidas por um EXPLAIN ANALYZE
+EFEITO_COLATERAL = re.compile(
+    r"\b(nextval|setval|pg_(try_)?advisory\w*|pg_notify"
+    r"|for\s+(no\s+key\s+)?update|for\s+(key\s+)?share)\b",
+    re.IGNORECASE
+)
+
+_lock = threading.Lock()
+_explicadas = set()            # impressões com plano já capturado (por processo)
+_explicadas_pid = None
+
+
+def ativo(segundos):
+    return LIMITE_MS > 0 and segundos * 1000 >= LIMITE_MS
+
+
+# =========================
+# IMPRESSÃO DO COMANDO
+# =========================
+_COMENTARIO = re.compile(r"--[^\n]*")
+_TEXTO = re.compile(r"'(?:[^']|'')*'")
+_NUMERO = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PARAMETRO = re.compile(r"%(?:\(\w+\))?s")
+_LISTA = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_LISTAS = re.compile(r"\(\?\)(?:\s*,\s*\(\?\))+")
+_ESPACOS = re.compile(r"\s+")
+
+
+def normalizar(sql):
+    # valores viram "?", listas (IN, VALUES do execute_values) viram uma só
+    sql = _COMENTARIO.sub(" ", sql)
+    sql = _TEXTO.sub("?", sql)
+    sql = _PARAMETRO.sub("?", sql)
+    sql = _NUMERO.sub("?", sql)
+    sql = _LISTA.sub("(?)", sql)
+    sql = _LISTAS.sub("(?)", sql)
+    return _ESPACOS.sub(" ", sql).strip().lower()
+
+
+def impressao(sql_normalizado):
+    return hashlib.sha1(sql_normalizado.encode()).hexdigest()[:12]
+
+
+# =========================
+# REGISTRO
+# =========================
+def _primeira_vez(chave):
+    global _explicadas, _explicadas_pid
+
+    with _lock:
+        if _explicadas_pid != os.getpid():
+            _explicadas, _explicadas_pid = set(), os.getpid()
+
+        if chave in _explicadas:
+            return False
+
+        _explicadas.add(chave)
+        return True
+
+
+def _explicar(conn, query, vars, somente_leitura):
+
+    # cursor base (sem medição): o EXPLAIN não conta nem se registra de novo
+    c = psycopg2.extensions.cursor(conn)
+
+    opcoes = "ANALYZE, BUFFERS, FORMAT TEXT" if somente_leitura else "FORMAT TEXT"
+
+    c.execute("SAVEPOINT consulta_lenta")
+    try:
+        c.execute(f"SET LOCAL statement_timeout = {TEMPO_MAXIMO_EXPLAIN_MS}")
+        c.execute(f"EXPLAIN ({opcoes}) {query}", vars)
+        return "\n".join(linha[0] for linha in c.fetchall())
+    except psycopg2.Error as e:
+        return f"(EXPLAIN falhou: {e.pgerror or e})"
+    finally:
+        # desfaz tudo o que o EXPLAIN fez, inclusive o SET LOCAL
+        c.execute("ROLLBACK TO SAVEPOINT consulta_lenta")
+        c.execute("RELEASE SAVEPOINT consulta_lenta")
+        c.close()
+
+
+def registrar(conn, query, vars, segundos):
+
+    try:
+        if isinstance(query, bytes):
+            query = query.decode("utf-8", "replace")
+
+        sql_normalizado = normalizar(query)
+        chave = impressao(sql_normalizado)
+
+        registro = {
+            "momento": datetime.now().isoformat(timespec="milliseconds"),
+            "pid": os.getpid(),
+            "rota": metricas.rota_atual(),
+            "impressao": chave,
+            "duracao_ms": round(segundos * 1000, 2),
+            "sql_normalizado": sql_normalizado,
+            "sql": query,
+            "parametros": vars
+        }
+
+        # só explica com a transação em bom estado (e não em autocommit)
+        if (
+            _primeira_vez(chave)
+            and not conn.autocommit
+            and conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        ):
+            somente_leitura = (
+                sql_normalizado.startswith(("select", "with"))
+                and " insert " not in f" {sql_normalizado} "
+                and " update " not in f" {sql_normalizado} "
+                and " delete " not in f" {sql_normalizado} "
+                and not EFEITO_COLATERAL.search(sql_normalizado)
+            )
+            registro["plano_analisado"] = somente_leitura
+            registro["plano"] = _explicar(conn, query, vars, somente_leitura)
+
+        linha = json.dumps(registro, ensure_ascii=False, default=str) + "\n"
+
+        # uma escrita por linha em modo append: processos não se misturam
+        with _lock, open(ARQUIVO, "a", encoding="utf-8") as arquivo:
+            arquivo.write(linha)
+
+    except Exception:
+        # o log nunca pode derrubar a requisição
+        log.exception("ERRO NO LOG DE CONSULTAS LENTAS")
+
+
+# =========================
+# LEITURA (página do administrador)
+# =========================
+def piores(limite=50):
+
+    try:
+        with open(ARQUIVO, "rb") as arquivo:
+            arquivo.seek(0, os.SEEK_END)
+            tamanho = arquivo.tell()
+            arquivo.seek(max(0, tamanho - LER_MAXIMO))
+            conteudo = arquivo.read()
+    except FileNotFoundError:
+        return []
+
+    # começou no meio de uma linha: descarta a primeira
+    linhas = conteudo.split(b"\n")
+    if tamanho > LER_MAXIMO:
+        linhas = linhas[1:]
+
+    grupos = {}
+
+    for linha in linhas:
+        try:
+            registro = json.loads(linha)
+        except ValueError:
+            continue
+
+        grupo = grupos.get(registro["impressao"])
+        if grupo is None:
+            grupo = grupos[registro["impressao"]] = {
+                "impressao": registro["impressao"],
+                "sql_normalizado": registro["sql_normalizado"],
+                "vezes": 0,
+                "total_ms": 0,
+                "max_ms": 0,
+                "rotas": set(),
+                "ultima": None,
+                "pior": None,
+                "plano": None,
+                "plano_analisado": None
+            }
+
+        grupo["vezes"] += 1
+        grupo["total_ms"] += registro["duracao_ms"]
+        grupo["rotas"].add(registro["rota"])
+        grupo["ultima"] = registro["momento"]
+
+        if registro["duracao_ms"] >= grupo["max_ms"]:
+            grupo["max_ms"] = registro["duracao_ms"]
+            grupo["pior"] = registro
+
+        if registro.get("plano"):
+            grupo["plano"] = registro["plano"]
+            grupo["plano_analisado"] = registro.get("plano_analisado")
+
+    resultado = sorted(grupos.values(), key=lambda g: g["total_ms"], reverse=True)[:limite]
+
+    for grupo in resultado:
+        grupo["media_ms"] = round(grupo["total_ms"] / grupo["vezes"], 2)
+        grupo["total_ms"] = round(grupo["total_ms"], 2)
+        grupo["rotas"] = sorted(r or "segundo_plano" for r in grupo["rotas"])
+
+    return resultado
@@ -0,0 +1,426 @@
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# =========================
+# MÉTRICAS (PROMETHEUS)
+# =========================
+# Cada processo (worker do gunicorn) conta as próprias requisições e
+# consultas em memória e grava um retrato em <METRICAS_DIR>/<pid>.json a cada
+# INTERVALO segundos. O /metrics, atendido por qualquer worker, soma os
+# arquivos de todos: contadores e histogramas de workers que já morreram
+# continuam somando (não podem voltar para trás); medidores (requisições em
+# andamento, pool) só contam de processos vivos.
+#
+# Quando um worker sai, o gunicorn (child_exit, gunicorn.conf.py) soma o
+# retrato dele em <METRICAS_DIR>/aposentados.json e apaga o arquivo do pid:
+# o diretório não cresce a cada worker reciclado.
+
+
+# um diretório por gunicorn master: workers do mesmo servidor se enxergam,
+# e um reinício começa do zero
+def diretorio(pid_master):
+    return os.getenv("METRICAS_DIR") or os.path.join(
+        tempfile.gettempdir(), f"quermesse-metricas-{pid_master}"
+    )
+
+
+def _pasta():
+    # resolvida a cada uso: o master importa este módulo (child_exit) antes
+    # de criar workers novos, e eles herdam o módulo já carregado
+    return diretorio(os.getppid())
+
+
+APOSENTADOS = "aposentados.json"
+
+INTERVALO = float(os.getenv("METRICAS_INTERVALO", "2"))
+
+# limites (le) dos histogramas
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BUCKETS_CONSULTAS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+BUCKETS_ESPERA = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+# consultas feitas fora de uma requisição (tarefas, ouvinte, aquecimento)
+ROTA_SEGUNDO_PLANO = "segundo_plano"
+
+DESCRICOES = {
+    "quermesse_requisicoes_total": ("counter", "Requisições atendidas por rota, método e status."),
+    "quermesse_requisicao_segundos": ("histogram", "Tempo de resposta por rota (até os cabeçalhos)."),
+    "quermesse_requisicoes_em_andamento": ("gauge", "Requisições sendo atendidas agora."),
+    "quermesse_db_consultas_total": ("counter", "Comandos enviados ao PostgreSQL, por rota."),
+    "quermesse_db_consultas_segundos_total": ("counter", "Tempo somado dos comandos no PostgreSQL, por rota."),
+    "quermesse_db_consultas_por_requisicao": ("histogram", "Comandos no PostgreSQL por requisição."),
+    "quermesse_db_conexao_espera_segundos": ("histogram", "Espera por uma conexão livre do pool."),
+    "quermesse_db_pool_em_uso": ("gauge", "Conexões do pool emprestadas."),
+    "quermesse_db_pool_livres": ("gauge", "Conexões do pool paradas."),
+    "quermesse_db_pool_aguardando": ("gauge", "Requisições esperando conexão do pool."),
+}
+
+# funções que devolvem {nome: valor} com medidores do processo (ex.: pool)
+_fontes_medidores = []
+
+
+def registrar_medidores(funcao):
+    _fontes_medidores.append(funcao)
+
+
+# =========================
+# REGISTRO DO PROCESSO
+# =========================
+class Registro:
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._contadores = {}      # (nome, labels) -> valor
+        self._histogramas = {}     # (nome, labels) -> [contagem por bucket..., soma, total]
+        self._em_andamento = 0
+
+        threading.Thread(target=self._gravar_sempre, name="metricas", daemon=True).start()
+
+    def somar(self, nome, labels, valor=1):
+        chave = (nome, labels)
+        with self._lock:
+            self._contadores[chave] = self._contadores.get(chave, 0) + valor
+
+    def observar(self, nome, labels, valor, buckets):
+        chave = (nome, labels)
+        with self._lock:
+            histograma = self._histogramas.get(chave)
+            if histograma is None:
+                histograma = self._histogramas[chave] = [0] * (len(buckets) + 3)
+
+            # último bucket = +Inf; depois vêm soma e total
+            histograma[bisect_left(buckets, valor)] += 1
+            histograma[-2] += valor
+            histograma[-1] += 1
+
+    def entrou(self):
+        with self._lock:
+            self._em_andamento += 1
+
+    def saiu(self):
+        with self._lock:
+            self._em_andamento -= 1
+
+    def retrato(self):
+        medidores = {"quermesse_requisicoes_em_andamento": self._em_andamento}
+
+        for fonte in _fontes_medidores:
+            try:
+                medidores.update(fonte())
+            except Exception:
+                pass
+
+        with self._lock:
+            return {
+                "pid": self.pid,
+                "contadores": [[n, list(l), v] for (n, l), v in self._contadores.items()],
+                "histogramas": [[n, list(l), list(h)] for (n, l), h in self._histogramas.items()],
+                "medidores": medidores
+            }
+
+    def gravar(self):
+        pasta = _pasta()
+        os.makedirs(pasta, exist_ok=True)
+        _gravar_json(os.path.join(pasta, f"{self.pid}.json"), self.retrato())
+
+    def _gravar_sempre(self):
+        while True:
+            time.sleep(INTERVALO)
+            try:
+                # medidores do pool mudam sem requisição nova; grava sempre
+                self.gravar()
+            except OSError:
+                log.exception("ERRO AO GRAVAR MÉTRICAS")
+
+
+def _gravar_json(caminho, dados):
+    temporario = caminho + ".tmp"
+
+    # os.replace: quem lê nunca vê um arquivo pela metade
+    with open(temporario, "w") as arquivo:
+        json.dump(dados, arquivo)
+    os.replace(temporario, caminho)
+
+
+_registro = None
+_registro_lock = threading.Lock()
+
+
+def obter_registro():
+    global _registro
+
+    # um registro por worker (fork), criado no primeiro uso
+    if _registro is None or _registro.pid != os.getpid():
+        with _registro_lock:
+            if _registro is None or _registro.pid != os.getpid():
+                _registro = Registro()
+
+    return _registro
+
+
+def _registro_existente():
+    # fora de requisição só mede processos que já atendem requisições:
+    # scripts (schema.py, benchmark.py, python tarefas.py) não criam arquivos
+    registro = _registro
+    return registro if registro is not None and registro.pid == os.getpid() else None
+
+
+# =========================
+# REQUISIÇÃO ATUAL
+# =========================
+_local = threading.local()
+
+
+def inicio_requisicao(rota=None):
+    _local.inicio = time.perf_counter()
+    _local.rota = rota
+    _local.consultas = 0
+    _local.tempo_db = 0.0
+    obter_registro().entrou()
+
+
+def fim_requisicao(rota, metodo, status):
+
+    inicio = getattr(_local, "inicio", None)
+    if inicio is None:
+        return
+
+    _local.inicio = None
+    _local.rota = None
+    registro = obter_registro()
+    registro.saiu()
+
+    rota = (rota,)
+    registro.somar("quermesse_requisicoes_total", (rota[0], metodo, str(status)))
+    registro.observar("quermesse_requisicao_segundos", rota, time.perf_counter() - inicio, BUCKETS_LATENCIA)
+    registro.observar("quermesse_db_consultas_por_requisicao", rota, _local.consultas, BUCKETS_CONSULTAS)
+    registro.somar("quermesse_db_consultas_total", rota, _local.consultas)
+    registro.somar("quermesse_db_consultas_segundos_total", rota, _local.tempo_db)
+
+
+def rota_atual():
+    # rota da requisição desta thread (log de consultas lentas)
+    if getattr(_local, "inicio", None) is None:
+        return ROTA_SEGUNDO_PLANO
+    return getattr(_local, "rota", None) or ROTA_SEGUNDO_PLANO
+
+
+def registrar_consulta(segundos):
+
+    # chamado pelos cursores do pool (db.py) a cada comando
+    if getattr(_local, "inicio", None) is not None:
+        _local.consultas += 1
+        _local.tempo_db += segundos
+        return
+
+    registro = _registro_existente()
+    if registro is not None:
+        registro.somar("quermesse_db_consultas_total", (ROTA_SEGUNDO_PLANO,))
+        registro.somar("quermesse_db_consultas_segundos_total", (ROTA_SEGUNDO_PLANO,), segundos)
+
+
+def registrar_espera_conexao(segundos):
+    registro = _registro_existente()
+    if registro is not None:
+        registro.observar("quermesse_db_conexao_espera_segundos", (), segundos, BUCKETS_ESPERA)
+
+
+# =========================
+# EXPOSIÇÃO (/metrics)
+# =========================
+LABELS = {
+    "quermesse_requisicoes_total": ("rota", "metodo", "status"),
+    "quermesse_requisicao_segundos": ("rota",),
+    "quermesse_db_consultas_total": ("rota",),
+    "quermesse_db_consultas_segundos_total": ("rota",),
+    "quermesse_db_consultas_por_requisicao": ("rota",),
+    "quermesse_db_conexao_espera_segundos": (),
+}
+
+BUCKETS = {
+    "quermesse_requisicao_segundos": BUCKETS_LATENCIA,
+    "quermesse_db_consultas_por_requisicao": BUCKETS_CONSULTAS,
+    "quermesse_db_conexao_espera_segundos": BUCKETS_ESPERA,
+}
+
+
+def _vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _ler(caminho):
+    try:
+        with open(caminho) as arquivo:
+            return json.load(arquivo)
+    except (OSError, ValueError):
+        return None
+
+
+def _ler_todos(pasta):
+    try:
+        nomes = os.listdir(pasta)
+    except FileNotFoundError:
+        return []
+
+    retratos = (_ler(os.path.join(pasta, nome)) for nome in nomes if nome.endswith(".json"))
+    return [retrato for retrato in retratos if retrato is not None]
+
+
+def _somar(contadores, histogramas, retrato):
+    for nome, labels, valor in retrato["contadores"]:
+        chave = (nome, tuple(labels))
+        contadores[chave] = contadores.get(chave, 0) + valor
+
+    for nome, labels, valores in retrato["histogramas"]:
+        chave = (nome, tuple(labels))
+        atual = histogramas.get(chave)
+        histogramas[chave] = valores if atual is None else [a + b for a, b in zip(atual, valores)]
+
+
+@contextmanager
+def _travado(pasta, modo):
+    # aposentar troca dois arquivos; quem lê espera, para não somar o
+    # worker duas vezes (no arquivo dele e em aposentados.json)
+    os.makedirs(pasta, exist_ok=True)
+    with open(os.path.join(pasta, "trava"), "a") as trava:
+        fcntl.flock(trava, modo)
+        yield
+
+
+def aposentar(pid, pasta=None):
+
+    # soma o retrato de um worker que saiu em aposentados.json e o apaga
+    pasta = pasta or _pasta()
+    caminho = os.path.join(pasta, f"{pid}.json")
+    if not os.path.exists(caminho):
+        return
+
+    with _travado(pasta, fcntl.LOCK_EX):
+        retrato = _ler(caminho)
+
+        if retrato is not None:
+            contadores = {}
+            histogramas = {}
+
+            anteriores = _ler(os.path.join(pasta, APOSENTADOS))
+            if anteriores is not None:
+                _somar(contadores, histogramas, anteriores)
+            _somar(contadores, histogramas, retrato)
+
+            _gravar_json(os.path.join(pasta, APOSENTADOS), {
+                "pid": None,
+                "contadores": [[n, list(l), v] for (n, l), v in contadores.items()],
+                "histogramas": [[n, list(l), h] for (n, l), h in histogramas.items()],
+                "medidores": {}
+            })
+
+        try:
+            os.remove(caminho)
+        except FileNotFoundError:
+            pass
+
+
+def _aposentar_mortos(pasta):
+    # worker que morreu sem passar pelo child_exit (ex.: METRICAS_DIR
+    # compartilhado entre servidores, gunicorn sem o gunicorn.conf.py)
+    try:
+        nomes = os.listdir(pasta)
+    except FileNotFoundError:
+        return
+
+    for nome in nomes:
+        pid = nome[:-len(".json")]
+        if nome.endswith(".json") and pid.isdigit() and not _vivo(int(pid)):
+            aposentar(int(pid), pasta)
+
+
+def _texto_labels(nomes, valores, extra=()):
+    pares = list(zip(nomes, valores)) + list(extra)
+    if not pares:
+        return ""
+
+    def escapar(valor):
+        return str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    return "{" + ",".join(f'{n}="{escapar(v)}"' for n, v in pares) + "}"
+
+
+def _numero(valor):
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+
+def exportar():
+
+    # retrato atualizado deste processo antes de ler os de todos
+    obter_registro().gravar()
+    pasta = _pasta()
+    _aposentar_mortos(pasta)
+
+    contadores = {}
+    histogramas = {}
+    medidores = {}
+
+    with _travado(pasta, fcntl.LOCK_SH):
+        retratos = _ler_todos(pasta)
+
+    for retrato in retratos:
+        _somar(contadores, histogramas, retrato)
+
+        if retrato["pid"] is not None and _vivo(retrato["pid"]):
+            for nome, valor in retrato["medidores"].items():
+                medidores[nome] = medidores.get(nome, 0) + valor
+
+    linhas = []
+
+    def cabecalho(nome):
+        tipo, descricao = DESCRICOES[nome]
+        linhas.append(f"# HELP {nome} {descricao}")
+        linhas.append(f"# TYPE {nome} {tipo}")
+
+    for nome in sorted({n for n, _ in contadores}):
+        cabecalho(nome)
+        for (n, labels), valor in sorted(contadores.items()):
+            if n == nome:
+                linhas.append(f"{nome}{_texto_labels(LABELS[nome], labels)} {_numero(valor)}")
+
+    for nome in sorted({n for n, _ in histogramas}):
+        cabecalho(nome)
+        buckets = BUCKETS[nome]
+
+        for (n, labels), valores in sorted(histogramas.items()):
+            if n != nome:
+                continue
+
+            # buckets do Prometheus são acumulados
+            acumulado = 0
+            for limite, quantidade in zip(list(buckets) + ["+Inf"], valores[:-2]):
+                acumulado += quantidade
+                le = limite if limite == "+Inf" else _numero(limite)
+                linhas.append(
+                    f"{nome}_bucket{_texto_labels(LABELS[nome], labels, [('le', le)])} {acumulado}"
+                )
+
+            linhas.append(f"{nome}_sum{_texto_labels(LABELS[nome], labels)} {_numero(valores[-2])}")
+            linhas.append(f"{nome}_count{_texto_labels(LABELS[nome], labels)} {valores[-1]}")
+
+    for nome in sorted(medidores):
+        cabecalho(nome)
+        linhas.append(f"{nome} {_numero(medidores[nome])}")
+
+    return "\n".join(linhas) + "\n"
@@ -0,0 +1,379 @@
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+import psycopg2
+import psycopg2.extras
+
+from db import conectar
+
+log = logging.getLogger(__name__)
+
+# =========================
+# LIVRO DE ESTOQUE
+# =========================
+# O saldo vendável de cada produto fica dividido em FATIAS linhas de
+# estoque_fatias (migração 10). Uma venda baixa de UMA fatia qualquer que
+# esteja livre e tenha saldo (SKIP LOCKED): caixas vendendo o mesmo produto
+# não esperam um pelo outro, como esperavam pela linha única de produtos.
+#
+# Se todas as fatias com saldo estão ocupadas, a venda volta ao ponto salvo
+# e espera uma fatia sorteada por produto; se nem essa basta (fim do
+# estoque, quantidade grande), trava todas as fatias dos seus produtos. Fora
+# o caminho rápido, que nunca espera, as travas são pegas sempre em ordem
+# crescente de (produto_id, fatia), então não há deadlock.
+#
+# Cada mudança de saldo vira uma linha de estoque_movimentos (venda,
+# cancelamento, ajuste, reset). A compactação, em segundo plano, soma os
+# movimentos pendentes em produtos.estoque_atual (saldo consolidado) e
+# redistribui as fatias dos produtos que mexeram. Sempre vale:
+#
+#   produtos.estoque_atual + movimentos pendentes = soma das fatias
+
+# mesmo número da migração 10 (trigger produtos_criar_fatias)
+FATIAS = 8
+
+TIPOS = ("venda", "cancelamento", "ajuste", "reset")
+
+# intervalo entre compactações em cada worker (s)
+INTERVALO_COMPACTACAO = float(os.getenv("ESTOQUE_COMPACTAR_INTERVALO", "5"))
+
+# chave do pg_try_advisory_xact_lock: uma compactação por vez entre workers
+LOCK_COMPACTACAO = 7_300_003
+
+
+# =========================
+# SALDO
+# =========================
+def disponivel(c=None):
+
+    # {produto_id: saldo vendável}, somando as fatias
+    if c is None:
+        with conectar() as conn:
+            return disponivel(conn.cursor())
+
+    c.execute("""
+        SELECT produto_id, SUM(saldo)::int
+        FROM estoque_fatias
+        GROUP BY produto_id
+    """)
+    return dict(c.fetchall())
+
+
+def _repartir(total):
+    # total em FATIAS partes quase iguais (as primeiras levam o resto)
+    return [total // FATIAS + (1 if fatia < total % FATIAS else 0) for fatia in range(FATIAS)]
+
+
+def _travar_fatias(c, produtos):
+
+    # {produto_id: [saldo da fatia 0, 1, ...]}, com as linhas travadas
+    c.execute("""
+        SELECT produto_id, fatia, saldo
+        FROM estoque_fatias
+        WHERE produto_id = ANY(%s)
+        ORDER BY produto_id, fatia
+        FOR UPDATE
+    """, (sorted(produtos),))
+
+    fatias = {}
+    for produto_id, fatia, saldo in c.fetchall():
+        fatias.setdefault(produto_id, [0] * FATIAS)[fatia] = saldo
+
+    return fatias
+
+
+def _gravar_fatias(c, fatias):
+    psycopg2.extras.execute_values(c, """
+        UPDATE estoque_fatias f
+        SET saldo = n.saldo
+        FROM (VALUES %s) AS n (produto_id, fatia, saldo)
+        WHERE f.produto_id = n.produto_id
+        AND f.fatia = n.fatia
+    """, [
+        (produto_id, fatia, saldo)
+        for produto_id, saldos in sorted(fatias.items())
+        for fatia, saldo in enumerate(saldos)
+    ], template="(%s::int, %s::int, %s::int)", page_size=len(fatias) * FATIAS)
+
+
+def movimentar(c, variacoes):
+
+    # variacoes: {produto_id: quantidade} (negativa = saída, positiva = volta)
+    # Devolve {produto_id: saldo depois} ou None se algum produto não tem
+    # saldo (nada é alterado). Não grava o movimento: ver registrar().
+    variacoes = {int(p): int(q) for p, q in variacoes.items() if q}
+
+    if not variacoes:
+        return {}
+
+    # cursor simples na mesma transação (quem chama pode usar RealDictCursor)
+    c = c.connection.cursor()
+
+    # ponto de volta para o caminho lento (desfaz o que o rápido travou)
+    c.execute("SAVEPOINT estoque_fatias")
+
+    # CAMINHO RÁPIDO: uma fatia livre por produto, começando de uma sorteada.
+    # A escolha fica num CTE materializado para rodar uma vez por produto (no
+    # WHERE do UPDATE ela seria refeita a cada linha e pularia a própria
+    # fatia já alterada). O saldo devolvido é o do início do comando
+    # (aproximado sob concorrência): serve para o alerta de estoque baixo;
+    # os tablets recebem o saldo lido depois do commit (notificacoes.py).
+    saldos = dict(psycopg2.extras.execute_values(c, f"""
+        WITH alvo AS MATERIALIZED (
+            SELECT b.produto_id, b.quantidade, e.fatia
+            FROM (VALUES %s) AS b (produto_id, quantidade, inicio)
+            CROSS JOIN LATERAL (
+                SELECT e.fatia
+                FROM estoque_fatias e
+                WHERE e.produto_id = b.produto_id
+                AND e.saldo + b.quantidade >= 0
+                ORDER BY mod(e.fatia + b.inicio, {FATIAS})
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            ) e
+        )
+        UPDATE estoque_fatias f
+        SET saldo = f.saldo + a.quantidade
+        FROM alvo a
+        WHERE f.produto_id = a.produto_id
+        AND f.fatia = a.fatia
+        RETURNING f.produto_id,
+                  (SELECT SUM(t.saldo) FROM estoque_fatias t
+                   WHERE t.produto_id = f.produto_id)::int + a.quantidade AS saldo
+    """, [
+        (produto_id, quantidade, random.randrange(FATIAS))
+        for produto_id, quantidade in sorted(variacoes.items())
+    ], template="(%s::int, %s::int, %s::int)", page_size=len(variacoes), fetch=True))
+
+    if len(saldos) == len(variacoes):
+        return saldos
+
+    # CAMINHO DE ESPERA: todas as fatias com saldo estavam ocupadas. Cada
+    # produto (em ordem de id) espera UMA fatia sorteada entre as que têm
+    # saldo, então os caixas fazem fila em fatias diferentes
+    c.execute("ROLLBACK TO SAVEPOINT estoque_fatias")
+
+    saldos = {}
+    for produto_id, quantidade in sorted(variacoes.items()):
+        c.execute(f"""
+            UPDATE estoque_fatias f
+            SET saldo = f.saldo + %(quantidade)s
+            WHERE f.produto_id = %(produto_id)s
+            AND f.saldo + %(quantidade)s >= 0
+            AND f.fatia = (
+                SELECT e.fatia
+                FROM estoque_fatias e
+                WHERE e.produto_id = %(produto_id)s
+                AND e.saldo + %(quantidade)s >= 0
+                ORDER BY mod(e.fatia + %(inicio)s, {FATIAS})
+                LIMIT 1
+            )
+            RETURNING (SELECT SUM(t.saldo) FROM estoque_fatias t
+                       WHERE t.produto_id = f.produto_id)::int + %(quantidade)s
+        """, {"produto_id": produto_id, "quantidade": quantidade, "inicio": random.randrange(FATIAS)})
+        linha = c.fetchone()
+
+        if linha is None:
+            break
+
+        saldos[produto_id] = linha[0]
+    else:
+        return saldos
+
+    # CAMINHO LENTO: a fatia esperada não bastou (ou o produto está no fim);
+    # todas as fatias dos produtos, travadas em ordem
+    c.execute("ROLLBACK TO SAVEPOINT estoque_fatias")
+
+    fatias = _travar_fatias(c, variacoes)
+    saldos = {}
+
+    for produto_id, quantidade in variacoes.items():
+        atuais = fatias.get(produto_id)
+
+        if atuais is None or sum(atuais) + quantidade < 0:
+            return None
+
+        if quantidade > 0:
+            atuais[atuais.index(min(atuais))] += quantidade
+        else:
+            # tira das fatias em ordem até completar
+            falta = -quantidade
+            for fatia, saldo in enumerate(atuais):
+                tirar = min(saldo, falta)
+                atuais[fatia] -= tirar
+                falta -= tirar
+
+        saldos[produto_id] = sum(atuais)
+
+    _gravar_fatias(c, {p: fatias[p] for p in variacoes})
+
+    return saldos
+
+
+def travar(c, produtos):
+
+    # {produto_id: saldo vendável} com todas as fatias travadas até o fim da
+    # transação (lotes: reserva em memória e depois um movimentar())
+    fatias = _travar_fatias(c.connection.cursor(), produtos)
+    return {produto_id: sum(saldos) for produto_id, saldos in fatias.items()}
+
+
+def registrar(c, tipo, movimentos):
+
+    # movimentos: [(produto_id, quantidade, numero_venda ou None)]
+    if not movimentos:
+        return
+
+    psycopg2.extras.execute_values(c, """
+        INSERT INTO estoque_movimentos (produto_id, tipo, quantidade, numero_venda)
+        VALUES %s
+    """, [(produto_id, tipo, quantidade, numero_venda) for produto_id, quantidade, numero_venda in movimentos],
+        page_size=len(movimentos))
+
+
+def ajustar(c, novos, tipo="ajuste"):
+
+    # novos: {produto_id: saldo desejado} (cadastro, zerar, reset).
+    # Devolve [(produto_id, saldo)] dos produtos que existem.
+    c = c.connection.cursor()
+    fatias = _travar_fatias(c, novos)
+
+    movimentos = []
+    for produto_id, atuais in fatias.items():
+        novo = max(int(novos[produto_id]), 0)
+        movimentos.append((produto_id, novo - sum(atuais), None))
+        fatias[produto_id] = _repartir(novo)
+
+    if fatias:
+        _gravar_fatias(c, fatias)
+
+    registrar(c, tipo, [m for m in movimentos if m[1]])
+
+    return [(produto_id, sum(saldos)) for produto_id, saldos in sorted(fatias.items())]
+
+
+# =========================
+# COMPACTAÇÃO
+# =========================
+def compactar(conn):
+
+    # Devolve quantos movimentos foram somados, ou None se outra
+    # compactação estava rodando
+    c = conn.cursor()
+
+    c.execute("SELECT pg_try_advisory_xact_lock(%s)", (LOCK_COMPACTACAO,))
+    if not c.fetchone()[0]:
+        conn.rollback()
+        return None
+
+    # só enxerga movimentos já confirmados; os que estão em transações
+    # abertas ficam para a próxima rodada
+    c.execute("""
+        WITH movidos AS (
+            UPDATE estoque_movimentos
+            SET compactado = TRUE
+            WHERE NOT compactado
+            RETURNING produto_id, quantidade
+        ), soma AS (
+            SELECT produto_id, SUM(quantidade) AS variacao, COUNT(*) AS quantos
+            FROM movidos
+            GROUP BY produto_id
+        )
+        UPDATE produtos p
+        SET estoque_atual = p.estoque_atual + s.variacao
+        FROM soma s
+        WHERE p.id = s.produto_id
+        RETURNING p.id, s.quantos
+    """)
+    compactados = c.fetchall()
+
+    # as fatias dos produtos que venderam ficam desiguais: reparte de novo
+    # (trava as fatias em ordem, como o caminho lento das vendas)
+    produtos = [produto_id for produto_id, _ in compactados]
+    if produtos:
+        fatias = _travar_fatias(c, produtos)
+        _gravar_fatias(c, {p: _repartir(sum(s)) for p, s in fatias.items()})
+
+    conn.commit()
+
+    return sum(quantos for _, quantos in compactados)
+
+
+def verificar(conn):
+
+    # [(produto_id, estoque_atual + pendentes, soma das fatias)] que não batem
+    c = conn.cursor()
+    c.execute("""
+        SELECT p.id,
+               p.estoque_atual + COALESCE(m.pendentes, 0),
+               COALESCE(f.saldo, 0)
+        FROM produtos p
+        LEFT JOIN (
+            SELECT produto_id, SUM(quantidade) AS pendentes
+            FROM estoque_movimentos
+            WHERE NOT compactado
+            GROUP BY produto_id
+        ) m ON m.produto_id = p.id
+        LEFT JOIN (
+            SELECT produto_id, SUM(saldo) AS saldo
+            FROM estoque_fatias
+            GROUP BY produto_id
+        ) f ON f.produto_id = p.id
+        WHERE p.estoque_atual + COALESCE(m.pendentes, 0) <> COALESCE(f.saldo, 0)
+        ORDER BY p.id
+    """)
+    return c.fetchall()
+
+
+def _compactar_sempre():
+    while True:
+        time.sleep(INTERVALO_COMPACTACAO)
+        try:
+            with conectar() as conn:
+                compactar(conn)
+        except psycopg2.Error:
+            log.exception("ERRO NA COMPACTAÇÃO DO ESTOQUE")
+
+
+_pid = None
+_pid_lock = threading.Lock()
+
+
+def iniciar():
+    global _pid
+
+    # uma thread por processo (cada worker do gunicorn é um fork); o lock
+    # no banco deixa só uma compactar por vez
+    if _pid == os.getpid():
+        return
+
+    with _pid_lock:
+        if _pid == os.getpid():
+            return
+        _pid = os.getpid()
+
+        threading.Thread(target=_compactar_sempre, name="estoque-compactacao", daemon=True).start()
+
+
+if __name__ == "__main__":
+    # python movimentos.py              -> compacta agora
+    # python movimentos.py --verificar  -> confere estoque_atual + pendentes com as fatias
+    with conectar() as conn:
+        if "--verificar" in sys.argv[1:]:
+            divergencias = verificar(conn)
+
+            for produto_id, livro, fatias in divergencias:
+                print(f"produto {produto_id}: livro={livro} fatias={fatias}")
+
+            if divergencias:
+                sys.exit(1)
+
+            print("Livro de estoque confere com as fatias.")
+        else:
+            quantos = compactar(conn)
+            print("Outra compactação em andamento." if quantos is None
+                  else f"{quantos} movimento(s) compactado(s).")
@@ -0,0 +1,294 @@
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+import movimentos
+from db import abrir_conexao
+
+log = logging.getLogger(__name__)
+
+# =========================
+# AVISOS DE ESTOQUE (LISTEN/NOTIFY + SSE)
+# =========================
+# As rotas que mexem no estoque chamam notificar_estoque() dentro da própria
+# transação; o PostgreSQL só entrega o NOTIFY no commit (e descarta no
+# rollback). Cada worker mantém UMA conexão em LISTEN e repassa os avisos
+# para todos os tablets conectados em /estoque/stream.
+#
+# O aviso leva só os ids: o saldo que a venda enxerga dentro da transação
+# não conta as outras vendas ainda abertas. O ouvinte soma as fatias depois
+# do commit (um SELECT por rajada de avisos), então o último saldo enviado
+# de cada produto é sempre o do banco.
+#
+# O ouvinte guarda também o estoque inteiro do worker: lido uma vez a cada
+# (re)conexão e aviso de catálogo, atualizado pelos avisos. /estoque_atual,
+# /catalogo e a tela de vendas leem dali, sem ir ao banco; sem LISTEN, leem
+# das fatias.
+
+CANAL_ESTOQUE = "estoque"
+
+# disparado por trigger a cada alteração em produtos (ver catalogo.py)
+CANAL_CATALOGO = "catalogo"
+
+# disparado por trigger a cada alteração em usuarios (ver acesso.py)
+CANAL_USUARIOS = "usuarios"
+
+# produtos por NOTIFY (o payload tem limite de 8000 bytes)
+PRODUTOS_POR_AVISO = 300
+
+# cada stream é encerrado depois desse tempo (s); o EventSource reconecta
+# sozinho e recebe o estoque completo de novo
+DURACAO_STREAM = float(os.getenv("ESTOQUE_STREAM_DURACAO", "300"))
+
+# comentário SSE enviado quando nada acontece, para proxies não fecharem
+INTERVALO_PING = 15
+
+# avisos acumulados por tablet antes de desistir e mandar tudo de novo
+FILA_MAXIMA = 100
+
+# marcador: o assinante perdeu avisos e precisa do estoque completo
+RESSINCRONIZAR = object()
+
+
+def notificar_estoque(c, produtos):
+
+    # produtos: ids dos produtos cujo saldo mudou
+    produtos = sorted({int(id) for id in produtos})
+
+    for inicio in range(0, len(produtos), PRODUTOS_POR_AVISO):
+        lote = produtos[inicio:inicio + PRODUTOS_POR_AVISO]
+        c.execute("SELECT pg_notify(%s, %s)", (CANAL_ESTOQUE, json.dumps(lote)))
+
+
+def saldos(c, produtos):
+
+    # {id: saldo} lidos agora das fatias
+    c.execute("""
+        SELECT produto_id, SUM(saldo)::int
+        FROM estoque_fatias
+        WHERE produto_id = ANY(%s)
+        GROUP BY produto_id
+    """, (sorted(produtos),))
+    return dict(c.fetchall())
+
+
+def aviso_estoque(estoque):
+    return {"produtos": {str(i): e for i, e in estoque.items()}}
+
+
+def estoque_completo():
+    return aviso_estoque(obter_ouvinte().estoque() or movimentos.disponivel())
+
+
+# =========================
+# OUVINTE DO PROCESSO
+# =========================
+class Ouvinte:
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._assinantes = set()
+
+        # mudam a cada aviso de catálogo/usuários e a cada reconexão;
+        # None = sem LISTEN
+        self._geracao_catalogo = 0
+        self._geracao_usuarios = 0
+        self._conectado = False
+
+        # {id: saldo}; trocado inteiro a cada aviso, então quem leu pode
+        # usar sem copiar
+        self._estoque = {}
+
+        threading.Thread(target=self._rodar, name="ouvinte-estoque", daemon=True).start()
+
+    def assinar(self):
+        fila = queue.Queue(maxsize=FILA_MAXIMA)
+        with self._lock:
+            self._assinantes.add(fila)
+        return fila
+
+    def cancelar(self, fila):
+        with self._lock:
+            self._assinantes.discard(fila)
+
+    def geracao_catalogo(self):
+        # enquanto a mesma geração valer, nenhum produto mudou desde então
+        with self._lock:
+            return self._geracao_catalogo if self._conectado else None
+
+    def geracao_usuarios(self):
+        # enquanto a mesma geração valer, nenhum usuário mudou desde então
+        with self._lock:
+            return self._geracao_usuarios if self._conectado else None
+
+    def _usuarios_mudou(self):
+        with self._lock:
+            self._geracao_usuarios += 1
+
+    def estoque(self):
+        # {id: saldo} em dia com os avisos; None = sem LISTEN (ler do banco)
+        with self._lock:
+            return self._estoque if self._conectado else None
+
+    def _catalogo_mudou(self, conectado=True):
+        with self._lock:
+            self._geracao_catalogo += 1
+            self._conectado = conectado
+
+    def _estoque_mudou(self, produtos, lidos):
+
+        # produtos: ids relidos; os que não voltaram em lidos foram apagados
+        with self._lock:
+            estoque = dict(self._estoque)
+            for id in produtos:
+                estoque.pop(id, None)
+            estoque.update(lidos)
+            self._estoque = estoque
+
+    def _recarregar(self, conn):
+        # estoque inteiro, lido depois do LISTEN: nenhum aviso fica de fora
+        estoque = movimentos.disponivel(conn.cursor())
+        with self._lock:
+            self._estoque = estoque
+
+    def _distribuir(self, mensagem):
+        with self._lock:
+            assinantes = list(self._assinantes)
+
+        for fila in assinantes:
+            try:
+                fila.put_nowait(mensagem)
+            except queue.Full:
+                # tablet lento: joga fora o acumulado e manda tudo de novo
+                with fila.mutex:
+                    fila.queue.clear()
+                fila.put_nowait(RESSINCRONIZAR)
+
+    def _rodar(self):
+        while True:
+            conn = None
+            try:
+                conn = abrir_conexao()
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute(
+                    f"LISTEN {CANAL_ESTOQUE}; LISTEN {CANAL_CATALOGO}; LISTEN {CANAL_USUARIOS}"
+                )
+
+                # avisos podem ter se perdido enquanto estávamos sem conexão
+                self._recarregar(conn)
+                self._usuarios_mudou()
+                self._catalogo_mudou()
+                self._distribuir(RESSINCRONIZAR)
+
+                while True:
+                    if select.select([conn], [], [], INTERVALO_PING) == ([], [], []):
+                        # confirma que a conexão continua viva
+                        conn.cursor().execute("SELECT 1")
+                    else:
+                        conn.poll()
+
+                    # avisos que chegam durante a leitura dos saldos já ficam
+                    # em conn.notifies: a volta seguinte trata
+                    while conn.notifies:
+                        mudaram = set()
+                        catalogo = False
+
+                        while conn.notifies:
+                            aviso = conn.notifies.pop(0)
+
+                            if aviso.channel == CANAL_CATALOGO:
+                                catalogo = True
+                                continue
+
+                            if aviso.channel == CANAL_USUARIOS:
+                                self._usuarios_mudou()
+                                continue
+
+                            try:
+                                mudaram.update(int(id) for id in json.loads(aviso.payload))
+                            except (TypeError, ValueError):
+                                pass
+
+                        # produto criado ou apagado: relê o estoque inteiro
+                        # antes de trocar a geração (quem vir a geração nova
+                        # já acha os produtos novos no estoque)
+                        if catalogo:
+                            self._recarregar(conn)
+                            self._catalogo_mudou()
+
+                        # autocommit: enxerga tudo que já foi confirmado,
+                        # inclusive as vendas que mandaram estes avisos
+                        if mudaram:
+                            lidos = saldos(conn.cursor(), mudaram)
+                            self._estoque_mudou(mudaram, lidos)
+                            self._distribuir(aviso_estoque(lidos))
+
+            except Exception:
+                log.exception("ERRO NO OUVINTE DE ESTOQUE")
+                self._usuarios_mudou()
+                self._catalogo_mudou(conectado=False)
+                time.sleep(2)
+
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+
+_ouvinte = None
+_ouvinte_lock = threading.Lock()
+
+
+def obter_ouvinte():
+    global _ouvinte
+
+    # um ouvinte por worker (fork), criado no primeiro uso
+    if _ouvinte is None or _ouvinte.pid != os.getpid():
+        with _ouvinte_lock:
+            if _ouvinte is None or _ouvinte.pid != os.getpid():
+                _ouvinte = Ouvinte()
+
+    return _ouvinte
+
+
+def evento(dados):
+    return f"data: {json.dumps(dados)}\n\n"
+
+
+def fluxo_estoque():
+
+    # gerador do /estoque/stream: estoque completo na conexão, depois só
+    # os produtos que mudaram
+    ouvinte = obter_ouvinte()
+    fila = ouvinte.assinar()
+
+    try:
+        yield "retry: 3000\n\n"
+        yield evento(estoque_completo())
+
+        fim = time.monotonic() + DURACAO_STREAM
+
+        while time.monotonic() < fim:
+            try:
+                mensagem = fila.get(timeout=INTERVALO_PING)
+            except queue.Empty:
+                yield ": ping\n\n"
+                continue
+
+            if mensagem is RESSINCRONIZAR:
+                mensagem = estoque_completo()
+
+            yield evento(mensagem)
+
+    finally:
+        ouvinte.cancelar(fila)
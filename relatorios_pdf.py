@@ -0,0 +1,293 @@
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+from reportlab.lib import colors
+from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+from reportlab.lib.pagesizes import A4
+
+# =========================
+# ESTILOS (compartilhados)
+# =========================
+# Criados uma vez por processo e só lidos depois; montar a folha de estilos
+# e os TableStyle a cada requisição era trabalho repetido.
+styles = getSampleStyleSheet()
+
+titulo_style = ParagraphStyle(
+    'TituloCentralizado',
+    parent=styles['Title'],
+    alignment=1  # centralizado
+)
+
+destaque_style = ParagraphStyle(
+    'Destaque',
+    parent=styles['Heading2'],
+    textColor=colors.HexColor("#0d6efd")
+)
+
+ESTILO_TABELA_RESUMO = TableStyle([
+    ('BACKGROUND', (0,0), (-1,0), colors.HexColor("#a9abaa")),
+    ('TEXTCOLOR',(0,0),(-1,0),colors.white),
+    ('ALIGN',(1,1),(-1,-1),'CENTER'),
+    ('GRID', (0,0), (-1,-1), 0.5, colors.grey),
+    ('FONTNAME', (0,0), (-1,-1), 'Helvetica'),
+    ('BOTTOMPADDING', (0,0), (-1,0), 8),
+])
+
+ESTILO_TABELA_FECHAMENTO = TableStyle([
+    ('BACKGROUND',(0,0),(-1,0),'#a9abaa'),
+    ('TEXTCOLOR',(0,0),(-1,0),'white'),
+    ('GRID',(0,0),(-1,-1),0.5,'grey'),
+    ('FONTNAME',(0,0),(-1,-1),'Helvetica'),
+    ('BACKGROUND', (0,-1), (-1,-1), '#d9edf7')
+])
+
+ESTILO_TABELA_VENDAS = TableStyle([
+
+    # Cabeçalho
+    ('BACKGROUND',(0,0),(-1,0),colors.lightgrey),
+    ('FONTNAME',(0,0),(-1,0),'Helvetica-Bold'),
+    ('ALIGN',(0,0),(-1,0),'CENTER'),
+
+    # Alinhamento das colunas
+    ('ALIGN',(0,1),(0,-1),'CENTER'),
+    ('ALIGN',(1,1),(3,-1),'CENTER'),
+    ('ALIGN',(4,1),(4,-1),'RIGHT'),
+
+    # Grade
+    ('GRID',(0,0),(-1,-1),1,colors.black),
+
+    # Linha total
+    ('FONTNAME',(3,-1),(4,-1),'Helvetica-Bold'),
+    ('BACKGROUND',(3,-1),(4,-1),colors.lightgrey)
+
+])
+
+RODAPE = "Relatório gerado automaticamente pelo Sistema Quermesse Online."
+
+
+def montar(elementos):
+    # tudo em memória: nenhum arquivo compartilhado entre requisições/workers
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    doc.build(elementos)
+    return buffer.getvalue()
+
+
+# =========================
+# CACHE DE PDFs PRONTOS
+# =========================
+# Chave = (relatório, filtros, versão das vendas). Qualquer venda gravada ou
+# apagada muda a versão (resumos.nova_versao), então um PDF só é reaproveitado
+# enquanto os dados dele não mudaram. Cache por processo, com limite de itens.
+CACHE_MAX = int(os.getenv("PDF_CACHE_MAX", "32"))
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def em_cache(chave, gerar):
+    with _cache_lock:
+        pdf = _cache.get(chave)
+        if pdf is not None:
+            _cache.move_to_end(chave)
+            return pdf
+
+    pdf = gerar()
+
+    with _cache_lock:
+        _cache[chave] = pdf
+        _cache.move_to_end(chave)
+        while len(_cache) > CACHE_MAX:
+            _cache.popitem(last=False)
+
+    return pdf
+
+
+# =========================
+# RELATÓRIOS
+# =========================
+def tabela_estilizada(dados):
+    tabela = Table(dados, hAlign="LEFT")
+    tabela.setStyle(ESTILO_TABELA_RESUMO)
+    return tabela
+
+
+def resumo_geral(total_geral, por_forma, mais_vendidos, por_operador, gerado_em):
+    elements = []
+
+    # 🏷️ Título
+    elements.append(Paragraph("QUERMESSE ONLINE", titulo_style))
+    elements.append(Spacer(1, 10))
+    elements.append(Paragraph("Resumo Geral de Vendas", styles["Heading2"]))
+    elements.append(Spacer(1, 10))
+
+    # 📅 Data
+    elements.append(Paragraph(f"Gerado em: {gerado_em}", styles["Normal"]))
+    elements.append(Spacer(1, 20))
+
+    # 💰 Total Geral
+    elements.append(Paragraph(
+        f"Total Geral Arrecadado: R$ {round(total_geral,2)}",
+        destaque_style
+    ))
+    elements.append(Spacer(1, 25))
+
+    # 🟩 Forma de pagamento
+    elements.append(Paragraph("Vendas por Forma de Pagamento", styles["Heading3"]))
+    elements.append(Spacer(1,10))
+
+    data_forma = [["Forma de Pagamento", "Total (R$)"]]
+    for item in por_forma:
+        data_forma.append([
+            item["forma_pagamento"],
+            round(item["total"],2)
+        ])
+
+    elements.append(tabela_estilizada(data_forma))
+    elements.append(Spacer(1,25))
+
+    # 🟩 Produtos
+    elements.append(Paragraph("Vendas por Produtos", styles["Heading3"]))
+    elements.append(Spacer(1,10))
+
+    data_prod = [["Produto", "Quantidade", "Total (R$)"]]
+    for p in mais_vendidos:
+        data_prod.append([
+            p["descricao"],
+            p["quantidade"],
+            round(p["total"],2)
+        ])
+
+    elements.append(tabela_estilizada(data_prod))
+    elements.append(Spacer(1,25))
+
+    # 🟩 Operadores
+    elements.append(Paragraph("Vendas por Operador de Caixa", styles["Heading3"]))
+    elements.append(Spacer(1,10))
+
+    data_op = [["Operador", "Nº Vendas", "Total (R$)"]]
+    for o in por_operador:
+        data_op.append([
+            o["nome_usuario"],
+            o["vendas"],
+            round(o["total"],2)
+        ])
+
+    elements.append(tabela_estilizada(data_op))
+    elements.append(Spacer(1,30))
+
+    # 📝 Rodapé
+    elements.append(Paragraph(RODAPE, styles["Italic"]))
+
+    return montar(elements)
+
+
+def reais(valor):
+    return f"R$ {round(float(valor or 0),2)}"
+
+
+def fechamento_caixa(fechamento):
+    elements = []
+
+    de, ate = fechamento["de"], fechamento["ate"]
+    total = fechamento["total"]
+
+    elements.append(Paragraph("QUERMESSE ONLINE", titulo_style))
+    elements.append(Spacer(1, 10))
+    elements.append(Paragraph("Fechamento de Caixa", styles["Heading2"]))
+    elements.append(Spacer(1, 10))
+
+    if de == ate:
+        elements.append(Paragraph(f"Data: {de:%d/%m/%Y}", styles["Normal"]))
+    else:
+        elements.append(Paragraph(f"Período: {de:%d/%m/%Y} a {ate:%d/%m/%Y}", styles["Normal"]))
+
+    elements.append(Spacer(1, 20))
+
+    tabela = [["Forma Pagamento", "Total Vendido", "Total Troco"]]
+
+    for r in fechamento["formas"]:
+        tabela.append([r["forma_pagamento"], reais(r["total"]), reais(r["total_troco"])])
+
+    tabela.append(["TOTAL GERAL", reais(total["total"]), reais(total["total_troco"])])
+
+    table = Table(tabela)
+    table.setStyle(ESTILO_TABELA_FECHAMENTO)
+
+    elements.append(table)
+
+    # 📅 Um subtotal por dia quando o período tem mais de um
+    if de != ate and fechamento["dias"]:
+        elements.append(Spacer(1,20))
+        elements.append(Paragraph("Por Dia", styles["Heading3"]))
+        elements.append(Spacer(1,10))
+
+        data_dia = [["Dia", "Forma Pagamento", "Nº Vendas", "Total Vendido", "Total Troco"]]
+        for d in fechamento["dias"]:
+            for r in d["formas"]:
+                data_dia.append([
+                    f"{d['data']:%d/%m/%Y}", r["forma_pagamento"], r["vendas"],
+                    reais(r["total"]), reais(r["total_troco"])
+                ])
+            data_dia.append([
+                f"{d['data']:%d/%m/%Y}", "Subtotal", d["vendas"],
+                reais(d["total"]), reais(d["total_troco"])
+            ])
+
+        elements.append(tabela_estilizada(data_dia))
+
+    if fechamento["operadores"]:
+        elements.append(Spacer(1,20))
+        elements.append(Paragraph("Por Operador", styles["Heading3"]))
+        elements.append(Spacer(1,10))
+
+        data_op = [["Operador", "Nº Vendas", "Total Vendido", "Total Troco"]]
+        for o in fechamento["operadores"]:
+            data_op.append([
+                o["nome_usuario"] or "-",
+                o["vendas"],
+                reais(o["total"]),
+                reais(o["total_troco"])
+            ])
+
+        elements.append(tabela_estilizada(data_op))
+
+    elements.append(Spacer(1,20))
+    elements.append(Paragraph(RODAPE, styles["Italic"]))
+
+    return montar(elements)
+
+
+def relatorio_vendas(vendas):
+    elementos = []
+
+    # Título
+    elementos.append(Paragraph("Relatório de Vendas", styles["Title"]))
+    elementos.append(Spacer(1,20))
+
+    dados = [["Venda", "Data", "Pagamento", "Usuário", "Valor"]]
+
+    total = 0
+
+    # vendas: [consultas.Venda]
+    for v in vendas:
+        dados.append([
+            v.numero_venda,
+            v.data_venda.strftime("%d/%m/%Y %H:%M"),
+            v.forma_pagamento,
+            v.nome_usuario,
+            f"R$ {v.valor_total:.2f}"
+        ])
+        total += v.valor_total
+
+    dados.append(["", "", "", "TOTAL", f"R$ {total:.2f}"])
+
+    tabela = Table(dados, colWidths=[60,120,110,120,80])
+    tabela.setStyle(ESTILO_TABELA_VENDAS)
+
+    elementos.append(tabela)
+
+    return montar(elementos)
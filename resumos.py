@@ -0,0 +1,259 @@
+import logging
+import random
+import sys
+
+import psycopg2
+import psycopg2.extras
+
+from db import conectar
+
+log = logging.getLogger(__name__)
+
+# =========================
+# RESUMOS DE VENDAS
+# =========================
+# Totais por forma de pagamento, produto e operador mantidos na mesma
+# transação de quem grava/apaga vendas. O dashboard lê só essas poucas linhas.
+#
+# Cada chave fica dividida em até FATIAS linhas (migração 12), como o saldo
+# do estoque: cada gravação soma numa fatia sorteada, então caixas vendendo
+# ao mesmo tempo quase nunca esperam pela mesma linha. Quem lê soma as
+# fatias de cada chave.
+
+# mesmo número da migração 12
+FATIAS = 8
+
+# (tabela, chave, colunas, consulta que recalcula a partir das vendas)
+RESUMOS = [
+    ("resumo_forma_pagamento", "forma_pagamento", ("vendas", "total"), """
+        SELECT forma_pagamento, COUNT(*) AS vendas, SUM(valor_total) AS total
+        FROM vendas
+        GROUP BY forma_pagamento
+    """),
+    ("resumo_produtos", "produto_id", ("quantidade", "total"), """
+        SELECT produto_id, SUM(quantidade) AS quantidade, SUM(valor_total) AS total
+        FROM itens_venda
+        GROUP BY produto_id
+    """),
+    ("resumo_operadores", "usuario_id", ("vendas", "total"), """
+        SELECT usuario_id, COUNT(*) AS vendas, SUM(valor_total) AS total
+        FROM vendas
+        WHERE usuario_id IS NOT NULL
+        GROUP BY usuario_id
+    """),
+]
+
+
+def aplicar_venda(c, forma_pagamento, usuario_id, valor_total, itens, sinal=1):
+
+    # itens: [(produto_id, quantidade, valor_total)]
+    # sinal=1 soma uma venda nova, sinal=-1 desconta uma venda apagada.
+    aplicar_vendas(c, [(forma_pagamento, usuario_id, valor_total, itens)], sinal)
+
+
+def aplicar_vendas(c, vendas, sinal=1):
+
+    # vendas: [(forma_pagamento, usuario_id, valor_total, itens)]
+    # O lote é somado aqui e vai ao banco num único comando, todo na mesma
+    # fatia; as linhas de cada resumo vão em ordem de chave, para não criar
+    # deadlock entre caixas que sortearem a mesma fatia.
+    formas = {}
+    operadores = {}
+    produtos = {}
+
+    for forma_pagamento, usuario_id, valor_total, itens in vendas:
+        vendas_forma, total_forma = formas.get(forma_pagamento, (0, 0))
+        formas[forma_pagamento] = (vendas_forma + 1, total_forma + valor_total)
+
+        if usuario_id is not None:
+            vendas_operador, total_operador = operadores.get(usuario_id, (0, 0))
+            operadores[usuario_id] = (vendas_operador + 1, total_operador + valor_total)
+
+        for produto_id, quantidade, total_item in itens:
+            quantidade_produto, total_produto = produtos.get(produto_id, (0, 0))
+            produtos[produto_id] = (quantidade_produto + quantidade, total_produto + total_item)
+
+    def colunas(resumo):
+        chaves = sorted(resumo)
+        return (
+            chaves,
+            [sinal * resumo[k][0] for k in chaves],
+            [sinal * resumo[k][1] for k in chaves]
+        )
+
+    formas, formas_vendas, formas_totais = colunas(formas)
+    operadores, operadores_vendas, operadores_totais = colunas(operadores)
+    produtos, quantidades, totais = colunas(produtos)
+
+    c.execute("""
+        WITH forma AS (
+            INSERT INTO resumo_forma_pagamento AS r (forma_pagamento, fatia, vendas, total)
+            SELECT f.forma_pagamento, %(fatia)s, f.vendas, f.total
+            FROM unnest(%(formas)s::text[], %(formas_vendas)s::int[], %(formas_totais)s::numeric[])
+                AS f (forma_pagamento, vendas, total)
+            ORDER BY f.forma_pagamento
+            ON CONFLICT (forma_pagamento, fatia) DO UPDATE
+            SET vendas = r.vendas + EXCLUDED.vendas,
+                total = r.total + EXCLUDED.total
+        ), operador AS (
+            INSERT INTO resumo_operadores AS r (usuario_id, fatia, vendas, total)
+            SELECT o.usuario_id, %(fatia)s, o.vendas, o.total
+            FROM unnest(%(operadores)s::int[], %(operadores_vendas)s::int[], %(operadores_totais)s::numeric[])
+                AS o (usuario_id, vendas, total)
+            ORDER BY o.usuario_id
+            ON CONFLICT (usuario_id, fatia) DO UPDATE
+            SET vendas = r.vendas + EXCLUDED.vendas,
+                total = r.total + EXCLUDED.total
+        )
+        INSERT INTO resumo_produtos AS r (produto_id, fatia, quantidade, total)
+        SELECT i.produto_id, %(fatia)s, i.quantidade, i.total
+        FROM unnest(%(produtos)s::int[], %(quantidades)s::int[], %(totais)s::numeric[])
+            AS i (produto_id, quantidade, total)
+        ORDER BY i.produto_id
+        ON CONFLICT (produto_id, fatia) DO UPDATE
+        SET quantidade = r.quantidade + EXCLUDED.quantidade,
+            total = r.total + EXCLUDED.total
+    """, {
+        "formas": formas,
+        "formas_vendas": formas_vendas,
+        "formas_totais": formas_totais,
+        "operadores": operadores,
+        "operadores_vendas": operadores_vendas,
+        "operadores_totais": operadores_totais,
+        "produtos": produtos,
+        "quantidades": quantidades,
+        "totais": totais,
+        "fatia": random.randrange(FATIAS)
+    })
+
+
+def versao(conn):
+
+    # Versão dos dados de vendas: muda a cada venda gravada/apagada, reset e
+    # alteração de nomes que aparecem nos relatórios. Quem guarda relatórios
+    # em cache lê a versão ANTES de consultar os dados.
+    c = conn.cursor()
+    c.execute("SELECT last_value FROM seq_versao_vendas")
+    return c.fetchone()[0]
+
+
+def nova_versao(conn):
+
+    # Chamar só DEPOIS do commit: quem enxergar a versão nova já enxerga
+    # também os dados novos (nextval não depende da transação).
+    # A alteração já foi gravada, então uma falha aqui não deve virar erro
+    # para quem chamou.
+    try:
+        c = conn.cursor()
+        c.execute("SELECT nextval('seq_versao_vendas')")
+        conn.commit()
+    except psycopg2.Error:
+        log.exception("ERRO AO AVANÇAR VERSÃO DAS VENDAS")
+
+
+def zerar(c):
+    c.execute("TRUNCATE TABLE " + ", ".join(t for t, _, _, _ in RESUMOS))
+
+
+def ler(c):
+    c.execute("SELECT COALESCE(SUM(total),0) AS total FROM resumo_forma_pagamento")
+    total_geral = c.fetchone()["total"]
+
+    c.execute("""
+        SELECT forma_pagamento, SUM(total) AS total
+        FROM resumo_forma_pagamento
+        GROUP BY forma_pagamento
+        HAVING SUM(vendas) > 0
+        ORDER BY forma_pagamento
+    """)
+    por_forma = c.fetchall()
+
+    c.execute("""
+        SELECT p.descricao, r.quantidade, r.total
+        FROM (
+            SELECT produto_id, SUM(quantidade)::int AS quantidade, SUM(total) AS total
+            FROM resumo_produtos
+            GROUP BY produto_id
+            HAVING SUM(quantidade) > 0
+        ) r
+        JOIN produtos p ON p.id = r.produto_id
+        ORDER BY r.quantidade DESC
+    """)
+    mais_vendidos = c.fetchall()
+
+    c.execute("""
+        SELECT u.nome_usuario, r.vendas, r.total
+        FROM (
+            SELECT usuario_id, SUM(vendas)::int AS vendas, SUM(total) AS total
+            FROM resumo_operadores
+            GROUP BY usuario_id
+            HAVING SUM(vendas) > 0
+        ) r
+        JOIN usuarios u ON u.id = r.usuario_id
+        ORDER BY r.total DESC
+    """)
+    por_operador = c.fetchall()
+
+    return total_geral, por_forma, mais_vendidos, por_operador
+
+
+def reconstruir(conn, apenas_verificar=False):
+
+    # Recalcula os resumos a partir das vendas e devolve as divergências
+    # encontradas: [(tabela, chave, valor_no_resumo, valor_recalculado)]
+    c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    # bloqueia gravações nos resumos enquanto compara/reconstrói; vendas em
+    # andamento esperam e aplicam seu delta por cima do valor reconstruído
+    c.execute("LOCK TABLE " + ", ".join(t for t, _, _, _ in RESUMOS) + " IN EXCLUSIVE MODE")
+
+    divergencias = []
+
+    for tabela, chave, colunas, consulta in RESUMOS:
+        c.execute(consulta)
+        recalculado = {r[chave]: tuple(r[col] for col in colunas) for r in c.fetchall()}
+
+        c.execute(f"""
+            SELECT {chave}, {', '.join(f'SUM({col}) AS {col}' for col in colunas)}
+            FROM {tabela}
+            GROUP BY {chave}
+        """)
+        atual = {
+            r[chave]: tuple(r[col] for col in colunas)
+            for r in c.fetchall()
+            if any(r[col] for col in colunas)
+        }
+
+        for k in sorted(set(recalculado) | set(atual), key=str):
+            if recalculado.get(k) != atual.get(k):
+                divergencias.append((tabela, k, atual.get(k), recalculado.get(k)))
+
+        if not apenas_verificar:
+            c.execute(f"DELETE FROM {tabela}")
+            c.execute(f"INSERT INTO {tabela} ({chave}, {', '.join(colunas)}) {consulta}")
+
+    if apenas_verificar:
+        conn.rollback()
+    else:
+        conn.commit()
+
+    return divergencias
+
+
+if __name__ == "__main__":
+    # python resumos.py              -> reconstrói e lista o que estava diferente
+    # python resumos.py --verificar  -> só lista as diferenças
+    apenas_verificar = "--verificar" in sys.argv[1:]
+
+    with conectar() as conn:
+        divergencias = reconstruir(conn, apenas_verificar)
+
+    for tabela, chave, atual, recalculado in divergencias:
+        print(f"{tabela}[{chave}]: resumo={atual} vendas={recalculado}")
+
+    if not divergencias:
+        print("Resumos conferem com as vendas.")
+    elif not apenas_verificar:
+        print(f"{len(divergencias)} divergência(s) corrigida(s).")
+    else:
+        sys.exit(1)
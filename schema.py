@@ -0,0 +1,452 @@
+import sys
+
+from db import conectar
+
+# =========================
+# MIGRAÇÕES
+# =========================
+# Cada migração roda uma única vez, em ordem crescente de versão.
+# Nunca altere uma migração já publicada: crie uma nova.
+MIGRACOES = [
+
+    (1, "esquema inicial", """
+        CREATE TABLE IF NOT EXISTS usuarios (
+            id SERIAL PRIMARY KEY,
+            nome_usuario TEXT,
+            usuario TEXT NOT NULL UNIQUE,
+            senha TEXT NOT NULL,
+            perfil TEXT NOT NULL DEFAULT 'usuario'
+        );
+
+        CREATE TABLE IF NOT EXISTS produtos (
+            id SERIAL PRIMARY KEY,
+            descricao TEXT NOT NULL,
+            valor NUMERIC(10,2) NOT NULL,
+            estoque_inicial INTEGER NOT NULL DEFAULT 0,
+            estoque_atual INTEGER NOT NULL DEFAULT 0,
+            estoque_minimo INTEGER,
+            imprimir_cupom BOOLEAN NOT NULL DEFAULT FALSE
+        );
+
+        CREATE TABLE IF NOT EXISTS vendas (
+            id SERIAL PRIMARY KEY,
+            numero_venda INTEGER NOT NULL,
+            produto_id INTEGER REFERENCES produtos(id),
+            quantidade INTEGER NOT NULL DEFAULT 1,
+            valor_total NUMERIC(10,2) NOT NULL,
+            data_venda TIMESTAMPTZ NOT NULL DEFAULT now(),
+            forma_pagamento TEXT,
+            valor_recebido NUMERIC(10,2),
+            troco NUMERIC(10,2),
+            usuario_id INTEGER
+        );
+
+        CREATE SEQUENCE IF NOT EXISTS seq_numero_venda;
+    """),
+
+    (2, "cabeçalho da venda separado dos itens", """
+        -- a tabela antiga (uma linha por item) passa a guardar só os itens
+        ALTER TABLE vendas RENAME TO itens_venda;
+        ALTER INDEX IF EXISTS vendas_pkey RENAME TO itens_venda_pkey;
+        ALTER SEQUENCE IF EXISTS vendas_id_seq RENAME TO itens_venda_id_seq;
+
+        CREATE TABLE vendas (
+            numero_venda INTEGER PRIMARY KEY,
+            data_venda TIMESTAMPTZ NOT NULL DEFAULT now(),
+            forma_pagamento TEXT NOT NULL,
+            valor_total NUMERIC(10,2) NOT NULL DEFAULT 0,
+            valor_recebido NUMERIC(10,2),
+            troco NUMERIC(10,2),
+            usuario_id INTEGER
+        );
+
+        -- valor_recebido/troco só existiam na primeira linha de cada venda
+        INSERT INTO vendas
+            (numero_venda, data_venda, forma_pagamento, valor_total,
+             valor_recebido, troco, usuario_id)
+        SELECT numero_venda,
+               MIN(data_venda),
+               MIN(forma_pagamento),
+               SUM(valor_total),
+               MAX(valor_recebido),
+               MAX(troco),
+               MIN(usuario_id)
+        FROM itens_venda
+        GROUP BY numero_venda;
+
+        ALTER TABLE itens_venda
+            DROP COLUMN data_venda,
+            DROP COLUMN forma_pagamento,
+            DROP COLUMN valor_recebido,
+            DROP COLUMN troco,
+            DROP COLUMN usuario_id,
+            ADD CONSTRAINT itens_venda_numero_venda_fkey
+                FOREIGN KEY (numero_venda)
+                REFERENCES vendas(numero_venda)
+                ON DELETE CASCADE;
+    """),
+
+    (3, "resumos de vendas para o dashboard", """
+        CREATE TABLE resumo_forma_pagamento (
+            forma_pagamento TEXT PRIMARY KEY,
+            vendas INTEGER NOT NULL DEFAULT 0,
+            total NUMERIC(12,2) NOT NULL DEFAULT 0
+        );
+
+        CREATE TABLE resumo_produtos (
+            produto_id INTEGER PRIMARY KEY,
+            quantidade INTEGER NOT NULL DEFAULT 0,
+            total NUMERIC(12,2) NOT NULL DEFAULT 0
+        );
+
+        CREATE TABLE resumo_operadores (
+            usuario_id INTEGER PRIMARY KEY,
+            vendas INTEGER NOT NULL DEFAULT 0,
+            total NUMERIC(12,2) NOT NULL DEFAULT 0
+        );
+
+        INSERT INTO resumo_forma_pagamento (forma_pagamento, vendas, total)
+        SELECT forma_pagamento, COUNT(*), SUM(valor_total)
+        FROM vendas
+        GROUP BY forma_pagamento;
+
+        INSERT INTO resumo_produtos (produto_id, quantidade, total)
+        SELECT produto_id, SUM(quantidade), SUM(valor_total)
+        FROM itens_venda
+        GROUP BY produto_id;
+
+        INSERT INTO resumo_operadores (usuario_id, vendas, total)
+        SELECT usuario_id, COUNT(*), SUM(valor_total)
+        FROM vendas
+        WHERE usuario_id IS NOT NULL
+        GROUP BY usuario_id;
+    """),
+
+    (4, "índices dos caminhos de consulta", """
+        -- fechamento/relatórios: intervalos [início, fim) em data_venda
+        CREATE INDEX IF NOT EXISTS idx_vendas_data_venda
+            ON vendas (data_venda);
+
+        -- filtro/JOIN por operador
+        CREATE INDEX IF NOT EXISTS idx_vendas_usuario_data
+            ON vendas (usuario_id, data_venda);
+
+        -- itens de uma venda (detalhe, cancelamento, exclusão, CASCADE da FK)
+        CREATE INDEX IF NOT EXISTS idx_itens_venda_numero_venda
+            ON itens_venda (numero_venda);
+
+        -- JOIN com produtos e verificação antes de excluir produto
+        CREATE INDEX IF NOT EXISTS idx_itens_venda_produto
+            ON itens_venda (produto_id);
+
+        ANALYZE vendas;
+        ANALYZE itens_venda;
+    """),
+
+    (5, "versão dos dados de vendas (cache de relatórios)", """
+        CREATE SEQUENCE IF NOT EXISTS seq_versao_vendas;
+    """),
+
+    (6, "fila de tarefas (relatórios em segundo plano)", """
+        CREATE TABLE tarefas (
+            id TEXT PRIMARY KEY,
+            tipo TEXT NOT NULL,
+            chave TEXT NOT NULL,
+            parametros JSONB NOT NULL DEFAULT '{}',
+            usuario_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'pendente',
+            progresso REAL NOT NULL DEFAULT 0,
+            erro TEXT,
+            nome_arquivo TEXT,
+            mimetype TEXT,
+            conteudo BYTEA,
+            criada_em TIMESTAMPTZ NOT NULL DEFAULT now(),
+            iniciada_em TIMESTAMPTZ,
+            concluida_em TIMESTAMPTZ
+        );
+
+        -- no máximo uma tarefa em andamento por pedido idêntico
+        CREATE UNIQUE INDEX idx_tarefas_chave_em_andamento
+            ON tarefas (chave)
+            WHERE status IN ('pendente', 'executando');
+
+        CREATE INDEX idx_tarefas_pendentes
+            ON tarefas (criada_em)
+            WHERE status = 'pendente';
+    """),
+
+    (7, "versão por produto para o catálogo incremental", """
+        ALTER TABLE produtos ADD COLUMN versao BIGINT NOT NULL DEFAULT 0;
+
+        CREATE TABLE produtos_removidos (
+            id INTEGER PRIMARY KEY,
+            versao BIGINT NOT NULL
+        );
+
+        -- versão = id da transação que gravou a linha (ver catalogo.py)
+        CREATE FUNCTION produtos_marcar_versao() RETURNS trigger AS $$
+        BEGIN
+            NEW.versao := pg_current_xact_id()::text::bigint;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE FUNCTION produtos_registrar_remocao() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO produtos_removidos (id, versao)
+            VALUES (OLD.id, pg_current_xact_id()::text::bigint)
+            ON CONFLICT (id) DO UPDATE SET versao = EXCLUDED.versao;
+            RETURN OLD;
+        END
+        $$ LANGUAGE plpgsql;
+
+        -- entregue só no commit; invalida o catálogo em memória dos workers
+        CREATE FUNCTION produtos_avisar_catalogo() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('catalogo', '');
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER produtos_versao
+            BEFORE INSERT OR UPDATE ON produtos
+            FOR EACH ROW EXECUTE FUNCTION produtos_marcar_versao();
+
+        CREATE TRIGGER produtos_remocao
+            AFTER DELETE ON produtos
+            FOR EACH ROW EXECUTE FUNCTION produtos_registrar_remocao();
+
+        CREATE TRIGGER produtos_catalogo
+            AFTER INSERT OR UPDATE OR DELETE ON produtos
+            FOR EACH STATEMENT EXECUTE FUNCTION produtos_avisar_catalogo();
+
+        UPDATE produtos SET versao = 0;
+    """),
+
+    (8, "chaves de idempotência das vendas", """
+        -- resposta original de cada venda enviada com chave, para reenvios
+        CREATE TABLE vendas_idempotencia (
+            chave TEXT PRIMARY KEY,
+            numero_venda INTEGER NOT NULL,
+            resposta JSONB NOT NULL,
+            criada_em TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """),
+
+    (9, "catálogo separado do estoque", """
+        -- baixa de estoque (toda venda) não muda mais a versão nem avisa o
+        -- catálogo: só descrição, preço, estoque mínimo e cupom contam.
+        -- O aviso passa a sair por linha (o PostgreSQL junta NOTIFYs
+        -- iguais da mesma transação num só).
+        DROP TRIGGER produtos_versao ON produtos;
+        DROP TRIGGER produtos_catalogo ON produtos;
+
+        CREATE OR REPLACE FUNCTION produtos_marcar_versao() RETURNS trigger AS $$
+        BEGIN
+            NEW.versao := pg_current_xact_id()::text::bigint;
+            PERFORM pg_notify('catalogo', '');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION produtos_registrar_remocao() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO produtos_removidos (id, versao)
+            VALUES (OLD.id, pg_current_xact_id()::text::bigint)
+            ON CONFLICT (id) DO UPDATE SET versao = EXCLUDED.versao;
+            PERFORM pg_notify('catalogo', '');
+            RETURN OLD;
+        END
+        $$ LANGUAGE plpgsql;
+
+        DROP FUNCTION produtos_avisar_catalogo();
+
+        CREATE TRIGGER produtos_versao_insercao
+            BEFORE INSERT ON produtos
+            FOR EACH ROW EXECUTE FUNCTION produtos_marcar_versao();
+
+        CREATE TRIGGER produtos_versao
+            BEFORE UPDATE ON produtos
+            FOR EACH ROW
+            WHEN ((OLD.descricao, OLD.valor, OLD.estoque_minimo, OLD.imprimir_cupom)
+                  IS DISTINCT FROM
+                  (NEW.descricao, NEW.valor, NEW.estoque_minimo, NEW.imprimir_cupom))
+            EXECUTE FUNCTION produtos_marcar_versao();
+    """),
+
+    (10, "livro de estoque com saldo em fatias", """
+        -- saldo vendável de cada produto dividido em 8 fatias (movimentos.FATIAS):
+        -- caixas vendendo o mesmo produto travam fatias diferentes
+        CREATE TABLE estoque_fatias (
+            produto_id INTEGER NOT NULL REFERENCES produtos(id) ON DELETE CASCADE,
+            fatia SMALLINT NOT NULL,
+            saldo INTEGER NOT NULL CHECK (saldo >= 0),
+            PRIMARY KEY (produto_id, fatia)
+        );
+
+        -- toda mudança de saldo (só inserções); a compactação soma os
+        -- pendentes em produtos.estoque_atual e marca como compactados
+        CREATE TABLE estoque_movimentos (
+            id BIGSERIAL PRIMARY KEY,
+            produto_id INTEGER NOT NULL REFERENCES produtos(id) ON DELETE CASCADE,
+            tipo TEXT NOT NULL
+                CHECK (tipo IN ('venda', 'cancelamento', 'ajuste', 'reset')),
+            quantidade INTEGER NOT NULL,
+            numero_venda INTEGER,
+            criado_em TIMESTAMPTZ NOT NULL DEFAULT now(),
+            compactado BOOLEAN NOT NULL DEFAULT FALSE
+        );
+
+        CREATE INDEX idx_estoque_movimentos_pendentes
+            ON estoque_movimentos (id)
+            WHERE NOT compactado;
+
+        CREATE INDEX idx_estoque_movimentos_produto
+            ON estoque_movimentos (produto_id, criado_em);
+
+        -- produto novo já nasce com as fatias do estoque inicial
+        CREATE FUNCTION produtos_criar_fatias() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO estoque_fatias (produto_id, fatia, saldo)
+            SELECT NEW.id, f,
+                   GREATEST(NEW.estoque_atual, 0) / 8
+                   + CASE WHEN f < GREATEST(NEW.estoque_atual, 0) % 8 THEN 1 ELSE 0 END
+            FROM generate_series(0, 7) AS f;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER produtos_fatias
+            AFTER INSERT ON produtos
+            FOR EACH ROW EXECUTE FUNCTION produtos_criar_fatias();
+
+        INSERT INTO estoque_fatias (produto_id, fatia, saldo)
+        SELECT p.id, f,
+               GREATEST(p.estoque_atual, 0) / 8
+               + CASE WHEN f < GREATEST(p.estoque_atual, 0) % 8 THEN 1 ELSE 0 END
+        FROM produtos p
+        CROSS JOIN generate_series(0, 7) AS f;
+    """),
+
+    (11, "fechamento de dias encerrados", """
+        -- um dia fechado não é mais agregado a partir das vendas: o
+        -- fechamento lê a fotografia gravada no fechamento do dia
+        CREATE TABLE dias_fechados (
+            data DATE PRIMARY KEY,
+            fechado_em TIMESTAMPTZ NOT NULL DEFAULT now(),
+            fechado_por INTEGER,
+            -- muda a cada reconstrução (chave do cache do PDF)
+            gerado_em TIMESTAMPTZ NOT NULL DEFAULT now(),
+            -- venda do dia apagada depois do fechamento: reconstruir
+            desatualizado BOOLEAN NOT NULL DEFAULT FALSE
+        );
+
+        -- uma linha por (dia, forma de pagamento, operador)
+        CREATE TABLE fechamentos (
+            data DATE NOT NULL REFERENCES dias_fechados(data) ON DELETE CASCADE,
+            forma_pagamento TEXT,
+            usuario_id INTEGER,
+            nome_usuario TEXT,
+            vendas INTEGER NOT NULL,
+            total NUMERIC(12,2) NOT NULL,
+            total_troco NUMERIC(12,2) NOT NULL
+        );
+
+        CREATE INDEX idx_fechamentos_data ON fechamentos (data);
+    """),
+
+    (12, "resumos de vendas em fatias", """
+        -- cada chave dos resumos em até 8 linhas (resumos.FATIAS): vendas
+        -- simultâneas somam em fatias diferentes; quem lê soma as fatias
+        ALTER TABLE resumo_forma_pagamento
+            ADD COLUMN fatia SMALLINT NOT NULL DEFAULT 0,
+            DROP CONSTRAINT resumo_forma_pagamento_pkey,
+            ADD PRIMARY KEY (forma_pagamento, fatia);
+
+        ALTER TABLE resumo_produtos
+            ADD COLUMN fatia SMALLINT NOT NULL DEFAULT 0,
+            DROP CONSTRAINT resumo_produtos_pkey,
+            ADD PRIMARY KEY (produto_id, fatia);
+
+        ALTER TABLE resumo_operadores
+            ADD COLUMN fatia SMALLINT NOT NULL DEFAULT 0,
+            DROP CONSTRAINT resumo_operadores_pkey,
+            ADD PRIMARY KEY (usuario_id, fatia);
+    """),
+
+    (13, "aviso de alteração de usuários", """
+        -- entregue só no commit; invalida o cache de login dos workers
+        -- (acesso.py) quando senha, perfil ou cadastro mudam
+        CREATE FUNCTION usuarios_avisar() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('usuarios', '');
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER usuarios_aviso
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON usuarios
+            FOR EACH STATEMENT EXECUTE FUNCTION usuarios_avisar();
+    """),
+
+    (14, "fotografia refeita na mesma transação", """
+        -- a fotografia de um dia fechado é refeita junto com a venda que o
+        -- altera (fechamentos.vendas_alteradas); um dia que ainda tenha
+        -- ficado marcado volta a ser aberto e é agregado das vendas
+        DELETE FROM dias_fechados WHERE desatualizado;
+        ALTER TABLE dias_fechados DROP COLUMN desatualizado;
+    """),
+]
+
+# chave do pg_advisory_xact_lock: impede dois processos migrando ao mesmo tempo
+LOCK_MIGRACAO = 7_300_001
+
+
+def versao_atual(c):
+    c.execute("SELECT COALESCE(MAX(versao), 0) FROM schema_versao")
+    return c.fetchone()[0]
+
+
+def aplicar_migracoes():
+    aplicadas = []
+
+    with conectar() as conn:
+        c = conn.cursor()
+
+        c.execute("SELECT pg_advisory_xact_lock(%s)", (LOCK_MIGRACAO,))
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS schema_versao (
+                versao INTEGER PRIMARY KEY,
+                descricao TEXT NOT NULL,
+                aplicada_em TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+        """)
+
+        atual = versao_atual(c)
+
+        # tudo numa transação só: ou o banco sobe de versão inteiro, ou nada muda
+        for versao, descricao, sql in MIGRACOES:
+            if versao <= atual:
+                continue
+
+            c.execute(sql)
+            c.execute(
+                "INSERT INTO schema_versao (versao, descricao) VALUES (%s, %s)",
+                (versao, descricao)
+            )
+            aplicadas.append((versao, descricao))
+
+        conn.commit()
+
+    return aplicadas
+
+
+if __name__ == "__main__":
+    aplicadas = aplicar_migracoes()
+
+    if not aplicadas:
+        print("Banco já está na versão mais recente.")
+        sys.exit(0)
+
+    for versao, descricao in aplicadas:
+        print(f"Migração {versao} aplicada: {descricao}")
@@ -1,5 +1,24 @@
-const CACHE_STATIC = "quermesse-static-v4";
-const CACHE_DYNAMIC = "quermesse-dynamic-v4";
+const CACHE_STATIC = "quermesse-static-v6";
+const CACHE_DYNAMIC = "quermesse-dynamic-v6";
+const CACHE_PIX = "quermesse-pix-v1";
+
+// QR do PIX por valor (/pix/<centavos>.png) nunca muda
+const PIX_QRCODE = /^\/pix\/\d+\.png$/;
+const PIX_MAXIMO = 200;
+
+// Vendas feitas sem rede ficam no IndexedDB e são reenviadas em ordem.
+// Cada uma leva a chave de idempotência gerada pelo tablet, então reenviar
+// uma venda que o servidor já gravou devolve a venda original.
+const FILA_DB = "quermesse-fila";
+const FILA_STORE = "vendas";
+const FILA_SYNC = "fila-vendas";
+
+// vendas que o servidor recusou de vez (pedido inválido): saem da fila para
+// não travar as outras e ficam aqui até o operador ver e descartar
+const RECUSADAS_STORE = "recusadas";
+
+// a fila volta ao servidor em lotes (/salvar_vendas_lote), não venda a venda
+const FILA_LOTE = 100;
 
 // Arquivos realmente estáticos
 const STATIC_ASSETS = [
@@ -24,7 +43,7 @@ self.addEventListener("activate", event => {
     caches.keys().then(keys => {
       return Promise.all(
         keys
-          .filter(key => key !== CACHE_STATIC && key !== CACHE_DYNAMIC)
+          .filter(key => ![CACHE_STATIC, CACHE_DYNAMIC, CACHE_PIX].includes(key))
           .map(key => caches.delete(key))
       );
     })
@@ -33,13 +52,265 @@ self.addEventListener("activate", event => {
   return self.clients.claim(); // assume controle imediato
 });
 
+// ================= FILA OFFLINE DE VENDAS =================
+function naFila(modo, operacao, nome = FILA_STORE) {
+  return new Promise((resolve, reject) => {
+    const pedido = indexedDB.open(FILA_DB, 2);
+
+    pedido.onupgradeneeded = () => {
+      const db = pedido.result;
+
+      if (!db.objectStoreNames.contains(FILA_STORE)) {
+        db.createObjectStore(FILA_STORE, { keyPath: "id", autoIncrement: true });
+      }
+      if (!db.objectStoreNames.contains(RECUSADAS_STORE)) {
+        db.createObjectStore(RECUSADAS_STORE, { keyPath: "id" });
+      }
+    };
+
+    pedido.onerror = () => reject(pedido.error);
+
+    pedido.onsuccess = () => {
+      const db = pedido.result;
+      const tx = db.transaction(nome, modo);
+      const req = operacao(tx.objectStore(nome));
+      let resultado;
+
+      req.onsuccess = () => { resultado = req.result; };
+      tx.oncomplete = () => { db.close(); resolve(resultado); };
+      tx.onerror = () => { db.close(); reject(tx.error); };
+    };
+  });
+}
+
+const contarFila = () => naFila("readonly", store => store.count());
+const contarRecusadas = () => naFila("readonly", store => store.count(), RECUSADAS_STORE);
+
+function enviarVenda(venda) {
+  return fetch(venda.url, {
+    method: "POST",
+    credentials: "same-origin",
+    headers: {
+      "Content-Type": "application/json",
+      "Idempotency-Key": venda.chave
+    },
+    body: venda.corpo
+  });
+}
+
+function avisarClientes(mensagem) {
+  return self.clients.matchAll().then(clientes => {
+    clientes.forEach(cliente => cliente.postMessage(mensagem));
+  });
+}
+
+async function avisarPendentes() {
+  const pendentes = await contarFila();
+  const recusadas = await contarRecusadas();
+  return avisarClientes({ tipo: "fila", pendentes, recusadas });
+}
+
+// tira a venda da fila (guardando antes: se cair no meio, a chave de
+// idempotência evita gravar duas vezes) e avisa o operador
+async function estacionar(venda, erro) {
+  await naFila("readwrite", store => store.put({ ...venda, erro, recusada_em: Date.now() }), RECUSADAS_STORE);
+  await naFila("readwrite", store => store.delete(venda.id));
+  await avisarClientes({ tipo: "recusada", chave: venda.chave, erro });
+}
+
+function corpoValido(venda) {
+  try {
+    JSON.parse(venda.corpo);
+    return true;
+  } catch (erro) {
+    return false;
+  }
+}
+
+// 4xx que não muda tentando de novo; 403 é sessão expirada (novo login
+// resolve), 408 e 429 são passageiros
+function recusaPermanente(response) {
+  return response.status >= 400 && response.status < 500 &&
+    ![403, 408, 429].includes(response.status);
+}
+
+// um reenvio por vez, mesmo com sync + online + mensagem chegando juntos
+let enviandoFila = null;
+
+function enviarFila() {
+  if (!enviandoFila) {
+    enviandoFila = reenviarFila().finally(() => {
+      enviandoFila = null;
+      return avisarPendentes();
+    });
+  }
+  return enviandoFila;
+}
+
+function enviarLote(vendas) {
+  return fetch("/salvar_vendas_lote", {
+    method: "POST",
+    credentials: "same-origin",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({
+      modo: "parcial",
+      // criada_em: o servidor grava a venda com a hora em que foi feita
+      vendas: vendas.map(venda => ({
+        ...JSON.parse(venda.corpo),
+        chave_idempotencia: venda.chave,
+        criada_em: venda.criada_em
+      }))
+    })
+  });
+}
+
+async function reenviarLote(lote) {
+  const response = await enviarLote(lote);  // sem rede: para aqui
+
+  // sessão expirada ou servidor fora do ar: tenta de novo depois
+  if (response.redirected || response.status === 403 || response.status >= 500) {
+    throw new Error("Reenvio adiado: HTTP " + response.status);
+  }
+
+  const dados = await response.json().catch(() => ({}));
+
+  if (Array.isArray(dados.resultados) && dados.resultados.length === lote.length) {
+    for (let i = 0; i < lote.length; i++) {
+      const resultado = dados.resultados[i] || {};
+
+      // gravada (ou já gravada antes): sai da fila
+      if (resultado.sucesso || resultado.repetida) {
+        await naFila("readwrite", store => store.delete(lote[i].id));
+        await avisarClientes({ tipo: "venda", chave: lote[i].chave, resposta: resultado });
+        continue;
+      }
+
+      // recusada (ex.: estoque acabou): o cliente já pagou, então fica
+      // guardada para o operador mesmo sem nenhuma página aberta
+      await estacionar(lote[i], resultado.erro || "Recusada pelo servidor");
+    }
+    return;
+  }
+
+  if (!recusaPermanente(response)) {
+    throw new Error("Reenvio adiado: resposta inesperada");
+  }
+
+  // lote recusado inteiro: manda venda a venda para achar a(s) culpada(s)
+  if (lote.length > 1) {
+    for (const venda of lote) {
+      await reenviarLote([venda]);
+    }
+    return;
+  }
+
+  await estacionar(lote[0], dados.erro || "Recusada pelo servidor (HTTP " + response.status + ")");
+}
+
+async function reenviarFila() {
+  const todas = await naFila("readonly", store => store.getAll());
+  const vendas = [];
+
+  // venda corrompida no IndexedDB nunca vai passar
+  for (const venda of todas) {
+    if (corpoValido(venda)) {
+      vendas.push(venda);
+    } else {
+      await estacionar(venda, "Venda corrompida na fila");
+    }
+  }
+
+  // ordem de id = ordem em que as vendas foram feitas
+  for (let inicio = 0; inicio < vendas.length; inicio += FILA_LOTE) {
+    await reenviarLote(vendas.slice(inicio, inicio + FILA_LOTE));
+  }
+}
+
+async function salvarVenda(request) {
+  const venda = {
+    url: request.url,
+    chave: request.headers.get("Idempotency-Key"),
+    corpo: await request.text(),
+    criada_em: Date.now()
+  };
+
+  // vendas guardadas antes saem primeiro, para a ordem se manter
+  if (await contarFila() > 0) {
+    await enviarFila().catch(() => {});
+  }
+
+  if (await contarFila() === 0) {
+    try {
+      return await enviarVenda(venda);
+    } catch (erro) {
+      // sem rede: cai na fila abaixo
+    }
+  }
+
+  await naFila("readwrite", store => store.add(venda));
+
+  if (self.registration.sync) {
+    self.registration.sync.register(FILA_SYNC).catch(() => {});
+  }
+
+  const pendentes = await contarFila();
+  avisarClientes({ tipo: "fila", pendentes, recusadas: await contarRecusadas() });
+
+  return new Response(
+    JSON.stringify({ sucesso: true, enfileirada: true, pendentes }),
+    { status: 202, headers: { "Content-Type": "application/json" } }
+  );
+}
+
+self.addEventListener("sync", event => {
+  if (event.tag === FILA_SYNC) {
+    event.waitUntil(enviarFila());
+  }
+});
+
 // ================= FETCH =================
 self.addEventListener("fetch", event => {
 
-  // Ignorar requisições que não são GET
+  const url = new URL(event.request.url);
+
+  // Venda com chave de idempotência → rede, ou fila offline
+  if (
+    event.request.method === "POST" &&
+    url.pathname === "/salvar_venda" &&
+    event.request.headers.has("Idempotency-Key")
+  ) {
+    event.respondWith(salvarVenda(event.request));
+    return;
+  }
+
+  // Ignorar as demais requisições que não são GET
   if (event.request.method !== "GET") return;
 
-  const url = new URL(event.request.url);
+  // Stream de estoque (SSE) nunca passa pelo cache
+  if (url.pathname === "/estoque/stream") return;
+
+  // QR do PIX → Cache First (limitado a PIX_MAXIMO imagens)
+  if (PIX_QRCODE.test(url.pathname)) {
+    event.respondWith(
+      caches.open(CACHE_PIX).then(cache =>
+        cache.match(event.request).then(cached => {
+          if (cached) return cached;
+
+          return fetch(event.request).then(response => {
+            if (response.ok) {
+              cache.put(event.request, response.clone());
+              cache.keys().then(keys => {
+                keys.slice(0, Math.max(0, keys.length - PIX_MAXIMO))
+                  .forEach(key => cache.delete(key));
+              });
+            }
+            return response;
+          });
+        })
+      )
+    );
+    return;
+  }
 
   // 1️⃣ Arquivos estáticos → Cache First
   if (STATIC_ASSETS.includes(url.pathname)) {
@@ -69,4 +340,24 @@ self.addEventListener("message", event => {
   if (event.data === "SKIP_WAITING") {
     self.skipWaiting();
   }
+
+  // página voltou a ter rede, ou quer saber quantas vendas estão na fila
+  if (event.data === "ENVIAR_FILA") {
+    event.waitUntil(enviarFila().catch(() => {}));
+  }
+
+  // operador abriu a lista de vendas recusadas
+  if (event.data === "LISTAR_RECUSADAS" && event.source) {
+    event.waitUntil(
+      naFila("readonly", store => store.getAll(), RECUSADAS_STORE)
+        .then(vendas => event.source.postMessage({ tipo: "recusadas", vendas }))
+    );
+  }
+
+  // operador conferiu (e anotou) as recusadas
+  if (event.data === "DESCARTAR_RECUSADAS") {
+    event.waitUntil(
+      naFila("readwrite", store => store.clear(), RECUSADAS_STORE).then(avisarPendentes)
+    );
+  }
 });
@@ -0,0 +1,300 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+
+import psycopg2
+import psycopg2.extras
+
+from db import conectar
+
+log = logging.getLogger(__name__)
+
+# =========================
+# FILA DE TAREFAS
+# =========================
+# Relatórios pesados rodam fora da requisição. A fila é a tabela "tarefas"
+# no próprio PostgreSQL (sem broker externo): qualquer processo pode
+# receber o pedido, executar, ou entregar o arquivo pronto.
+#
+# Por padrão os workers web só enfileiram, e a execução fica com o processo
+# "worker" do Procfile (python tarefas.py, TAREFAS_CONCORRENCIA threads).
+# Com TAREFAS_NO_WEB=1 cada worker do gunicorn também executa (um processo
+# só, sem o worker separado).
+
+CONCORRENCIA = int(os.getenv("TAREFAS_CONCORRENCIA", "1"))
+NO_WEB = os.getenv("TAREFAS_NO_WEB", "0") == "1"
+
+# arquivos prontos (e erros) são apagados depois desse tempo (s)
+EXPIRAR_APOS = float(os.getenv("TAREFAS_EXPIRAR_APOS", "3600"))
+
+# tarefa "executando" há mais tempo que isso é dada como perdida (s)
+TEMPO_MAXIMO = float(os.getenv("TAREFAS_TEMPO_MAXIMO", "900"))
+
+# espera entre consultas à fila quando não há nada a fazer (s)
+INTERVALO = float(os.getenv("TAREFAS_INTERVALO", "2"))
+
+# intervalo mínimo entre gravações de progresso de uma tarefa (s)
+INTERVALO_PROGRESSO = 0.5
+
+# tipo -> (função, somente_admin)
+# função(parametros, progresso) -> (conteúdo em bytes, nome do arquivo, mimetype)
+TIPOS = {}
+
+
+def tarefa(tipo, somente_admin=False):
+    def registrar(funcao):
+        TIPOS[tipo] = (funcao, somente_admin)
+        return funcao
+    return registrar
+
+
+def chave_tarefa(tipo, parametros, versao, dono=None):
+    # pedidos iguais sobre os mesmos dados caem na mesma tarefa; com dono,
+    # só os pedidos desse usuário (quem não é admin só acessa as suas)
+    texto = json.dumps([tipo, parametros, versao, dono], sort_keys=True, default=str)
+    return hashlib.sha256(texto.encode()).hexdigest()
+
+
+# =========================
+# ENFILEIRAR / CONSULTAR
+# =========================
+def enviar(tipo, parametros, usuario_id, versao=None, compartilhar=False):
+
+    # compartilhar=True: a tarefa serve a qualquer um que peça o mesmo
+    # (admins, que acessam todas); senão fica só para usuario_id
+    chave = chave_tarefa(tipo, parametros, versao, None if compartilhar else usuario_id)
+
+    with conectar() as conn:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+        # mesma tarefa em andamento, ou já pronta e ainda não expirada
+        c.execute("""
+            SELECT id, status
+            FROM tarefas
+            WHERE chave = %s
+              AND (status IN ('pendente', 'executando')
+                   OR (status = 'concluida'
+                       AND concluida_em > now() - make_interval(secs => %s)))
+            ORDER BY criada_em DESC
+            LIMIT 1
+        """, (chave, EXPIRAR_APOS))
+        existente = c.fetchone()
+
+        if existente:
+            conn.rollback()
+            return existente
+
+        # o índice único parcial resolve a corrida entre dois pedidos iguais
+        c.execute("""
+            INSERT INTO tarefas (id, tipo, chave, parametros, usuario_id)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (chave) WHERE status IN ('pendente', 'executando')
+            DO NOTHING
+            RETURNING id, status
+        """, (uuid.uuid4().hex, tipo, chave, psycopg2.extras.Json(parametros), usuario_id))
+        tarefa_nova = c.fetchone()
+
+        if tarefa_nova is None:
+            c.execute("""
+                SELECT id, status
+                FROM tarefas
+                WHERE chave = %s AND status IN ('pendente', 'executando')
+            """, (chave,))
+            tarefa_nova = c.fetchone()
+
+        conn.commit()
+
+    _acordar.set()
+
+    return tarefa_nova
+
+
+def consultar(id_tarefa):
+    with conectar() as conn:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        c.execute("""
+            SELECT id, tipo, status, progresso, erro, nome_arquivo,
+                   usuario_id, criada_em, concluida_em
+            FROM tarefas
+            WHERE id = %s
+        """, (id_tarefa,))
+        return c.fetchone()
+
+
+def arquivo(id_tarefa):
+    with conectar() as conn:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        c.execute("""
+            SELECT conteudo, nome_arquivo, mimetype, usuario_id
+            FROM tarefas
+            WHERE id = %s AND status = 'concluida'
+        """, (id_tarefa,))
+        return c.fetchone()
+
+
+# =========================
+# EXECUÇÃO
+# =========================
+_acordar = threading.Event()
+_pid = None
+_pid_lock = threading.Lock()
+
+
+def _reservar():
+    with conectar() as conn:
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+        # SKIP LOCKED: executores de processos diferentes nunca pegam a mesma
+        c.execute("""
+            UPDATE tarefas
+            SET status = 'executando', iniciada_em = now(), progresso = 0
+            WHERE id = (
+                SELECT id
+                FROM tarefas
+                WHERE status = 'pendente' AND tipo = ANY(%s)
+                ORDER BY criada_em
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, tipo, parametros
+        """, (list(TIPOS),))
+        reservada = c.fetchone()
+
+        conn.commit()
+
+    return reservada
+
+
+def _executar(reservada):
+    id_tarefa = reservada["id"]
+    funcao, _ = TIPOS[reservada["tipo"]]
+
+    ultimo = [0.0]
+
+    def progresso(fracao):
+        agora = time.monotonic()
+        if agora - ultimo[0] < INTERVALO_PROGRESSO:
+            return
+        ultimo[0] = agora
+
+        with conectar() as conn:
+            c = conn.cursor()
+            c.execute(
+                "UPDATE tarefas SET progresso = %s WHERE id = %s AND status = 'executando'",
+                (min(max(fracao, 0), 1), id_tarefa)
+            )
+            conn.commit()
+
+    try:
+        conteudo, nome_arquivo, mimetype = funcao(reservada["parametros"], progresso)
+    except Exception as e:
+        log.exception("ERRO NA TAREFA %s", id_tarefa)
+        with conectar() as conn:
+            c = conn.cursor()
+            c.execute("""
+                UPDATE tarefas
+                SET status = 'erro', erro = %s, concluida_em = now()
+                WHERE id = %s AND status = 'executando'
+            """, (str(e), id_tarefa))
+            conn.commit()
+        return
+
+    with conectar() as conn:
+        c = conn.cursor()
+        c.execute("""
+            UPDATE tarefas
+            SET status = 'concluida',
+                progresso = 1,
+                conteudo = %s,
+                nome_arquivo = %s,
+                mimetype = %s,
+                concluida_em = now()
+            WHERE id = %s AND status = 'executando'
+        """, (psycopg2.Binary(conteudo), nome_arquivo, mimetype, id_tarefa))
+        conn.commit()
+
+
+def limpar():
+
+    # apaga arquivos expirados e encerra tarefas que passaram do tempo máximo
+    # (executor que morreu no meio, worker reiniciado etc.)
+    with conectar() as conn:
+        c = conn.cursor()
+        c.execute("""
+            DELETE FROM tarefas
+            WHERE status IN ('concluida', 'erro')
+              AND concluida_em < now() - make_interval(secs => %s)
+        """, (EXPIRAR_APOS,))
+        c.execute("""
+            UPDATE tarefas
+            SET status = 'erro', erro = 'Tempo máximo excedido', concluida_em = now()
+            WHERE status = 'executando'
+              AND iniciada_em < now() - make_interval(secs => %s)
+        """, (TEMPO_MAXIMO,))
+        conn.commit()
+
+
+def _executor(numero):
+    proxima_limpeza = 0
+
+    while True:
+        try:
+            # só o primeiro executor do processo faz a limpeza
+            if numero == 0 and time.monotonic() >= proxima_limpeza:
+                limpar()
+                proxima_limpeza = time.monotonic() + 60
+
+            reservada = _reservar()
+
+            if reservada is None:
+                _acordar.wait(INTERVALO)
+                _acordar.clear()
+                continue
+
+            _executar(reservada)
+
+        except psycopg2.Error:
+            log.exception("ERRO NA FILA DE TAREFAS")
+            time.sleep(INTERVALO)
+
+
+def iniciar():
+    global _pid
+
+    # uma vez por processo (cada worker do gunicorn é um fork)
+    if _pid == os.getpid():
+        return
+
+    with _pid_lock:
+        if _pid == os.getpid():
+            return
+        _pid = os.getpid()
+
+        for numero in range(CONCORRENCIA):
+            threading.Thread(
+                target=_executor,
+                args=(numero,),
+                name=f"tarefas-{numero}",
+                daemon=True
+            ).start()
+
+
+if __name__ == "__main__":
+    # executor dedicado (processo "worker" do Procfile)
+    # importa pelo nome do módulo: é nele que o app registra os tipos
+    import app  # noqa: F401
+    import tarefas
+
+    tarefas.iniciar()
+    print(f"Executando tarefas: {', '.join(sorted(tarefas.TIPOS))} ({CONCORRENCIA} thread(s))")
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        sys.exit(0)